@@ -0,0 +1,592 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import timedelta
+from typing import Iterator
+
+log = logging.getLogger(__name__)
+
+
+def cache_key(args, kwargs, version: str | None = None) -> tuple[str, str]:
+    """
+    Returns the cache key for a call: a fixed-size digest of the canonical
+    JSON encoding of the arguments (and the version, if any).
+    Also returns the encoding itself, which is stored alongside the entry
+    so that the cache can still be inspected.
+    """
+    encoded = json.dumps((args, kwargs), sort_keys=True, separators=(",", ":"),
+                         ensure_ascii=False)
+    data = encoded if version is None else f"{version}\0{encoded}"
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest(), encoded
+
+
+def legacy_cache_key(key: str) -> tuple[str, str]:
+    """
+    Converts a key of the old format, `json.dumps((args, kwargs))`,
+    to the current one.
+    """
+    args, kwargs = json.loads(key)
+    return cache_key(args, kwargs)
+
+
+class CacheBackend:
+    """
+    Storage interface used by `cache_results`.
+    A backend maps string keys to arbitrary (picklable) values.
+    Missing keys raise KeyError on `get`. Values can be stored with a
+    readable description of the arguments they were computed from.
+    Values stored with `encoding="json"` must be plain JSON data; they
+    can be read without the Python classes that produced them.
+
+    Backends may support an expiry policy: entries older than `ttl`
+    seconds are treated as missing, and at most `max_entries` entries
+    are kept, evicting the least recently (`eviction="lru"`) or least
+    frequently (`eviction="lfu"`) used ones.
+    Entries are tagged with `version`; compaction drops entries from
+    other versions.
+    """
+    ttl: float | None = None
+    max_entries: int | None = None
+    eviction: str = "lru"
+    version: str | None = None
+    # number of entries evicted to stay within max_entries
+    evictions: int = 0
+
+    def get(self, key: str):
+        return self.get_entry(key)[0]
+
+    def get_entry(self, key: str) -> tuple[object, float | None]:
+        """
+        Returns the value and the time it was stored (as a Unix
+        timestamp), or None if the backend does not record it.
+        """
+        raise NotImplementedError
+
+    def set(self, key: str, value, args: str | None = None,
+            encoding: str = "pickle") -> None:
+        raise NotImplementedError
+
+    def set_many(self, items) -> None:
+        """
+        Stores `(key, value)`, `(key, value, args)` or
+        `(key, value, args, encoding)` tuples.
+        """
+        for item in items:
+            self.set(*item)
+
+    def items(self):
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def changed(self) -> bool:
+        """
+        Returns True if the store was modified by someone else
+        (another connection or process) since the last call.
+        """
+        return False
+
+    def compact(self) -> int:
+        """
+        Removes expired entries and entries over the size limit, and
+        rewrites the store to free their space. Returns the number of
+        removed entries.
+        """
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+def _encode(value, encoding: str) -> bytes:
+    if encoding == "json":
+        return json.dumps(value, ensure_ascii=False).encode("utf-8")
+    return pickle.dumps(value)
+
+
+def _decode(data: bytes, encoding: str):
+    if encoding == "json":
+        return json.loads(data)
+    return pickle.loads(data)
+
+
+def _ttl_seconds(ttl) -> float | None:
+    if isinstance(ttl, timedelta):
+        return ttl.total_seconds()
+    return ttl
+
+
+class SqliteBackend(CacheBackend):
+    """
+    Stores every entry as its own row in an SQLite database, so lookups
+    and inserts only touch the affected key instead of the whole cache.
+    Each insert is its own transaction, and SQLite's locking makes it
+    safe to share the database between threads and processes.
+
+    `ttl` may be given in seconds or as a `timedelta`. The policy is
+    also saved in the database, so that `compact` can be run offline
+    (see `cache_tool.py`) with `load_policy=True` without knowing it.
+    Access times and counts are only tracked when `max_entries` is set,
+    so that plain lookups do not write to the database. The size limit
+    is enforced every `max_entries // 100` inserts, so the store can
+    briefly grow about 1% over it.
+    """
+
+    def __init__(self, filename: str, ttl=None, max_entries: int | None = None,
+                 eviction: str = "lru", version: str | None = None,
+                 load_policy: bool = False):
+        if eviction not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy: {eviction}")
+        self.filename = filename
+        self.ttl = _ttl_seconds(ttl)
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.version = version
+        self.load_policy = load_policy
+        self.evictions = 0
+        self._inserts = 0
+        # sqlite3 connections must not be shared between threads
+        self._local = threading.local()
+        # for `changed`: a connection that is only used to read
+        # `PRAGMA data_version`, and its value after our own last write
+        self._watcher: sqlite3.Connection | None = None
+        self._known_version: int | None = None
+        self._outside_change = False
+        self._write_lock = threading.RLock()
+        if load_policy:
+            self._conn()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            with self._writing():
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                with conn:
+                    # serialize schema setup between connections
+                    conn.execute("BEGIN IMMEDIATE")
+                    self._create_tables(conn)
+            self._local.conn = conn
+        return conn
+
+    def _data_version(self) -> int:
+        # `_write_lock` must be held
+        if self._watcher is None:
+            self._watcher = sqlite3.connect(self.filename, timeout=30, isolation_level=None,
+                                            check_same_thread=False)
+        return self._watcher.execute("PRAGMA data_version").fetchone()[0]
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        """
+        Commits in this block are our own, and do not count as changes
+        by someone else in `changed`. (PRAGMA data_version of a connection
+        also changes when other connections of this process commit, e.g.
+        those of other threads.)
+        """
+        with self._write_lock:
+            version = self._data_version()
+            if self._known_version not in (None, version):
+                self._outside_change = True
+            yield
+            self._known_version = self._data_version()
+
+    def _create_tables(self, conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL)"
+        )
+        # columns added after the first version of the schema
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(cache)")}
+        for column, definition in [
+            ("created_at", "REAL NOT NULL DEFAULT 0"),
+            ("accessed_at", "REAL NOT NULL DEFAULT 0"),
+            ("hits", "INTEGER NOT NULL DEFAULT 0"),
+            ("args", "TEXT"),
+            ("version", "TEXT"),
+            ("encoding", "TEXT NOT NULL DEFAULT 'pickle'"),
+        ]:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE cache ADD COLUMN {column} {definition}")
+                if column == "created_at":
+                    # start the clock for existing entries now
+                    conn.execute("UPDATE cache SET created_at = ?", (time.time(),))
+                if column == "args":
+                    # existing entries still use the JSON-encoded arguments as key
+                    rows = conn.execute("SELECT key FROM cache").fetchall()
+                    conn.executemany(
+                        "UPDATE cache SET key = ?, args = ? WHERE key = ?",
+                        (legacy_cache_key(key) + (key,) for key, in rows))
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        if self.load_policy:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            self.ttl = json.loads(meta.get("ttl", "null"))
+            self.max_entries = json.loads(meta.get("max_entries", "null"))
+            self.eviction = json.loads(meta.get("eviction", '"lru"'))
+            self.version = json.loads(meta.get("version", "null"))
+        else:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            policy = {"ttl": json.dumps(self.ttl),
+                      "max_entries": json.dumps(self.max_entries),
+                      "eviction": json.dumps(self.eviction),
+                      "version": json.dumps(self.version)}
+            # only written if it differs, so that opening a connection
+            # does not count as a change
+            if meta != {**meta, **policy}:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", policy.items())
+
+    def get_entry(self, key: str) -> tuple[object, float | None]:
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value, encoding, created_at FROM cache WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        value, encoding, created_at = row
+        if self.ttl is not None and created_at + self.ttl < time.time():
+            raise KeyError(key)
+        if self.max_entries is not None:
+            with self._writing():
+                conn.execute(
+                    "UPDATE cache SET accessed_at = ?, hits = hits + 1 WHERE key = ?",
+                    (time.time(), key))
+        return _decode(value, encoding), created_at
+
+    def set(self, key: str, value, args: str | None = None,
+            encoding: str = "pickle") -> None:
+        self.set_many([(key, value, args, encoding)])
+
+    def set_many(self, items, created_at: float | None = None) -> None:
+        now = time.time()
+        conn = self._conn()
+        with self._writing(), conn:
+            conn.execute("BEGIN")
+            cursor = conn.executemany(
+                "INSERT OR REPLACE INTO cache"
+                " (key, value, encoding, created_at, accessed_at, hits, args, version)"
+                " VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                (self._row(item, created_at or now, now) for item in items))
+        if self.max_entries is not None:
+            self._inserts += cursor.rowcount
+            if self._inserts >= max(1, self.max_entries // 100):
+                self._inserts = 0
+                self._evict(conn)
+
+    def _row(self, item, created_at: float, accessed_at: float) -> tuple:
+        key, value, *rest = item
+        args = rest[0] if len(rest) > 0 else None
+        encoding = rest[1] if len(rest) > 1 else "pickle"
+        return (key, _encode(value, encoding), encoding, created_at, accessed_at,
+                args, self.version)
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        removed = 0
+        with self._writing(), conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if self.ttl is not None:
+                removed += conn.execute(
+                    "DELETE FROM cache WHERE created_at < ?",
+                    (time.time() - self.ttl,)).rowcount
+            if self.load_policy:
+                # offline compaction also drops entries of old versions
+                removed += conn.execute(
+                    "DELETE FROM cache WHERE version IS NOT ?",
+                    (self.version,)).rowcount
+            if self.max_entries is not None:
+                count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+                if count > self.max_entries:
+                    order = "accessed_at" if self.eviction == "lru" else "hits, accessed_at"
+                    evicted = conn.execute(
+                        "DELETE FROM cache WHERE key IN ("
+                        f" SELECT key FROM cache ORDER BY {order} LIMIT ?)",
+                        (count - self.max_entries,)).rowcount
+                    self.evictions += evicted
+                    removed += evicted
+        if removed:
+            log.debug(f"Removed {removed} entries from {self.filename}")
+        return removed
+
+    def items(self):
+        for key, value, encoding in self._conn().execute(
+                "SELECT key, value, encoding FROM cache"):
+            yield key, _decode(value, encoding)
+
+    def entries(self):
+        """
+        Yields all entries as dicts with their metadata, for exporting.
+        """
+        rows = self._conn().execute(
+            "SELECT key, value, encoding, args, version, created_at FROM cache")
+        for key, value, encoding, args, version, created_at in rows:
+            yield {
+                "key": key,
+                "args": args,
+                "version": version,
+                "created_at": created_at,
+                "encoding": encoding,
+                "value": _decode(value, encoding),
+            }
+
+    def merge(self, entries, conflict: str = "newest") -> dict[str, int]:
+        """
+        Adds entries as returned by `entries` (e.g. from another node).
+        If a key already exists, `conflict` decides which value is kept:
+        "newest" keeps the more recently created one, "existing" keeps
+        ours, and "incoming" takes the new one.
+        Returns the number of added, replaced and skipped entries.
+        """
+        if conflict not in ("newest", "existing", "incoming"):
+            raise ValueError(f"Unknown conflict rule: {conflict}")
+        counts = {"added": 0, "replaced": 0, "skipped": 0}
+        now = time.time()
+        conn = self._conn()
+        with self._writing(), conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for entry in entries:
+                row = conn.execute(
+                    "SELECT created_at FROM cache WHERE key = ?",
+                    (entry["key"],)).fetchone()
+                if row is None:
+                    result = "added"
+                elif conflict == "incoming" or (
+                        conflict == "newest" and entry["created_at"] > row[0]):
+                    result = "replaced"
+                else:
+                    counts["skipped"] += 1
+                    continue
+                encoding = entry.get("encoding", "json")
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache"
+                    " (key, value, encoding, created_at, accessed_at, hits, args, version)"
+                    " VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                    (entry["key"], _encode(entry["value"], encoding), encoding,
+                     entry["created_at"], now, entry["args"], entry["version"]))
+                counts[result] += 1
+        return counts
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def changed(self) -> bool:
+        # data_version changes whenever another connection commits,
+        # our own commits are taken into account by `_writing`
+        with self._write_lock:
+            version = self._data_version()
+            changed = self._outside_change or self._known_version not in (None, version)
+            self._known_version = version
+            self._outside_change = False
+        return changed
+
+    def compact(self) -> int:
+        conn = self._conn()
+        removed = self._evict(conn)
+        with self._writing():
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        with self._write_lock:
+            if self._watcher is not None:
+                self._watcher.close()
+                self._watcher = None
+
+
+class PickleBackend(CacheBackend):
+    """
+    The original storage format: one pickled dict per cache.
+    Every insert rewrites the whole file, so this is only suitable
+    for small caches. Kept for compatibility and for migration.
+
+    Writes take an exclusive lock on `<file>.lock` and merge with the
+    current file contents, so that several processes can share a cache
+    without losing each other's entries.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._cache = None
+        self._lock = threading.Lock()
+        self._mtime = None
+
+    def _read(self) -> dict:
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                return pickle.load(f)
+        return {}
+
+    def _load(self) -> dict:
+        if self._cache is None:
+            self._cache = self._read()
+        return self._cache
+
+    def _update(self, items) -> None:
+        with self._lock, open(self.filename + ".lock", 'w', encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # pick up entries written by other processes in the meantime
+            cache = self._read()
+            cache.update(items)
+            tmp_file = f"{self.filename}.{os.getpid()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(cache, f)
+            os.replace(tmp_file, self.filename)
+            self._cache = cache
+            self._mtime = os.stat(self.filename).st_mtime_ns
+
+    def get_entry(self, key: str) -> tuple[object, float | None]:
+        return self._load()[key], None
+
+    def set(self, key: str, value, args: str | None = None,
+            encoding: str = "pickle") -> None:
+        self._update([(key, value)])
+
+    def set_many(self, items) -> None:
+        self._update((key, value) for key, value, *_ in items)
+
+    def items(self):
+        return list(self._load().items())
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def changed(self) -> bool:
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        changed = self._mtime is not None and mtime != self._mtime
+        self._mtime = mtime
+        if changed:
+            self._cache = None
+        return changed
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+class LRUCache:
+    """
+    In-memory least-recently-used cache, bounded by the number of
+    entries and by the (pickled) size of the values in bytes.
+    Entries can be given an expiry time (Unix timestamp).
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self.size_bytes = 0
+        # key -> (value, size, expires_at)
+        self._data: OrderedDict[str, tuple[object, int, float | None]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            try:
+                value, size, expires_at = self._data[key]
+                if expires_at is not None and expires_at < time.time():
+                    del self._data[key]
+                    self.size_bytes -= size
+                    raise KeyError(key)
+            except KeyError:
+                self.stats.misses += 1
+                raise
+            self._data.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def set(self, key: str, value, expires_at: float | None = None) -> None:
+        size = len(pickle.dumps(value))
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            if key in self._data:
+                self.size_bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size, expires_at)
+            self.size_bytes += size
+            while len(self._data) > self.max_entries or self.size_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.stats.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.size_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def default_backend(name: str, **options) -> CacheBackend:
+    """
+    Returns the default backend for the cache called `name`.
+    `options` are passed on to `SqliteBackend`.
+    Existing `<name>_cache.pkl` files are migrated on first use.
+    """
+    backend = SqliteBackend(f"{name}_cache.sqlite", **options)
+    pickle_file = f"{name}_cache.pkl"
+    if os.path.exists(pickle_file):
+        migrate_pickle(pickle_file, backend)
+    return backend
+
+
+def migrate_pickle(pickle_file: str, backend: CacheBackend) -> int:
+    """
+    Copies all entries of a legacy pickle cache into `backend`,
+    converting the keys to the current format. Afterwards the pickle
+    file is renamed to `<file>.migrated`, so the migration only runs
+    once. Returns the number of migrated entries.
+    """
+    try:
+        with open(pickle_file, 'rb') as f:
+            cache = pickle.load(f)
+    except FileNotFoundError:
+        # another process migrated it in the meantime
+        return 0
+
+    items = []
+    for key, value in cache.items():
+        new_key, args = legacy_cache_key(key)
+        items.append((new_key, value, args))
+    backend.set_many(items)
+    try:
+        os.replace(pickle_file, pickle_file + ".migrated")
+    except FileNotFoundError:
+        pass
+    log.info(f"Migrated {len(cache)} entries from {pickle_file}")
+    return len(cache)
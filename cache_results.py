@@ -1,7 +1,10 @@
-import json
-import os
-import pickle
+import concurrent.futures
 import logging
+import threading
+import time
+import typing
+from cache_backends import (CacheBackend, CacheStats, LRUCache, cache_key,
+                            default_backend)
 from utils import sync_async_decorator
 
 logging.basicConfig(level=logging.INFO)
@@ -13,19 +16,197 @@ class Unset:
 UNSET = Unset()
 
 
-def cache_results(name=None, dummy_on_miss=UNSET):
+# Calls that are currently being computed, by (cache name, key).
+# Concurrent calls with the same key wait for the first one instead
+# of computing the same result again.
+_in_flight: dict[tuple[str, str], concurrent.futures.Future] = {}
+_in_flight_lock = threading.Lock()
+
+
+def result_adapter(func):
+    """
+    Returns a pydantic TypeAdapter for the return annotation of `func`,
+    which is used to store its results as plain JSON. Returns None if
+    there is no usable annotation; the results are then pickled.
+    """
+    try:
+        return_type = typing.get_type_hints(func).get("return")
+    except Exception:  # pylint: disable=broad-exception-caught
+        return None
+    if return_type is None:
+        return None
+    try:
+        from pydantic import TypeAdapter  # pylint: disable=import-outside-toplevel
+        return TypeAdapter(return_type)
+    except Exception:  # pylint: disable=broad-exception-caught
+        log.debug(f"Cannot store results of {func.__name__} as JSON, using pickle")
+        return None
+
+
+class TieredCache:
+    """
+    An in-memory LRU cache in front of a persistent backend.
+    The memory tier is cleared whenever the backend reports that it
+    was changed by another process or connection.
+    If an `adapter` is given, values are stored as JSON and validated
+    against it when read back, so the store does not depend on Python
+    class paths (see `cache_tool.py export`).
+    """
+
+    def __init__(self, name: str, backend: CacheBackend, memory: LRUCache,
+                 adapter=None):
+        self.name = name
+        self.backend = backend
+        self.memory = memory
+        self.adapter = adapter
+        self.disk_stats = CacheStats()
+
+    def get(self, key: str):
+        if self.backend.changed():
+            log.debug(f"Backing store of {self.name} changed, clearing memory cache")
+            self.memory.clear()
+        try:
+            return self.memory.get(key)
+        except KeyError:
+            pass
+        try:
+            value, created_at = self.backend.get_entry(key)
+        except KeyError:
+            self.disk_stats.misses += 1
+            raise
+        self.disk_stats.hits += 1
+        if self.adapter is not None:
+            # JSON data, or objects pickled before results were stored as JSON
+            value = self.adapter.validate_python(value)
+        self.memory.set(key, value, self._expires_at(created_at))
+        return value
+
+    def set(self, key: str, value, args: str | None = None) -> None:
+        stored, encoding = value, "pickle"
+        if self.adapter is not None:
+            try:
+                stored = self.adapter.dump_python(value, mode="json", warnings="error")
+                encoding = "json"
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                log.warning(f"Could not store result of {self.name} as JSON: {e}")
+        self.backend.set(key, stored, args, encoding)
+        self.memory.set(key, value, self._expires_at(time.time()))
+
+    def _expires_at(self, created_at: float | None) -> float | None:
+        if self.backend.ttl is None or created_at is None:
+            return None
+        return created_at + self.backend.ttl
+
+    def stats(self) -> dict:
+        self.disk_stats.evictions = self.backend.evictions
+        return {
+            "memory": self.memory.stats.as_dict(),
+            "disk": self.disk_stats.as_dict(),
+        }
+
+
+# All caches created by `cache_results`, for reporting
+_caches: list[TieredCache] = []
+
+
+def register_cache(cache: TieredCache) -> None:
+    """
+    Adds a cache that was not created by `cache_results` (e.g. the chunk
+    cache of `crawl4ai_helpers`) to the ones reported by `cache_stats`.
+    """
+    _caches.append(cache)
+
+
+def cache_stats() -> dict[str, dict[str, dict[str, int]]]:
+    """
+    Returns the hit/miss/eviction counters of all caches, per tier:
+    `{"google_search": {"memory": {"hits": ...}, "disk": {...}}, ...}`
+    Counters of caches that share a name are added up.
+    """
+    result = {}
+    for cache in _caches:
+        tiers = result.setdefault(cache.name, {})
+        for tier, counters in cache.stats().items():
+            total = tiers.setdefault(tier, dict.fromkeys(counters, 0))
+            for counter, value in counters.items():
+                total[counter] += value
+    return result
+
+
+def cache_results(name=None, dummy_on_miss=UNSET, backend=None,
+                  memory_entries=1000, memory_bytes=64 * 1024 * 1024,
+                  ttl=None, max_entries=None, eviction="lru", version=None,
+                  ignore=(), cacheable=None):
     """
     Decorator to cache the results of a function based on its name.
-    The cache is stored in a file named after the function.
-    Uses pickle for serialization.
+    By default the cache is stored in an SQLite database named after the
+    function (`<name>_cache.sqlite`), see `cache_backends`.
+    `backend` can be a `CacheBackend` instance, or a callable that takes
+    the cache name and returns one.
+    Recently used entries are also kept in memory, up to `memory_entries`
+    entries and `memory_bytes` bytes. Set `memory_entries=0` to disable.
+    Entries older than `ttl` (seconds or `timedelta`) are ignored, and at
+    most `max_entries` entries are kept on disk, evicting by `eviction`
+    ("lru" or "lfu"). These are passed on to the backend factory.
+
+    Results are stored as JSON if the function has a return annotation
+    that pydantic understands, otherwise they are pickled.
+    Keys are digests of the arguments, see `cache_backends.cache_key`.
+    Changing `version` (a string, or a function returning one that is
+    called on first use) gives the function a fresh set of keys, without
+    affecting other caches; `cache_tool.py compact` then removes the
+    entries of old versions.
+    Keyword arguments named in `ignore` are passed on to the function,
+    but are not part of the key (e.g. inputs that were already computed).
+    If `cacheable` is given, results for which it returns False are
+    returned, but not stored (and ignored if they are in the cache).
+
+    The decorated function gets a `cached(*args, **kwargs)` method, which
+    returns the cached result without calling the function, or raises
+    `KeyError`.
     """
-    @sync_async_decorator
-    def decorator(func, *args, **kwargs):
-        nonlocal name
+    cache = None
+
+    def get_cache(func) -> TieredCache:
+        nonlocal name, cache, version
         if name is None:
             name = func.__name__
 
-        cache_file = f"{name}_cache.pkl"
+        if cache is None:
+            if callable(version):
+                version = version()
+            if isinstance(backend, CacheBackend):
+                store = backend
+            else:
+                policy = {}
+                if version is not None:
+                    policy["version"] = version
+                if ttl is not None:
+                    policy["ttl"] = ttl
+                if max_entries is not None:
+                    policy["max_entries"] = max_entries
+                    policy["eviction"] = eviction
+                store = (backend or default_backend)(name, **policy)
+            cache = TieredCache(name, store, LRUCache(memory_entries, memory_bytes),
+                                result_adapter(func))
+            register_cache(cache)
+        return cache
+
+    def key_for(args, kwargs) -> tuple[str, str]:
+        # `get_cache` must have been called, it resolves a callable `version`
+        kwargs = {k: v for k, v in kwargs.items() if k not in ignore}
+        return cache_key(args, kwargs, version)
+
+    def lookup(key: str):
+        result = cache.get(key)
+        if cacheable is not None and not cacheable(result):
+            # stored before `cacheable` was added
+            raise KeyError(key)
+        return result
+
+    @sync_async_decorator
+    def decorator_logic(func, *args, **kwargs):
+        get_cache(func)
 
         skip_cache = kwargs.pop('skip_cache', False)
         cache_return_info = kwargs.pop('cache_return_info', False)
@@ -34,39 +215,78 @@ def cache_results(name=None, dummy_on_miss=UNSET):
                 return (value, info)
             return value
 
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as f:
-                cache = pickle.load(f)
-        else:
-            cache = {}
+        key, encoded_args = key_for(args, kwargs)
 
-        key = json.dumps((args, kwargs), sort_keys=True)
+        while True:
+            if not skip_cache:
+                try:
+                    result = lookup(key)
+                except KeyError:
+                    pass
+                else:
+                    log.debug(f"Cache hit for {name} with args: {args}, kwargs: {kwargs}")
+                    log.debug("Returning cached result")
+                    return add_info(result, 'hit')
 
-        if not skip_cache and key in cache:
-            log.debug(f"Cache hit for {name} with args: {args}, kwargs: {kwargs}")
-            result = cache[key]
-            log.debug("Returning cached result")
-            return add_info(result, 'hit')
+            if skip_cache:
+                log.debug(f"Skipping cache for {name} with args: {args}, kwargs: {kwargs}")
+            else:
+                log.debug(f"Cache miss for {name} with args: {args}, kwargs: {kwargs}")
 
-        if skip_cache:
-            log.debug(f"Skipping cache for {name} with args: {args}, kwargs: {kwargs}")
-        else:
-            log.debug(f"Cache miss for {name} with args: {args}, kwargs: {kwargs}")
+            if dummy_on_miss is not UNSET:
+                log.debug(f"Returning dummy value for {name} with args: {args}, kwargs: {kwargs}")
+                return add_info(dummy_on_miss, 'dummy')
 
-        if dummy_on_miss is not UNSET:
-            log.debug(f"Returning dummy value for {name} with args: {args}, kwargs: {kwargs}")
-            return add_info(dummy_on_miss, 'dummy')
+            with _in_flight_lock:
+                flight = _in_flight.get((name, key))
+                if flight is None:
+                    flight = concurrent.futures.Future()
+                    _in_flight[(name, key)] = flight
+                    break
 
-        # call the wrapped function
-        result = yield args, kwargs
+            # Someone else is already computing this result, wait for it
+            log.debug(f"Waiting for in-flight call of {name} with args: {args}, kwargs: {kwargs}")
+            try:
+                result = yield flight
+            except BaseException:
+                if flight.cancelled():
+                    # the first caller was interrupted, try again
+                    continue
+                raise
+            return add_info(result, 'coalesced')
 
-        # store the result in cache
-        cache[key] = result
-        with open(cache_file, 'wb') as f:
-            pickle.dump(cache, f)
+        try:
+            # call the wrapped function
+            result = yield args, kwargs
+
+            # store the result in cache
+            if cacheable is None or cacheable(result):
+                cache.set(key, result, encoded_args)
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        except BaseException:
+            flight.cancel()
+            raise
+        else:
+            flight.set_result(result)
+        finally:
+            with _in_flight_lock:
+                del _in_flight[(name, key)]
 
         return add_info(result, 'skip' if skip_cache else 'miss')
 
+    def decorator(func):
+        wrapper = decorator_logic(func)
+
+        def cached(*args, **kwargs):
+            get_cache(func)
+            key, _ = key_for(args, kwargs)
+            return lookup(key)
+
+        wrapper.cached = cached
+        return wrapper
+
     # if the parameter is a function, we called this without parentheses
     # so just run the decorator directly
     if callable(name):
@@ -0,0 +1,135 @@
+"""
+Maintenance commands for the caches written by `cache_results`.
+
+    # remove expired entries, entries over the size limit and entries
+    # of old versions, and shrink the database files
+    uv run cache_tool.py compact google_search_cache.sqlite scrape_url_cache.sqlite
+
+    # export a cache as JSON lines, independent of Python classes
+    uv run cache_tool.py export scrape_url_cache.sqlite -o scrape_url_node1.jsonl
+
+    # merge exports (or SQLite files) from other nodes into the local cache
+    uv run cache_tool.py merge scrape_url_cache.sqlite scrape_url_node1.jsonl scrape_url_node2.jsonl
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+from cache_backends import SqliteBackend
+
+
+def _json_default(obj):
+    # Pydantic models pickled by older versions of cache_results
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def portable_entries(filename: str):
+    """
+    Yields the entries of a cache file with plain JSON values.
+    `filename` can be an SQLite cache or a JSON lines export.
+    Pickled values that cannot be converted are skipped.
+    """
+    if filename.endswith(".jsonl"):
+        with open(filename, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+
+    backend = SqliteBackend(filename, load_policy=True)
+    for entry in backend.entries():
+        if entry["encoding"] != "json":
+            try:
+                entry["value"] = json.loads(json.dumps(entry["value"], default=_json_default))
+            except TypeError as e:
+                print(f"Skipping entry {entry['key']} ({entry['args']}): {e}", file=sys.stderr)
+                continue
+            entry["encoding"] = "json"
+        yield entry
+    backend.close()
+
+
+def compact(args):
+    for filename in args.files:
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f"File {filename} does not exist.")
+
+        # use the policy the cache was last used with, unless overridden
+        backend = SqliteBackend(filename, load_policy=True)
+        entries_before = len(backend)
+        if args.ttl_days is not None:
+            backend.ttl = args.ttl_days * 24 * 60 * 60
+        if args.max_entries is not None:
+            backend.max_entries = args.max_entries
+        if args.eviction is not None:
+            backend.eviction = args.eviction
+
+        size_before = os.path.getsize(filename)
+        removed = backend.compact()
+        backend.close()
+        size_after = os.path.getsize(filename)
+        print(f"{filename}: removed {removed} of {entries_before} entries, "
+              f"{size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB")
+
+
+def export(args):
+    count = 0
+    with (open(args.output, "w", encoding="utf-8") if args.output
+          else contextlib.nullcontext(sys.stdout)) as out:
+        for entry in portable_entries(args.file):
+            print(json.dumps(entry, ensure_ascii=False), file=out)
+            count += 1
+    print(f"Exported {count} entries from {args.file}", file=sys.stderr)
+
+
+def merge(args):
+    target = SqliteBackend(args.target, load_policy=True)
+    for source in args.sources:
+        counts = target.merge(portable_entries(source), conflict=args.conflict)
+        print(f"{source}: added {counts['added']}, replaced {counts['replaced']}, "
+              f"skipped {counts['skipped']} entries")
+    target.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_compact = subparsers.add_parser(
+        "compact", help="Remove dead entries and rewrite the cache files")
+    parser_compact.add_argument("files", nargs="+", help="SQLite cache files")
+    parser_compact.add_argument("--ttl-days", type=float,
+                                help="Remove entries older than this")
+    parser_compact.add_argument("--max-entries", type=int,
+                                help="Keep at most this many entries")
+    parser_compact.add_argument("--eviction", choices=["lru", "lfu"],
+                                help="Which entries to remove first")
+    parser_compact.set_defaults(func=compact)
+
+    parser_export = subparsers.add_parser(
+        "export", help="Write a cache as JSON lines")
+    parser_export.add_argument("file", help="SQLite cache file")
+    parser_export.add_argument("-o", "--output", help="Output file (default: stdout)")
+    parser_export.set_defaults(func=export)
+
+    parser_merge = subparsers.add_parser(
+        "merge", help="Add the entries of other caches to a cache")
+    parser_merge.add_argument("target", help="SQLite cache file to merge into")
+    parser_merge.add_argument("sources", nargs="+",
+                              help="JSON lines exports (.jsonl) or SQLite cache files")
+    parser_merge.add_argument("--conflict", choices=["newest", "existing", "incoming"],
+                              default="newest",
+                              help="Which value to keep if a key exists in both (default: newest)")
+    parser_merge.set_defaults(func=merge)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,367 @@
+import hashlib
+import inspect
+import json
 import logging
-log = logging.getLogger(__name__)
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Callable
 
 from crawl4ai import LLMExtractionStrategy
+from crawl4ai.utils import (escape_json_string, extract_xml_data,
+                            perform_completion_with_backoff, sanitize_html,
+                            sanitize_input_encode)
+from pydantic import TypeAdapter
+
+from cache_backends import LRUCache, SqliteBackend
+from cache_results import TieredCache, register_cache
+from crawler.ranking import top_chunks
+from llm_batching import BatchDispatcher, numbered_items
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+_chunk_cache: TieredCache | None = None
+_chunk_cache_lock = threading.Lock()
+
+
+def chunk_cache() -> TieredCache:
+    """
+    The cache of LLM answers per chunk, see `ChunkLimitedLLMExtractionStrategy`.
+    Stored in `llm_chunk_cache.sqlite`, entries expire after 180 days.
+    """
+    global _chunk_cache  # pylint: disable=global-statement
+    with _chunk_cache_lock:
+        if _chunk_cache is None:
+            _chunk_cache = TieredCache(
+                "llm_chunk",
+                SqliteBackend("llm_chunk_cache.sqlite", ttl=timedelta(days=180)),
+                LRUCache(10_000, 64 * 1024 * 1024),
+                TypeAdapter(list[dict[str, Any]]))
+            register_cache(_chunk_cache)
+        return _chunk_cache
+
+
+def chunk_key(model: str, instruction: str | None, schema: Any, chunk: str) -> str:
+    """
+    The key of the answer of `model` for `chunk`. Identical chunks (e.g.
+    navigation and footers, or a PDF linked under several URLs) get the
+    same key, whatever page they are on.
+    """
+    chunk_hash = hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).hexdigest()
+    data = json.dumps([model, instruction, schema, chunk_hash], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def any_positive(blocks: list[dict[str, Any]]) -> bool:
+    return any(block.get("software_usage_found") is True for block in blocks)
+
+
+# Prompt for several chunks at once, see `llm_dispatcher`. Each chunk has
+# its own instruction, so chunks of different pages can share a request.
+PROMPT_EXTRACT_BATCH = """Here are {COUNT} numbered items. Each item has the URL and content of a web page, and a request about that content:
+
+{ITEMS}
+
+<schema_block>
+{SCHEMA}
+</schema_block>
+
+Answer the request of each item separately, using only the content of that item. Extract the requested information according to the JSON schema above. Every JSON object must have the field "item" with the number of the item it belongs to, and there must be at least one object for each item.
+
+Return all JSON objects of all items as one JSON list, wrapped in <blocks>...</blocks> XML tags. Do NOT add any comments to the JSON, and make sure to close the </blocks> tag."""
+
+PROMPT_BATCH_ITEM = """<item number="{NUMBER}">
+<url>{URL}</url>
+<user_request>
+{REQUEST}
+</user_request>
+<url_content>
+{HTML}
+</url_content>
+</item>"""
+
+# Settings of the batching of LLM requests, see `configure_batching`
+_batch_settings = {"batch_size": 4, "max_wait": 0.25}
+_dispatcher: BatchDispatcher | None = None
+_dispatcher_lock = threading.Lock()
+
+
+def configure_batching(batch_size: int | None = None, max_wait: float | None = None) -> None:
+    """
+    Sets how many chunks are sent to the LLM in one request at most
+    (1 turns batching off), and how many seconds a chunk waits for others
+    to fill the batch.
+    """
+    global _dispatcher  # pylint: disable=global-statement
+    with _dispatcher_lock:
+        if batch_size is not None:
+            _batch_settings["batch_size"] = batch_size
+        if max_wait is not None:
+            _batch_settings["max_wait"] = max_wait
+        _dispatcher = None
+
+
+def llm_dispatcher() -> BatchDispatcher | None:
+    """
+    The dispatcher that combines the chunks of all pages evaluated at the
+    same time into batched LLM requests, or None if batching is off.
+    """
+    global _dispatcher  # pylint: disable=global-statement
+    with _dispatcher_lock:
+        if _batch_settings["batch_size"] <= 1:
+            return None
+        if _dispatcher is None:
+            _dispatcher = BatchDispatcher(_send_batch, _batch_settings["batch_size"],
+                                          _batch_settings["max_wait"])
+        return _dispatcher
+
+
+def _batch_schema(schema: dict[str, Any]) -> dict[str, Any]:
+    """
+    `schema` with the additional field "item", the number of the item.
+    """
+    return {
+        **schema,
+        "properties": {"item": {"type": "integer"}, **schema.get("properties", {})},
+        "required": ["item", *schema.get("required", [])],
+    }
+
+
+def _send_batch(key, requests: list[tuple["ChunkLimitedLLMExtractionStrategy", str, int, str]]
+                ) -> list[list[dict[str, Any]] | Exception]:
+    """
+    Asks the LLM about several chunks in one request. Chunks whose answer
+    is missing (or all of them, if the answer cannot be parsed) are sent
+    again on their own, at the same time. If that fails too, the error is
+    returned for the chunk, instead of failing the whole batch.
+    """
+    # (all requests with the same key have the same model, schema and arguments)
+    del key
+    if len(requests) == 1:
+        strategy, url, ix, html = requests[0]
+        return [LLMExtractionStrategy.extract(strategy, url, ix, html)]
+
+    strategy = requests[0][0]
+    items = "\n\n".join(
+        PROMPT_BATCH_ITEM
+        .replace("{NUMBER}", str(number))
+        .replace("{URL}", url)
+        .replace("{REQUEST}", request_strategy.instruction or "")
+        .replace("{HTML}", escape_json_string(sanitize_html(html)))
+        for number, (request_strategy, url, _, html) in enumerate(requests, start=1))
+    prompt = (PROMPT_EXTRACT_BATCH
+              .replace("{COUNT}", str(len(requests)))
+              .replace("{SCHEMA}", json.dumps(_batch_schema(strategy.schema or {}), indent=2))
+              .replace("{ITEMS}", items))
+    extra_args = dict(strategy.extra_args)
+    if "max_tokens" in extra_args:
+        # room for the answers of all items
+        extra_args["max_tokens"] *= len(requests)
+
+    try:
+        log.info(f"Sending {len(requests)} chunks to the LLM in one request")
+        response = perform_completion_with_backoff(
+            strategy.llm_config.provider,
+            prompt,
+            strategy.llm_config.api_token,
+            base_url=strategy.llm_config.base_url,
+            extra_args=extra_args,
+        )
+        content = response.choices[0].message.content
+        answers = numbered_items(json.loads(extract_xml_data(["blocks"], content)["blocks"]),
+                                 len(requests))
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        log.warning(f"Batched LLM request failed, sending the chunks one by one: {e!r}")
+        answers = [None] * len(requests)
+
+    for answer in answers:
+        for block in answer or []:
+            block["error"] = False
+    missing = [number for number, answer in enumerate(answers) if answer is None]
+    if not missing:
+        return answers
+
+    def resend(request) -> list[dict[str, Any]] | Exception:
+        try:
+            return LLMExtractionStrategy.extract(*request)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            return e
+
+    # in parallel, like the chunks of a wave (one at a time for groq, see `run`)
+    metrics.increment("llm_batches", "resent", len(missing))
+    workers = 1 if strategy.llm_config.provider.startswith("groq/") else len(missing)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        resent = executor.map(resend, [requests[number] for number in missing])
+        for number, answer in zip(missing, resent):
+            answers[number] = answer
+    return answers
+
+
+# The parameters of the parent class, see `ChunkLimitedLLMExtractionStrategy.__setattr__`
+_PARENT_PARAMETERS = inspect.signature(LLMExtractionStrategy.__init__).parameters
 
 
 class ChunkLimitedLLMExtractionStrategy(LLMExtractionStrategy):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        max_chunks = 5
+    """
+    Sends at most `max_chunks` chunks of a page to the LLM. If the page
+    has more chunks, and `ranking_terms` are given, the chunks that are
+    most relevant for these terms are chosen (BM25, see `crawler.ranking`),
+    best first. Otherwise, the first `max_chunks` chunks are used.
+
+    The chunks are evaluated in waves of `wave_size` concurrent calls.
+    After each wave, `stop_when` is called with the blocks extracted so
+    far; if it returns True, the remaining chunks are not sent to the LLM.
+    By default, this stops at the first positive block. Pass
+    `stop_when=None` to always evaluate all chunks.
+    Afterwards, `evaluated_chunks` is the number of chunks that were sent,
+    and `skipped_chunks` has the indices of the others.
+    No further waves are started once `stop_event` is set, e.g. because
+    the caller was cancelled (`run` itself cannot be interrupted).
 
+    If a `cache` is given (see `chunk_cache`), the answers for each chunk
+    are cached by model, instruction, schema and chunk content.
+
+    Chunks that are not cached are sent through `llm_dispatcher`, which
+    batches them with chunks of other pages evaluated at the same time.
+    """
+
+    def __init__(self, *args, max_chunks: int = 5, ranking_terms: list[str] | None = None,
+                 wave_size: int = 2,
+                 stop_when: Callable[[list[dict[str, Any]]], bool] | None = any_positive,
+                 cache: TieredCache | None = None,
+                 stop_event: threading.Event | None = None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+        self.stop_event = stop_event
         self.max_chunks = max_chunks
+        self.ranking_terms = ranking_terms
+        self.wave_size = wave_size
+        self.stop_when = stop_when
+        self.evaluated_chunks = 0
+        self.skipped_chunks: list[int] = []
 
         # self.chunk_warning_threshold = chunk_warning_threshold
         # self.chunk_count = 0
         # self.warnings_issued = []
 
+    def __setattr__(self, name: str, value: Any) -> None:
+        """
+        Like `LLMExtractionStrategy.__setattr__`, which rejects the deprecated
+        attributes (provider, api_token, ...) unless they have the default of
+        the `__init__` parameter of the same name. This `__init__` passes them
+        on in `**kwargs`, so the defaults are taken from the parent's.
+        """
+        unwanted = getattr(self, "_UNWANTED_PROPS", {})
+        if name in unwanted and value is not _PARENT_PARAMETERS[name].default:
+            raise AttributeError(f"Setting '{name}' is deprecated. {unwanted[name]}")
+        super(LLMExtractionStrategy, self).__setattr__(name, value)
+
     def _merge(self, documents, chunk_token_threshold, overlap) -> list[str]:
         """Override merge method to implement hard chunk limiting"""
         merged = super()._merge(documents, chunk_token_threshold, overlap)
         chunk_count = len(merged)
         if chunk_count > self.max_chunks:
             log.warning(f"Content would generate {chunk_count} chunks, limiting to {self.max_chunks}")
-            # Implement truncation or alternative processing
-            merged = merged[:self.max_chunks]
+            if self.ranking_terms:
+                selected = top_chunks(merged, self.ranking_terms, self.max_chunks)
+                log.info(f"Most relevant chunks: {selected}")
+                merged = [merged[ix] for ix in selected]
+            else:
+                merged = merged[:self.max_chunks]
             # self.warnings_issued.append(f"Content truncated to {self.max_chunks} chunks")
-        return merged
\ No newline at end of file
+        return merged
+
+    def run(self, url: str, sections: list[str]) -> list[dict[str, Any]]:
+        """Override run method to evaluate the chunks in waves, see class docstring"""
+        merged = self._merge(
+            sections,
+            self.chunk_token_threshold,
+            overlap=int(self.chunk_token_threshold * self.overlap_rate),
+        )
+        # like the original: one request at a time for groq, because of rate limits
+        sequential = self.llm_config.provider.startswith("groq/")
+        wave_size = 1 if sequential else max(1, self.wave_size)
+
+        extracted: list[dict[str, Any]] = []
+        self.evaluated_chunks = 0
+        self.skipped_chunks = []
+        # Only the LLM calls run in the executor. The cache is used from
+        # this thread, so that the short-lived executor threads do not open
+        # SQLite connections of their own.
+        with ThreadPoolExecutor(max_workers=wave_size) as executor:
+            for start in range(0, len(merged), wave_size):
+                if self.stop_event is not None and self.stop_event.is_set():
+                    self.skipped_chunks = list(range(start, len(merged)))
+                    log.info(f"Skipping chunks {self.skipped_chunks} of {url}, stopped")
+                    break
+                wave = range(start, min(start + wave_size, len(merged)))
+                chunks = {ix: sanitize_input_encode(merged[ix]) for ix in wave}
+                cached = {ix: self._cached(chunks[ix]) for ix in wave}
+                futures = {ix: executor.submit(self._extract_uncached, url, ix, chunks[ix])
+                           for ix in wave if cached[ix] is None}
+                self.evaluated_chunks += len(wave)
+                for ix in wave:
+                    blocks = cached[ix]
+                    if blocks is None:
+                        try:
+                            blocks = futures[ix].result()
+                        except Exception as e:  # pylint: disable=broad-exception-caught
+                            log.warning(f"Error in chunk {ix} of {url}: {e}")
+                            blocks = [{
+                                "index": ix,
+                                "error": True,
+                                "tags": ["error"],
+                                "content": str(e),
+                            }]
+                        else:
+                            self._store(url, chunks[ix], blocks)
+                    extracted.extend(blocks)
+
+                if self.stop_when is not None and self.stop_when(extracted):
+                    self.skipped_chunks = list(range(wave.stop, len(merged)))
+                    if self.skipped_chunks:
+                        log.info(f"Skipping chunks {self.skipped_chunks} of {url}, "
+                                 f"answer found after {wave.stop} chunks")
+                    break
+                if sequential:
+                    time.sleep(0.5)
+        return extracted
+
+    def extract(self, url: str, ix: int, html: str) -> list[dict[str, Any]]:
+        """Override extract method to look up the answer for the chunk in the cache first"""
+        blocks = self._cached(html)
+        if blocks is None:
+            blocks = self._extract_uncached(url, ix, html)
+            self._store(url, html, blocks)
+        return blocks
+
+    def _cached(self, html: str) -> list[dict[str, Any]] | None:
+        if self.cache is None:
+            return None
+        key = chunk_key(self.llm_config.provider, self.instruction, self.schema, html)
+        try:
+            blocks = self.cache.get(key)
+        except KeyError:
+            metrics.increment("llm_chunk_cache", "miss")
+            return None
+        metrics.increment("llm_chunk_cache", "hit")
+        return [dict(block) for block in blocks]
+
+    def _store(self, url: str, html: str, blocks: list[dict[str, Any]]) -> None:
+        if self.cache is None or any(block.get("error") for block in blocks):
+            return
+        key = chunk_key(self.llm_config.provider, self.instruction, self.schema, html)
+        self.cache.set(key, blocks, json.dumps({"model": self.llm_config.provider, "url": url}))
+
+    def _extract_uncached(self, url: str, ix: int, html: str) -> list[dict[str, Any]]:
+        dispatcher = llm_dispatcher()
+        if dispatcher is None:
+            return super().extract(url, ix, html)
+        # chunks are only batched with chunks for the same model and schema
+        batch_key = (self.llm_config.provider, self.llm_config.base_url,
+                     json.dumps(self.schema, sort_keys=True),
+                     json.dumps(self.extra_args, sort_keys=True))
+        return dispatcher.submit(batch_key, (self, url, ix, html))
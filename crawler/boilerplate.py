@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+from collections import Counter
+from typing import Callable, Iterable
+from urllib.parse import urlsplit
+
+from crawler import content_store
+from crawler.content_store import normalize_url
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+_BLOCK_SEPARATOR = re.compile(r"\n\s*\n")
+
+
+def split_blocks(markdown: str) -> list[str]:
+    """
+    Paragraph-like blocks, separated by empty lines (like `RegexChunking`).
+    """
+    return [block.strip() for block in _BLOCK_SEPARATOR.split(markdown) if block.strip()]
+
+
+def block_hash(block: str) -> str:
+    return hashlib.blake2b(" ".join(block.split()).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def estimate_tokens(text: str) -> int:
+    # about 4 tokens per 3 words, like crawl4ai's word_token_rate
+    return round(len(text.split()) * 4 / 3)
+
+
+class _HostStats:
+    def __init__(self):
+        self.pages: set[str] = set()
+        # distinct page contents, the same page or PDF can be under several URLs
+        self.contents: set[str] = set()
+        # number of distinct contents each block occurs in
+        self.counts: Counter[str] = Counter()
+
+
+class BoilerplateFilter:
+    """
+    Learns which blocks (header, navigation, language switcher, footer,
+    ...) occur on most pages of a host, and removes them from pages of
+    that host before they are chunked.
+
+    A block is boilerplate if it is on at least `min_pages` pages and on
+    at least `min_fraction` of the pages seen from the host. Pages with
+    the same content (e.g. a document linked under several URLs) count
+    only once. When a host
+    is seen for the first time, up to `seed_pages` of its pages are read
+    with `seed` (by default from the content store), so that the filter
+    also works on the first pages of a run.
+    """
+
+    def __init__(self, min_pages: int = 3, min_fraction: float = 0.5, seed_pages: int = 50,
+                 seed: Callable[[str, int], Iterable[tuple[str, str]]] | None = None):
+        self.min_pages = min_pages
+        self.min_fraction = min_fraction
+        self.seed_pages = seed_pages
+        self.seed = seed
+        self._hosts: dict[str, _HostStats] = {}
+        self._lock = threading.Lock()
+
+    def seed_host(self, url: str) -> None:
+        """
+        Reads the seed pages of the host of `url`, if it was not seen yet.
+        This reads from the content store, see `prepare_host`.
+        """
+        with self._lock:
+            self._host_stats(urlsplit(url).hostname or "")
+
+    def knows_host(self, url: str) -> bool:
+        with self._lock:
+            return (urlsplit(url).hostname or "") in self._hosts
+
+    def _host_stats(self, host: str) -> _HostStats:
+        stats = self._hosts.get(host)
+        if stats is None:
+            stats = self._hosts[host] = _HostStats()
+            if self.seed is not None:
+                for url, markdown in self.seed(host, self.seed_pages):
+                    self._add(stats, url, markdown)
+        return stats
+
+    @staticmethod
+    def _add(stats: _HostStats, url: str, markdown: str) -> None:
+        url = normalize_url(url)
+        if url in stats.pages:
+            return
+        stats.pages.add(url)
+        content = block_hash(markdown)
+        if content not in stats.contents:
+            stats.contents.add(content)
+            stats.counts.update({block_hash(block) for block in split_blocks(markdown)})
+
+    def strip(self, url: str, markdown: str, keep: Callable[[str], bool] | None = None) -> str:
+        """
+        Learns from `markdown` and returns it without the boilerplate
+        blocks of its host. Blocks for which `keep` returns True are never
+        removed (e.g. a navigation link to the learning platform that is on
+        every page is evidence, not noise).
+        """
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            stats = self._host_stats(host)
+            self._add(stats, url, markdown)
+            threshold = max(self.min_pages, self.min_fraction * len(stats.contents))
+            boilerplate = {h for h, n in stats.counts.items() if n >= threshold}
+
+        kept: list[str] = []
+        removed: list[str] = []
+        for block in split_blocks(markdown):
+            if block_hash(block) in boilerplate and not (keep and keep(block)):
+                removed.append(block)
+            else:
+                kept.append(block)
+        if removed:
+            removed_text = "\n\n".join(removed)
+            metrics.increment("boilerplate", "pages_stripped")
+            metrics.increment("boilerplate", "blocks_removed", len(removed))
+            metrics.increment("boilerplate", "bytes_saved", len(removed_text.encode("utf-8")))
+            metrics.increment("boilerplate", "tokens_saved", estimate_tokens(removed_text))
+            log.debug(f"Removed {len(removed)} boilerplate blocks from {url}")
+            return "\n\n".join(kept)
+        return markdown
+
+
+def _seed_from_store(host: str, limit: int) -> Iterable[tuple[str, str]]:
+    store = content_store.get_store()
+    if store is None:
+        return []
+    return store.pages_for_host(host, limit)
+
+
+# Settings of the filter used by `classify_page`, see `configure`
+_settings = {"enabled": True}
+_filter = BoilerplateFilter(seed=_seed_from_store)
+
+
+def configure(enabled: bool | None = None, **options) -> None:
+    """
+    Turns boilerplate removal on or off, or changes the `BoilerplateFilter`
+    options (min_pages, min_fraction, seed_pages). Changing options
+    forgets what was learned so far.
+    """
+    global _filter  # pylint: disable=global-statement
+    if enabled is not None:
+        _settings["enabled"] = enabled
+    if options:
+        _filter = BoilerplateFilter(seed=_seed_from_store, **options)
+
+
+async def prepare_host(url: str) -> None:
+    """
+    Reads the seed pages of the host of `url` from the content store in a
+    thread, so that `strip_boilerplate` does not block the event loop
+    with SQLite reads and decompression.
+    """
+    if _settings["enabled"] and not _filter.knows_host(url):
+        await asyncio.to_thread(_filter.seed_host, url)
+
+
+def strip_boilerplate(url: str, markdown: str, keep: Callable[[str], bool] | None = None) -> str:
+    """
+    `BoilerplateFilter.strip` with the filter of this run, if it is turned on.
+    """
+    if not _settings["enabled"]:
+        return markdown
+    return _filter.strip(url, markdown, keep)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from pydantic import BaseModel
+
+from cache_backends import _ttl_seconds
+
+log = logging.getLogger(__name__)
+
+
+class Page(BaseModel):
+    """
+    The text content of a fetched URL, as markdown.
+    """
+    url: str
+    markdown: str
+    is_pdf: bool = False
+    fetched_at: float | None = None
+    status_code: int | None = None
+    headers: dict[str, str] = {}
+
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    """
+    The key of a URL in the store: scheme and host in lower case, without
+    default port, fragment and `utm_*` parameters, and with the query
+    parameters sorted.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port is not None and parts.port != _DEFAULT_PORTS.get(scheme):
+        netloc += f":{parts.port}"
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_")))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def content_hash(markdown: str) -> str:
+    return hashlib.blake2b(markdown.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ContentStore:
+    """
+    Local store of fetched pages, so that evaluating them again (e.g. with
+    a new prompt or model) does not need the network.
+
+    The text is stored once per distinct content (content-addressed,
+    zlib-compressed), and each normalized URL points to its content,
+    together with the fetch time, status code and response headers.
+    Pages older than `max_age` (seconds or `timedelta`) are ignored.
+    """
+
+    def __init__(self, filename: str, max_age=None):
+        self.filename = filename
+        self.max_age = _ttl_seconds(max_age)
+        # sqlite3 connections must not be shared between threads
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS content ("
+                    " hash TEXT PRIMARY KEY,"
+                    " data BLOB NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS pages ("
+                    " url TEXT PRIMARY KEY,"
+                    " hash TEXT NOT NULL,"
+                    " original_url TEXT NOT NULL,"
+                    " is_pdf INTEGER NOT NULL,"
+                    " fetched_at REAL NOT NULL,"
+                    " status_code INTEGER,"
+                    " headers TEXT NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS pages_hash ON pages (hash)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, url: str) -> Page | None:
+        row = self._conn().execute(
+            "SELECT content.data, pages.is_pdf, pages.fetched_at, pages.status_code, pages.headers"
+            " FROM pages JOIN content ON content.hash = pages.hash WHERE pages.url = ?",
+            (normalize_url(url),)).fetchone()
+        if row is None:
+            return None
+        data, is_pdf, fetched_at, status_code, headers = row
+        if self.max_age is not None and fetched_at < time.time() - self.max_age:
+            return None
+        return Page(url=url, markdown=zlib.decompress(data).decode("utf-8"), is_pdf=bool(is_pdf),
+                    fetched_at=fetched_at, status_code=status_code, headers=json.loads(headers))
+
+    def put(self, page: Page) -> None:
+        digest = content_hash(page.markdown)
+        key = normalize_url(page.url)
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            old = conn.execute("SELECT hash FROM pages WHERE url = ?", (key,)).fetchone()
+            conn.execute("INSERT OR IGNORE INTO content (hash, data) VALUES (?, ?)",
+                         (digest, zlib.compress(page.markdown.encode("utf-8"))))
+            conn.execute(
+                "INSERT OR REPLACE INTO pages"
+                " (url, hash, original_url, is_pdf, fetched_at, status_code, headers)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, digest, page.url, int(page.is_pdf), page.fetched_at or time.time(),
+                 page.status_code, json.dumps(page.headers)))
+            if old is not None and old[0] != digest:
+                # the old content, unless another URL has it too
+                conn.execute("DELETE FROM content WHERE hash = ?"
+                             " AND NOT EXISTS (SELECT 1 FROM pages WHERE hash = ?)",
+                             (old[0], old[0]))
+
+    def pages_for_host(self, host: str, limit: int) -> list[tuple[str, str]]:
+        """
+        URL and markdown of the most recently fetched pages of `host`.
+        """
+        host = host.lower()
+        rows = self._conn().execute(
+            "SELECT pages.original_url, content.data"
+            " FROM pages JOIN content ON content.hash = pages.hash"
+            " WHERE pages.url BETWEEN ? AND ? OR pages.url BETWEEN ? AND ?"
+            " ORDER BY pages.fetched_at DESC LIMIT ?",
+            (f"http://{host}/", f"http://{host}/\uffff",
+             f"https://{host}/", f"https://{host}/\uffff", limit)).fetchall()
+        return [(url, zlib.decompress(data).decode("utf-8")) for url, data in rows]
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# Settings of the store used by `fetch_page`, see `configure`
+_settings: dict = {"filename": "page_content.sqlite", "max_age": None, "enabled": True, "refresh": False}
+_store: ContentStore | None = None
+_store_lock = threading.Lock()
+
+
+def configure(**options) -> None:
+    """
+    Sets the options (filename, max_age, enabled, refresh) of the store
+    used by `fetch_page`. With `refresh=True`, pages are fetched again,
+    and the store is updated.
+    """
+    global _store  # pylint: disable=global-statement
+    with _store_lock:
+        _settings.update(options)
+        _store = None
+
+
+def get_store() -> ContentStore | None:
+    """
+    The store used by `fetch_page`, or None if it is turned off.
+    """
+    global _store  # pylint: disable=global-statement
+    with _store_lock:
+        if not _settings["enabled"]:
+            return None
+        if _store is None:
+            _store = ContentStore(_settings["filename"], _settings["max_age"])
+        return _store
+
+
+def lookup(url: str) -> Page | None:
+    """
+    The stored page for `url`, unless the store is off or in refresh mode.
+    """
+    store = get_store()
+    if store is None or _settings["refresh"]:
+        return None
+    return store.get(url)
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# The process pool of the current run, see `convert_pool`
+_executor: ProcessPoolExecutor | None = None
+
+
+@contextmanager
+def convert_pool(workers: int, max_tasks_per_child: int = 200) -> Iterator[ProcessPoolExecutor | None]:
+    """
+    Opens a pool of `workers` processes for the duration of a run, used by
+    `run_cpu_bound` to convert pages (HTML cleaning, markdown generation,
+    PDF text) without blocking the event loop or holding the GIL.
+    With `workers=0`, the conversion runs in a thread instead.
+
+    Workers are replaced after `max_tasks_per_child` pages, so that memory
+    kept by the parsers does not add up.
+    """
+    global _executor  # pylint: disable=global-statement
+    if workers <= 0:
+        yield None
+        return
+    # "spawn", since forking a process with running threads (event loop,
+    # sqlite, HTTP client) is not safe
+    executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                   max_tasks_per_child=max_tasks_per_child)
+    log.info(f"Started {workers} conversion processes")
+    _executor = executor
+    try:
+        yield executor
+    finally:
+        _executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_cpu_bound(func: Callable[..., T], *args) -> T:
+    """
+    Runs `func(*args)` in the process pool of the run, or in a thread if
+    there is none. `func` must be a module-level function, and its
+    arguments and result are pickled, so it should return only what is
+    needed (e.g. the markdown, not the parsed document).
+    """
+    if _executor is None:
+        return await asyncio.to_thread(func, *args)
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable
+
+import psutil
+from crawl4ai import AsyncWebCrawler
+from crawl4ai.processors.pdf import PDFCrawlerStrategy
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class PoolConfig:
+    """
+    `size` browsers are kept open for web pages, i.e. at most `size`
+    pages are loaded at once. A browser is restarted after `max_pages`
+    pages, or when the memory of its own processes (the Playwright driver
+    and the browser it runs) has grown by more than `max_memory_mb` since
+    it was started. The limit applies to each browser separately.
+    PDFs are loaded by `pdf_size` separate crawlers, which need no browser.
+    """
+    size: int = 4
+    pdf_size: int = 2
+    max_pages: int | None = 50
+    max_memory_mb: float | None = 2048
+
+
+def memory_usage_mb(processes: list[psutil.Process]) -> float:
+    """
+    Resident memory of `processes` and all their children, in MB.
+    """
+    total = 0
+    for process in processes:
+        try:
+            tree = [process, *process.children(recursive=True)]
+        except psutil.Error:
+            # exited in the meantime
+            continue
+        for member in tree:
+            try:
+                total += member.memory_info().rss
+            except psutil.Error:
+                pass
+    return total / (1024 * 1024)
+
+
+def _child_pids() -> set[int]:
+    return {child.pid for child in psutil.Process().children()}
+
+
+class _Slot:
+    def __init__(self, pool: "CrawlerPool", number: int):
+        self.pool = pool
+        self.number = number
+        self.crawler: AsyncWebCrawler | None = None
+        self.pages = 0
+        # the processes started by this slot's crawler, see `start`
+        self.processes: list[psutil.Process] = []
+        self.memory_at_start = 0.0
+
+    def recycle_reason(self) -> str | None:
+        if self.crawler is None:
+            return None
+        if self.pool.max_pages is not None and self.pages >= self.pool.max_pages:
+            return "pages"
+        if (self.pool.max_memory_mb is not None
+                and memory_usage_mb(self.processes) - self.memory_at_start > self.pool.max_memory_mb):
+            return "memory"
+        return None
+
+    async def start(self) -> AsyncWebCrawler:
+        # Each crawler starts its own Playwright driver, which runs the
+        # browser. Crawlers of a pool are started one at a time, so the
+        # new child processes of this process belong to this one.
+        async with self.pool.start_lock:
+            before = _child_pids()
+            self.crawler = self.pool.crawler_factory()
+            await self.crawler.start()
+            self.processes = [psutil.Process(pid) for pid in _child_pids() - before]
+        self.pages = 0
+        self.memory_at_start = memory_usage_mb(self.processes)
+        metrics.increment(f"crawler_pool:{self.pool.name}", "started")
+        return self.crawler
+
+    async def close(self) -> None:
+        crawler, self.crawler = self.crawler, None
+        self.processes = []
+        if crawler is not None:
+            try:
+                await crawler.close()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception(f"Could not close crawler {self.pool.name}#{self.number}")
+
+
+class CrawlerPool:
+    """
+    A fixed number of long-lived `AsyncWebCrawler`s. Each one is used for
+    one page at a time, callers wait if all are busy. Crawlers are started
+    on first use and restarted after `max_pages` pages or when the memory
+    of their browser grew by more than `max_memory_mb` (see `PoolConfig`).
+    """
+
+    def __init__(self, name: str, size: int, crawler_factory: Callable[[], AsyncWebCrawler],
+                 max_pages: int | None = None, max_memory_mb: float | None = None):
+        self.name = name
+        self.crawler_factory = crawler_factory
+        self.max_pages = max_pages
+        self.max_memory_mb = max_memory_mb
+        self.start_lock = asyncio.Lock()
+        self._slots = [_Slot(self, number) for number in range(size)]
+        self._idle: asyncio.Queue[_Slot] = asyncio.Queue()
+        for slot in self._slots:
+            self._idle.put_nowait(slot)
+
+    @asynccontextmanager
+    async def crawler(self) -> AsyncIterator[AsyncWebCrawler]:
+        slot = await self._idle.get()
+        try:
+            reason = slot.recycle_reason()
+            if reason is not None:
+                log.info(f"Restarting crawler {self.name}#{slot.number} "
+                         f"after {slot.pages} pages ({reason})")
+                metrics.increment(f"crawler_pool:{self.name}", f"recycled_{reason}")
+                await slot.close()
+            crawler = slot.crawler or await slot.start()
+            try:
+                yield crawler
+            finally:
+                slot.pages += 1
+        finally:
+            self._idle.put_nowait(slot)
+
+    async def close(self) -> None:
+        for slot in self._slots:
+            await slot.close()
+
+
+# The pools of the current run, see `crawler_pools`
+_pools: dict[str, CrawlerPool] = {}
+
+
+@asynccontextmanager
+async def crawler_pools(config: PoolConfig | None = None) -> AsyncIterator[dict[str, CrawlerPool]]:
+    """
+    Opens the crawler pools used by `get_crawler` for the duration of a run,
+    and closes all browsers at the end.
+    """
+    config = config or PoolConfig()
+    pools = {
+        "html": CrawlerPool("html", config.size, AsyncWebCrawler,
+                            max_pages=config.max_pages, max_memory_mb=config.max_memory_mb),
+        "pdf": CrawlerPool("pdf", config.pdf_size,
+                           lambda: AsyncWebCrawler(crawler_strategy=PDFCrawlerStrategy())),  # type: ignore
+    }
+    _pools.update(pools)
+    try:
+        yield pools
+    finally:
+        _pools.clear()
+        for pool in pools.values():
+            await pool.close()
+
+
+@asynccontextmanager
+async def get_crawler(pdf: bool = False) -> AsyncIterator[AsyncWebCrawler]:
+    """
+    Returns a crawler from the pool of the current run. Without
+    `crawler_pools`, a new crawler is started (and closed) for the call.
+    """
+    pool = _pools.get("pdf" if pdf else "html")
+    if pool is not None:
+        async with pool.crawler() as crawler:
+            yield crawler
+    else:
+        crawler_strategy = PDFCrawlerStrategy() if pdf else None
+        async with AsyncWebCrawler(crawler_strategy=crawler_strategy) as crawler:  # type: ignore
+            yield crawler
@@ -0,0 +1,147 @@
+import logging
+import re
+import time
+
+import httpx
+from crawl4ai import CrawlerRunConfig, DefaultMarkdownGenerator
+from crawl4ai.async_logger import AsyncLogger
+from crawl4ai.utils import sanitize_input_encode
+
+from crawler import pdf_text
+from crawler.content_store import Page
+from crawler.convert_pool import run_cpu_bound
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+USER_AGENT = ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+              "(KHTML, like Gecko) Chrome/124.0 Safari/537.36")
+
+# Settings of the fast path, see `configure`
+_settings = {"enabled": True, "min_words": 50, "timeout": 20.0, "max_connections": 20}
+_client: httpx.AsyncClient | None = None
+
+# Signs of pages that only show their content after running JavaScript
+_JS_MARKERS = re.compile(
+    r"<noscript[^>]*>[^<]*(enable|aktivieren)[^<]*javascript"
+    r"|<div id=\"(root|app|__next)\"></div>",
+    re.IGNORECASE)
+
+
+def configure(**options) -> None:
+    """
+    Sets the options (enabled, min_words, timeout, max_connections) of
+    the HTTP fast path of `fetch_page`.
+    """
+    _settings.update(options)
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client  # pylint: disable=global-statement
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers={"User-Agent": USER_AGENT},
+            follow_redirects=True,
+            timeout=_settings["timeout"],
+            limits=httpx.Limits(max_connections=_settings["max_connections"]),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client  # pylint: disable=global-statement
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def enabled() -> bool:
+    return _settings["enabled"]
+
+
+def html_to_markdown(url: str, html: str) -> str:
+    """
+    The same conversion `AsyncWebCrawler` does after loading a page:
+    the default scraping strategy, then the default markdown generator.
+    """
+    config = CrawlerRunConfig()
+    scraping_strategy = config.scraping_strategy
+    if not scraping_strategy.logger:
+        scraping_strategy.logger = AsyncLogger(verbose=False)
+    params = {k: v for k, v in config.__dict__.items() if k != "url"}
+    result = scraping_strategy.scrap(url, html, **params)
+    cleaned_html = sanitize_input_encode(result.cleaned_html)
+    return DefaultMarkdownGenerator().generate_markdown(
+        input_html=cleaned_html, base_url=url).raw_markdown
+
+
+def convert_html(url: str, data: bytes, encoding: str) -> str | None:
+    """
+    Decodes and converts a page in the conversion processes (see
+    `crawler.convert_pool`). Returns None if the page needs JavaScript.
+    """
+    html = data.decode(encoding, errors="replace")
+    if _JS_MARKERS.search(html):
+        return None
+    return html_to_markdown(url, html)
+
+
+async def fetch(url: str) -> tuple[Page | None, str]:
+    """
+    Loads `url` with a plain HTTP request. HTML is converted to markdown,
+    PDFs (by content type or magic bytes) to text, see `crawler.pdf_text`.
+    Returns the page and "ok", or None and the reason why the browser is
+    needed (not HTML, an error status, signs of JavaScript rendering, or
+    too little text). A PDF that is too large or cannot be read gives an
+    empty page, since the browser would not do better.
+    """
+    limit = pdf_text.max_bytes()
+    try:
+        async with _get_client().stream("GET", url) as response:
+            if response.status_code >= 400:
+                return None, f"status_{response.status_code}"
+            content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+            headers = dict(response.headers)
+            final_url = str(response.url)
+            length = response.headers.get("content-length", "")
+            too_large = length.isdigit() and int(length) > limit
+            data = bytearray()
+            async for part in response.aiter_bytes():
+                data += part
+                # if it is too large, only the start is read, to recognize PDFs
+                if too_large or len(data) > limit:
+                    too_large = True
+                    break
+    except httpx.HTTPError as e:
+        log.info(f"HTTP fetch of {url} failed: {e!r}")
+        return None, "http_error"
+
+    page = Page(url=url, markdown="", fetched_at=time.time(),
+                status_code=response.status_code, headers=headers)
+    if pdf_text.is_pdf(content_type, bytes(data[:1024])):
+        page.is_pdf = True
+        if too_large:
+            log.warning(f"Not reading {url}, the PDF is larger than {limit} bytes")
+            metrics.increment("pdf", "too_large")
+            return page, "pdf_too_large"
+        try:
+            result = await run_cpu_bound(pdf_text.extract_text, bytes(data),
+                                         pdf_text.token_budget(), pdf_text.max_pages())
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            log.warning(f"Could not read the PDF {url}: {e!r}")
+            metrics.increment("pdf", "error")
+            return page, "pdf_error"
+        pdf_text.record_metrics(result)
+        page.markdown = result.text
+        return page, "ok"
+
+    if content_type not in ("text/html", "application/xhtml+xml", ""):
+        return None, "not_html"
+    # a truncated HTML page is still parsed, and has enough text
+    markdown = await run_cpu_bound(convert_html, final_url, bytes(data), response.encoding or "utf-8")
+    if markdown is None:
+        return None, "javascript"
+    if len(markdown.split()) < _settings["min_words"]:
+        return None, "too_little_text"
+    page.markdown = markdown
+    return page, "ok"
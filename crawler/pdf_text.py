@@ -0,0 +1,101 @@
+import io
+import logging
+from typing import NamedTuple
+
+import pdfplumber
+
+from crawler import ranking
+from crawler.boilerplate import estimate_tokens
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Settings of the PDF extraction, see `configure`
+_settings = {
+    # larger PDFs are not downloaded
+    "max_bytes": 30 * 1024 * 1024,
+    # pages after this are not read
+    "max_pages": 60,
+    # the text of a PDF is read until it fills this many times the chunks
+    # sent to the LLM, so that the ranking still has a choice
+    "budget_factor": 3,
+}
+
+
+def configure(**options) -> None:
+    """
+    Sets the options (max_bytes, max_pages, budget_factor) of the PDF
+    extraction.
+    """
+    _settings.update(options)
+
+
+def max_bytes() -> int:
+    return _settings["max_bytes"]
+
+
+def max_pages() -> int:
+    return _settings["max_pages"]
+
+
+def token_budget() -> int:
+    """
+    The number of tokens read from a PDF, see the `budget_factor` option.
+    """
+    return ranking.max_chunks() * ranking.CHUNK_TOKENS * _settings["budget_factor"]
+
+
+def is_pdf(content_type: str, data: bytes) -> bool:
+    """
+    Whether a response is a PDF, by its content type or its first bytes
+    (many servers send PDFs as application/octet-stream).
+    """
+    return content_type == "application/pdf" or data[:1024].lstrip().startswith(b"%PDF-")
+
+
+class PdfText(NamedTuple):
+    text: str
+    pages_read: int
+    page_count: int
+    # "page_limit" or "budget_reached" if reading stopped early
+    stopped: str | None
+
+
+def extract_text(data: bytes, token_budget: int | None = None, max_pages: int | None = None) -> PdfText:
+    """
+    The text of the PDF `data`, page by page. Stops after `max_pages`
+    pages, or once the text has about `token_budget` tokens, so that
+    only the start of a long PDF (e.g. a Modulhandbuch) is parsed.
+    Runs in the conversion processes (see `crawler.convert_pool`), so the
+    metrics are recorded by the caller, with `record_metrics`.
+    """
+    if max_pages is None:
+        max_pages = _settings["max_pages"]
+    texts: list[str] = []
+    tokens = 0
+    stopped = None
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        page_count = len(pdf.pages)
+        for number, page in enumerate(pdf.pages):
+            if number >= max_pages:
+                log.info(f"Stopping after {max_pages} of {page_count} PDF pages")
+                stopped = "page_limit"
+                break
+            text = page.extract_text() or ""
+            # frees the parsed layout of the page
+            page.close()
+            texts.append(text.strip())
+            tokens += estimate_tokens(text)
+            if token_budget is not None and tokens >= token_budget:
+                if number + 1 < page_count:
+                    log.info(f"Stopping after {number + 1} of {page_count} PDF pages, chunk budget is full")
+                    stopped = "budget_reached"
+                break
+    return PdfText("\n\n".join(text for text in texts if text), len(texts), page_count, stopped)
+
+
+def record_metrics(result: PdfText) -> None:
+    metrics.increment("pdf", "pages_read", result.pages_read)
+    metrics.increment("pdf", "pages_skipped", result.page_count - result.pages_read)
+    if result.stopped:
+        metrics.increment("pdf", result.stopped)
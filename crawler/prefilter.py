@@ -0,0 +1,86 @@
+import logging
+import re
+import unicodedata
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Other spellings of the software names, in addition to the name itself.
+# Matching ignores case, umlauts (ä = ae) and punctuation (Stud.IP = Stud IP).
+ALIASES: dict[str, list[str]] = {
+    "Moodle": [],
+    "Ilias": [],
+    "OpenOLAT": ["OLAT", "Open OLAT"],
+    "Stud.IP": ["StudIP"],
+    "Canvas": [],
+}
+
+_UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+# Settings of `prefilter`, see `configure`
+_settings = {"enabled": True}
+
+
+def configure(aliases: dict[str, list[str]] | None = None, enabled: bool | None = None) -> None:
+    """
+    Adds aliases, e.g. `{"Ilias": ["ILIAS 8"]}`, or turns the prefilter
+    on or off.
+    """
+    for software, names in (aliases or {}).items():
+        ALIASES.setdefault(software, []).extend(names)
+    if enabled is not None:
+        _settings["enabled"] = enabled
+
+
+def settings_for(software: list[str]) -> dict:
+    """
+    The settings that decide the prefilter verdicts for `software`:
+    whether the prefilter is on, and the aliases of each product.
+    """
+    return {
+        "enabled": _settings["enabled"],
+        "aliases": {name: sorted(ALIASES.get(name, [])) for name in software},
+    }
+
+
+def normalize(text: str) -> str:
+    """
+    Lower case, umlauts written out, and everything except letters and
+    digits replaced by single spaces.
+    """
+    text = unicodedata.normalize("NFC", text).casefold().translate(_UMLAUTS)
+    # remaining accents, e.g. é -> e
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " " + " ".join(re.findall(r"[^\W_]+", text)) + " "
+
+
+def mentions(text: str, software: str) -> bool:
+    """
+    Whether `text` mentions `software` or one of its aliases, at the
+    start of a word (so "Moodle-basiert" and "Moodlekurs" match, but
+    "Chocolate" does not match "OLAT").
+    """
+    normalized = normalize(text)
+    for name in [software, *ALIASES.get(software, [])]:
+        if " " + normalize(name).strip() in normalized:
+            return True
+    return False
+
+
+def prefilter(text: str, software: str) -> bool:
+    """
+    Like `mentions`, and counts the result in the `prefilter` metrics.
+    Always True if the prefilter is turned off.
+    """
+    if not _settings["enabled"]:
+        return True
+    matched = mentions(text, software)
+    metrics.increment("prefilter", "checked")
+    metrics.increment("prefilter", "matched" if matched else "rejected")
+    if not matched:
+        log.info(f"Prefilter: {software} is not mentioned, skipping the LLM")
+    counters = metrics.counters["prefilter"]
+    metrics.set("prefilter", "hit_rate", counters["matched"] / counters["checked"])
+    return matched
@@ -0,0 +1,97 @@
+import math
+from collections import Counter
+
+from crawler.prefilter import ALIASES, normalize
+
+# Words that indicate that a chunk is about the use of a learning
+# platform, in addition to the software names. See `configure`.
+CRITERION_TERMS: list[str] = [
+    "Lernplattform",
+    "Lernmanagementsystem",
+    "E-Learning",
+    "LMS",
+    "Kursraum",
+    "Login",
+]
+
+# Size of a chunk (`chunk_token_threshold` of the extraction strategy)
+CHUNK_TOKENS = 1000
+
+# Settings of the chunk selection, see `configure`
+_settings = {"max_chunks": 5}
+
+
+def configure(max_chunks: int | None = None, terms: list[str] | None = None) -> None:
+    """
+    Sets the number of chunks sent to the LLM per page, and/or replaces
+    `CRITERION_TERMS`.
+    """
+    if max_chunks is not None:
+        _settings["max_chunks"] = max_chunks
+    if terms is not None:
+        CRITERION_TERMS[:] = terms
+
+
+def max_chunks() -> int:
+    return _settings["max_chunks"]
+
+
+def query_terms(software: list[str]) -> list[str]:
+    """
+    The terms chunks are ranked by: the software names, their aliases,
+    and `CRITERION_TERMS`.
+    """
+    terms = []
+    for name in software:
+        terms += [name, *ALIASES.get(name, [])]
+    return terms + CRITERION_TERMS
+
+
+def tokenize(text: str) -> list[str]:
+    return normalize(text).split()
+
+
+def bm25_scores(documents: list[str], terms: list[str], k1: float = 1.5, b: float = 0.75) -> list[float]:
+    """
+    Okapi BM25 score of each document for the query `terms`.
+    Like the prefilter, a query word matches words that start with it
+    ("moodle" matches "moodlekurs"). Multi-word terms count as their words.
+    """
+    words = list(dict.fromkeys(word for term in terms for word in tokenize(term)))
+    if not documents or not words:
+        return [0.0] * len(documents)
+
+    counts = []
+    for document in documents:
+        tokens = Counter(tokenize(document))
+        length = sum(tokens.values())
+        frequencies = {word: sum(n for token, n in tokens.items() if token.startswith(word))
+                       for word in words}
+        counts.append((length, frequencies))
+
+    average_length = sum(length for length, _ in counts) / len(counts) or 1
+    n = len(documents)
+    idf = {}
+    for word in words:
+        containing = sum(1 for _, frequencies in counts if frequencies[word])
+        idf[word] = math.log(1 + (n - containing + 0.5) / (containing + 0.5))
+
+    scores = []
+    for length, frequencies in counts:
+        score = 0.0
+        for word in words:
+            tf = frequencies[word]
+            if tf:
+                score += idf[word] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+        scores.append(score)
+    return scores
+
+
+def top_chunks(chunks: list[str], terms: list[str], k: int) -> list[int]:
+    """
+    Indices of the `k` chunks with the highest BM25 score for `terms`,
+    best first. Chunks with the same score keep their order.
+    """
+    scores = bm25_scores(chunks, terms)
+    ranked = sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+    return ranked[:k]
@@ -1,16 +1,26 @@
+import asyncio
 import json
 import logging
+import threading
+import time
+from datetime import timedelta
 from typing import TYPE_CHECKING, Literal
 
 import dotenv
-from crawl4ai import (AsyncWebCrawler, CacheMode, CrawlerRunConfig,
-                      CrawlResult, LLMConfig)
-from crawl4ai.processors.pdf import (PDFContentScrapingStrategy,
-                                     PDFCrawlerStrategy)
+from crawl4ai import CacheMode, CrawlerRunConfig, CrawlResult, LLMConfig
+from crawl4ai.chunking_strategy import RegexChunking
+from crawl4ai.processors.pdf import PDFContentScrapingStrategy
 from pydantic import BaseModel, TypeAdapter
 
 from cache_results import cache_results
-from crawl4ai_helpers import ChunkLimitedLLMExtractionStrategy
+from crawl4ai_helpers import (ChunkLimitedLLMExtractionStrategy, any_positive,
+                              chunk_cache)
+from crawler import content_store, http_fetch, ranking
+from crawler.boilerplate import prepare_host, strip_boilerplate
+from crawler.content_store import Page
+from crawler.crawler_pool import get_crawler
+from crawler.prefilter import mentions, prefilter, settings_for
+from metrics import metrics
 from record_results import record_results
 
 log = logging.getLogger(__name__)
@@ -21,30 +31,130 @@ class LMSResult(BaseModel):
     software_usage_found: bool
     error: Literal[False] = False
 
+class SoftwareVerdict(LMSResult):
+    """
+    The verdict for one of several software products, see `classify_page_multi`.
+    """
+    software: str
+
 class ErrorBlock(BaseModel):
     index: int
     error: Literal[True] = True
     tags: list[str]
     content: str
 
-@record_results
-@cache_results
-# async def scrape_url(url: str, software: str = "Moodle", einrichtung: str = "HfM Würzburg", skip_cache=False) -> LMSResult:
-async def scrape_url(url: str, prompt_template: str, arguments: dict, skip_cache=False) -> LMSResult:
 
-    log.info(f"Scraping URL: {url} for {arguments}")
-    is_pdf = False
-    if "dumpFile" in url or url.endswith(".pdf"):
-        # hack hack hack
-        is_pdf = True
+# Start of the reasoning of verdicts that were made without the LLM
+NO_CONTENT = "(No content extracted)"
+PREFILTER = "(Prefilter)"
+
+
+def is_llm_verdict(result: LMSResult) -> bool:
+    """
+    Whether `result` is a verdict of the LLM. The others depend on the
+    prefilter settings (see `--alias`, `--no-prefilter`), or on a fetch that
+    failed, and are not cached by `scrape_url`, so that they are made again
+    next time. (`scrape_url_multi` has the prefilter settings in its key.)
+    """
+    return not result.reasoning.startswith((NO_CONTENT, PREFILTER))
+
+
+def is_pdf_url(url: str) -> bool:
+    # hack hack hack
+    # (only used for the browser, which does not see the content type)
+    return "dumpFile" in url or url.endswith(".pdf")
+
+
+async def fetch_page(url: str) -> Page:
+    """
+    Loads `url` and returns its content as markdown, without running the
+    LLM. Pages are first loaded with a plain HTTP request (see
+    `crawler.http_fetch`), which also recognizes and reads PDFs; the
+    browser is only started if that does not give usable content.
+    Pages are kept in the content store (see `crawler.content_store`),
+    and only fetched if they are not there yet.
+    """
+    page = content_store.lookup(url)
+    if page is not None:
+        metrics.increment("content_store", "hit")
+        return page
+    metrics.increment("content_store", "miss")
+
+    page = None
+    if http_fetch.enabled():
+        start = time.perf_counter()
+        page, reason = await http_fetch.fetch(url)
+        metrics.record_call("fetch:http", time.perf_counter() - start,
+                            reason if page is not None else "fallback")
+        if page is None:
+            log.info(f"Loading {url} with the browser ({reason})")
+            metrics.increment("fetch_fallback", reason)
+        elif reason != "ok":
+            # an unreadable PDF, not stored
+            return page
+    if page is None:
+        start = time.perf_counter()
+        page, success = await fetch_with_browser(url, is_pdf_url(url))
+        metrics.record_call("fetch:browser", time.perf_counter() - start,
+                            "ok" if success else "failed")
+        if not success:
+            # not stored, so that it is tried again next time
+            return page
+
+    store = content_store.get_store()
+    if store is not None:
+        store.put(page)
+    return page
+
+
+async def fetch_with_browser(url: str, is_pdf: bool) -> tuple[Page, bool]:
+    """
+    Loads `url` with the browser (or the PDF strategy). Returns the page
+    and whether loading it succeeded.
+    """
+    # 2. Build the crawler config
+    scraping_strategy = PDFContentScrapingStrategy() if is_pdf else None
+    crawl_config = CrawlerRunConfig(
+        scraping_strategy=scraping_strategy,  # type: ignore
+        # pages are stored in our own content store instead
+        cache_mode=CacheMode.BYPASS,
+        verbose=True,
+        log_console=True,
+    )
+
+    # Create a browser config if needed
+    # browser_cfg = BrowserConfig(headless=True)
+
+    # a long-lived crawler, if the run opened `crawler_pools`
+    async with get_crawler(pdf=is_pdf) as crawler:
+        # cast(AsyncLogger, crawler.logger).console.file = sys.stderr
+        log.info("Scraping URL: %s", url)
+        result = await crawler.arun(
+            url=url,
+            config=crawl_config
+        )
+        log.info("URL scraped: %s", url)
+        if TYPE_CHECKING:
+            assert isinstance(result, CrawlResult)
+
+    # `result.markdown` is a str subclass with the raw markdown
+    page = Page(url=url, markdown=str(result.markdown or ""), is_pdf=is_pdf,
+                fetched_at=time.time(), status_code=result.status_code,
+                headers={k: str(v) for k, v in (result.response_headers or {}).items()})
+    if not result.success:
+        log.warning("Could not load %s: %s", url, result.error_message)
+    return page, bool(result.success)
+
 
+def make_llm_strategy(prompt: str, schema: type[BaseModel] = LMSResult,
+                      stop_when=any_positive,
+                      ranking_terms: list[str] | None = None,
+                      stop_event: threading.Event | None = None) -> ChunkLimitedLLMExtractionStrategy:
     api_key = dotenv.get_key(".env", "LLM_API_KEY")
     #base_url = "https://chat-ai.academiccloud.de/v1"
     base_url = dotenv.get_key(".env", "LLM_BASE_URL")
     provider = dotenv.get_key(".env", "LLM_PROVIDER")
 
-    prompt = prompt_template.format(**arguments)
-
     if provider == "openai/llama-3.3-70b-instruct":
         extra_args = {
             "temperature": 0.0,
@@ -55,98 +165,209 @@ async def scrape_url(url: str, prompt_template: str, arguments: dict, skip_cache
             "temperature": 1,
             # "max_completion_tokens": 800,
         }
-    llm_strategy = ChunkLimitedLLMExtractionStrategy(
+    return ChunkLimitedLLMExtractionStrategy(
         llm_config=LLMConfig(provider=provider, base_url=base_url, api_token=api_key),
-        schema=LMSResult.model_json_schema(),
+        schema=schema.model_json_schema(),
         verbose=True,
         extraction_type="schema",
         instruction=prompt,
-        chunk_token_threshold=1000,
+        chunk_token_threshold=ranking.CHUNK_TOKENS,
         overlap_rate=0.05,
         apply_chunking=True,
         input_format="markdown",   # or "html", "fit_markdown"
         extra_args=extra_args,
+        stop_when=stop_when,
+        max_chunks=ranking.max_chunks(),
+        ranking_terms=ranking_terms,
+        cache=chunk_cache(),
+        stop_event=stop_event,
     )
 
-    # 2. Build the crawler config
-    scraping_strategy = PDFContentScrapingStrategy() if is_pdf else None
-    crawl_config = CrawlerRunConfig(
-        scraping_strategy=scraping_strategy,  # type: ignore
-        extraction_strategy=llm_strategy,
-        cache_mode=CacheMode.DISABLED if is_pdf else CacheMode.WRITE_ONLY,
-        verbose=True,
-        log_console=True,
-    )
 
-    # Create a browser config if needed
-    # browser_cfg = BrowserConfig(headless=True)
+async def classify_page(page: Page, prompt_template: str, arguments: dict) -> LMSResult:
+    """
+    Asks the LLM whether the content of `page` answers the prompt.
+    The markdown is chunked like crawl4ai does it, and the verdicts of
+    the chunks are combined: any positive chunk makes the page positive.
+    Blocks that are on most pages of the host are removed first, see
+    `without_boilerplate`. Pages that do not mention `arguments["software"]`
+    at all are negative without asking the LLM, see `prefilter`.
+    """
+    if not page.markdown:
+        log.warning("⚠️ No content extracted")
+        return LMSResult(reasoning=NO_CONTENT, software_usage_found=False)
+
+    software = arguments.get("software")
+    page = await without_boilerplate(page, [software] if software else [])
+    if software and not prefilter(page.markdown, software):
+        return LMSResult(reasoning=f"{PREFILTER} {software} is not mentioned on the page",
+                         software_usage_found=False)
+
+    prompt = prompt_template.format(**arguments)
+    data = await extract_blocks(page, prompt, LMSResult, [software] if software else [])
+    return combine_verdicts(data)
+
+
+async def without_boilerplate(page: Page, software: list[str]) -> Page:
+    """
+    `page` without the blocks that are on most pages of its host (see
+    `crawler.boilerplate`), except those that mention one of `software`.
+    """
+    await prepare_host(page.url)
+    markdown = strip_boilerplate(
+        page.url, page.markdown, keep=lambda block: any(mentions(block, name) for name in software))
+    return page.model_copy(update={"markdown": markdown})
+
+
+async def extract_blocks(page: Page, prompt: str, schema: type[BaseModel], software: list[str],
+                         stop_when=any_positive) -> list:
+    """
+    Runs the LLM with `prompt` on the chunks of `page`, and returns the
+    extracted blocks, validated as `schema`. Of long pages, only the chunks
+    most relevant for `software` are used (see `crawler.ranking`). The
+    remaining chunks are skipped once `stop_when` returns True for the
+    blocks so far (see `ChunkLimitedLLMExtractionStrategy`).
+    Raises `RuntimeError` if the LLM call failed for a chunk.
+    """
+    stop = threading.Event()
+    llm_strategy = make_llm_strategy(prompt, schema, stop_when, ranking.query_terms(software), stop)
+    sections = RegexChunking().chunk(page.markdown)
+    # `run` is blocking (it uses its own thread pool for the chunks)
+    try:
+        blocks = await asyncio.to_thread(llm_strategy.run, page.url, sections)
+    except asyncio.CancelledError:
+        # e.g. another URL was positive first: the thread cannot be
+        # cancelled, but it stops after the current wave of chunks
+        stop.set()
+        raise
+    metrics.increment("llm_chunks", "evaluated", llm_strategy.evaluated_chunks)
+    metrics.increment("llm_chunks", "skipped", len(llm_strategy.skipped_chunks))
+
+    # log.info("LLM usage: %s", llm_strategy.usages)
+    # log.info("LLM usage: %s", llm_strategy.total_usage)
+    # llm_strategy.show_usage()
+
+    log.info("extracted blocks: %s", json.dumps(blocks)[:1000])
+
+    try:
+        data = TypeAdapter(list[schema|ErrorBlock]).validate_python(blocks)  # type: ignore
+    except Exception as e:
+        log.warning(f"⚠️ Error validating JSON: {e}")
+        log.warning("Extracted content: %s", blocks)
+        raise
+
+    for item in data:
+        if isinstance(item, ErrorBlock):
+            raise RuntimeError(
+                f"Error in block {item.index}: {item.content}")
+    return data
+
+
+def combine_verdicts(data: list[LMSResult]) -> LMSResult:
+    """
+    Combines the verdicts of the chunks of a page: any positive chunk
+    makes the page positive.
+    """
+    positive: list[str] = []
+    for item in data:
+        if item.software_usage_found:
+            positive.append(item.reasoning)
+
+    usage_found = len(positive) > 0
+    if usage_found:
+        # reasoning = f"URL: {url};"
+        reasoning = "; ".join(positive)
+    else:
+        # reasoning = f"URL: {url};"
+        reasoning = "No mention found."
+
+    return LMSResult(reasoning=reasoning, software_usage_found=usage_found)
+
+
+@record_results
+@cache_results(ttl=timedelta(days=180), ignore=("page",), cacheable=is_llm_verdict)
+# async def scrape_url(url: str, software: str = "Moodle", einrichtung: str = "HfM Würzburg", skip_cache=False) -> LMSResult:
+async def scrape_url(url: str, prompt_template: str, arguments: dict, skip_cache=False,
+                     page: Page | None = None) -> LMSResult:
+    """
+    Fetches `url` and classifies its content, see `fetch_page` and
+    `classify_page`. If the page was already fetched, it can be passed
+    as `page` (this is not part of the cache key).
+    """
+    log.info(f"Scraping URL: {url} for {arguments}")
+    if page is None:
+        page = await fetch_page(url)
+    return await classify_page(page, prompt_template, arguments)
+
+
+async def classify_page_multi(page: Page, prompt_template: str, arguments: dict,
+                              software: list[str]) -> dict[str, LMSResult]:
+    """
+    Like `classify_page`, but asks for a verdict for each of `software`
+    in one LLM call per chunk. `prompt_template` gets `{software}` as a
+    comma separated list. Software the LLM did not answer for counts as
+    not found, software not mentioned on the page at all is not asked for.
+    """
+    if not page.markdown:
+        log.warning("⚠️ No content extracted")
+        return {name: LMSResult(reasoning=NO_CONTENT, software_usage_found=False)
+                for name in software}
+
+    page = await without_boilerplate(page, software)
+    # only ask about the software that is mentioned at all
+    results = {name: LMSResult(reasoning=f"{PREFILTER} {name} is not mentioned on the page",
+                               software_usage_found=False)
+               for name in software if not prefilter(page.markdown, name)}
+    software = [name for name in software if name not in results]
+    if not software:
+        return results
+
+    prompt = prompt_template.format(**{**arguments, "software": ", ".join(software)})
+    by_name = {name.casefold(): name for name in software}
+
+    def all_positive(blocks: list[dict]) -> bool:
+        found = {by_name.get(str(block.get("software", "")).strip().casefold())
+                 for block in blocks if block.get("software_usage_found") is True}
+        return found >= set(software)
+
+    data = await extract_blocks(page, prompt, SoftwareVerdict, software, stop_when=all_positive)
+    chunks: dict[str, list[LMSResult]] = {name: [] for name in software}
+    for item in data:
+        name = by_name.get(item.software.strip().casefold())
+        if name is None:
+            log.warning(f"LLM answered for unknown software {item.software!r}")
+            continue
+        chunks[name].append(item)
+    results.update({name: combine_verdicts(verdicts) for name, verdicts in chunks.items()})
+    return results
+
+
+@record_results
+async def scrape_url_multi(url: str, prompt_template: str, arguments: dict, software: list[str],
+                           skip_cache=False, page: Page | None = None,
+                           cache_return_info=False) -> dict[str, LMSResult]:
+    """
+    Fetches `url` once and classifies it for all of `software`, see
+    `classify_page_multi`. Returns the verdicts by software.
+
+    The prefilter decides which products the LLM is asked about, so the
+    result is cached together with the prefilter settings for `software`
+    (see `crawler.prefilter.settings_for`): changed aliases or
+    `--no-prefilter` give new cache entries.
+    """
+    return await _scrape_url_multi(url, prompt_template, arguments, software,
+                                   settings_for(software), skip_cache=skip_cache,
+                                   page=page, cache_return_info=cache_return_info)
 
-    crawler_strategy = PDFCrawlerStrategy() if is_pdf else None
-    
-    async with AsyncWebCrawler(crawler_strategy=crawler_strategy) as crawler:  # type: ignore
-        # cast(AsyncLogger, crawler.logger).console.file = sys.stderr
-        log.info("Scraping URL: %s", url)
-        result = await crawler.arun(
-            url=url,
-            config=crawl_config
-        )
-        log.info("URL scraped: %s", url)
-        if TYPE_CHECKING:
-            assert isinstance(result, CrawlResult)
 
-        # log.info("LLM usage: %s", llm_strategy.usages)
-        # log.info("LLM usage: %s", llm_strategy.total_usage)
-        # llm_strategy.show_usage()
-
-        if not result.extracted_content:
-            log.warning("⚠️ No content extracted")
-            return LMSResult(reasoning="(No content extracted)", software_usage_found=False)
-
-
-        log.info("result.error_message: %s", result.error_message)
-        log.info("result.extracted_content: %s", result.extracted_content[:1000])
-
-        try:
-            data = TypeAdapter(list[LMSResult|ErrorBlock]).validate_json(
-                result.extracted_content)
-        except json.JSONDecodeError as e:
-            log.warning(f"⚠️ JSON decoding error: {e}")
-            log.warning("The extracted content might not be valid JSON.")
-            log.warning("Extracted content: %s", result.extracted_content)
-            raise
-            return LMSResult(reasoning="(JSON decoding error)", software_usage_found=False)
-        except Exception as e:
-            log.warning(f"⚠️ Error validating JSON: {e}")
-            log.warning("Extracted content: %s", result.extracted_content)
-            raise
-            return LMSResult(reasoning="(Error validating JSON)", software_usage_found=False)
-
-        # # combine chunks into a single reasoning
-        # chunks = []
-        # for item in data:
-        #     if isinstance(item, ErrorBlock):
-        #         raise RuntimeError(
-        #             f"Error in block {item.index}: {item.content}")
-            
-        #     chunks.append({
-        #         "software_usage_found": item.software_usage_found,
-        #         "reasoning": item.reasoning
-        #     })
-
-        positive: list[str] = []
-        for item in data:
-            if isinstance(item, ErrorBlock):
-                raise RuntimeError(
-                    f"Error in block {item.index}: {item.content}")
-            if item.software_usage_found:
-                positive.append(item.reasoning)
-
-        usage_found = len(positive) > 0
-        if usage_found:
-            # reasoning = f"URL: {url};"
-            reasoning = "; ".join(positive)
-        else:
-            # reasoning = f"URL: {url};"
-            reasoning = "No mention found."
-
-        return LMSResult(reasoning=reasoning, software_usage_found=usage_found)
+@cache_results(name="scrape_url_multi", ttl=timedelta(days=180), ignore=("page",),
+               cacheable=lambda results: not any(result.reasoning.startswith(NO_CONTENT)
+                                                 for result in results.values()))
+async def _scrape_url_multi(url: str, prompt_template: str, arguments: dict, software: list[str],
+                            prefilter_settings: dict, skip_cache=False,
+                            page: Page | None = None) -> dict[str, LMSResult]:
+    del prefilter_settings  # only part of the cache key
+    log.info(f"Scraping URL: {url} for {software}, {arguments}")
+    if page is None:
+        page = await fetch_page(url)
+    return await classify_page_multi(page, prompt_template, arguments, software)
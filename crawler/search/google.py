@@ -1,4 +1,5 @@
 
+from datetime import timedelta
 from cache_results import cache_results
 from record_results import record_results
 import dotenv
@@ -8,7 +9,7 @@ log = logging.getLogger(__name__)
 
 
 @record_results
-@cache_results  # (dummy_on_miss=[])
+@cache_results(ttl=timedelta(days=90))  # (dummy_on_miss=[])
 def google_search(query: str, skip_cache=False) -> list[str]:
     api_key = dotenv.get_key(".env", "GOOGLE_API_KEY")
     cse_id = dotenv.get_key(".env", "GOOGLE_CSE_ID")
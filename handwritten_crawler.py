@@ -1,18 +1,25 @@
+import argparse
 import asyncio
 import csv
-import json
 import logging
 import os
 import re
+from datetime import timedelta
 from typing import TypedDict
 
 
-from crawler.scraper import scrape_url
+from cache_results import cache_stats
+from crawl4ai_helpers import configure_batching
+from crawler import (boilerplate, content_store, http_fetch, pdf_text, prefilter,
+                     ranking)
+from crawler.convert_pool import convert_pool
+from crawler.crawler_pool import PoolConfig, crawler_pools
+from crawler.scraper import LMSResult, scrape_url, scrape_url_multi
 from crawler.search.google import google_search
-from utils import parse_json_objects
-
-# For unpickling the cached results
-from crawler.scraper import LMSResult
+from metrics import metrics
+from pipeline import EvaluationMode, PipelineConfig, make_record, run_pipeline
+from progress import ProgressIndex
+from record_results import record_results
 
 # import litellm
 # litellm._turn_on_debug()
@@ -32,15 +39,7 @@ logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
 
 
 def get_done_combos(output_file: str, keys: tuple[str, str]) -> set[tuple[str, str]]:
-    combos_done = set()
-    if os.path.exists(output_file):
-        objs = parse_json_objects(output_file)
-        for obj in objs:
-            einrichtung = obj.get("einrichtung", "")
-            software = obj.get("software", "")
-            if einrichtung and software:
-                combos_done.add((einrichtung, software))
-    return combos_done
+    return ProgressIndex(output_file, keys).load()
 
 
 
@@ -84,7 +83,9 @@ def read_universities(filename: str) -> list[UniversityDict]:
     unis = list({uni["name"]: uni for uni in unis}.values())
     return unis
 
-async def main():
+async def main(concurrency: int = 1, pipeline: PipelineConfig | None = None,
+               pool: PoolConfig | None = None, mode: EvaluationMode = "sequential",
+               max_parallel: int = 5, multi_label: bool = False, convert_workers: int = 0):
 
     # url = "https://www.ub.tu-clausthal.de/en/publishing-open-access/publish-open-access/open-access-policy-and-strategy-of-the-technischen-universitaet-clausthal"
     # software = "OpenOLAT" 
@@ -103,7 +104,8 @@ async def main():
     output_file = "results_new.jsonlines"
 
     unis = read_universities('../einrichtungen/data/hochschulen.csv')
-    combos_done = get_done_combos(output_file, ("einrichtung", "software"))
+    progress = ProgressIndex(output_file, ("einrichtung", "software"))
+    combos_done = progress.load()
 
 
 
@@ -127,6 +129,8 @@ async def main():
     # ]
 
     prompt_template = "Finde heraus ob aus dem Text hervorgeht, dass {software} oder eine auf {software} basierende Software in der Einrichtung {einrichtung} genutzt wird. Antworte mit Wahr oder Falsch und gib eine kurze Begründung."
+    # for --multi-label, {software} is a list like "Moodle, Ilias, OpenOLAT"
+    multi_prompt_template = "Finde für jede der folgenden Software heraus, ob aus dem Text hervorgeht, dass sie oder eine darauf basierende Software in der Einrichtung {einrichtung} genutzt wird: {software}. Gib für jede Software einen Eintrag mit ihrem Namen, Wahr oder Falsch und einer kurzen Begründung."
 
     # Zähle alle Unis
     total_unis = len(unis)
@@ -144,76 +148,342 @@ async def main():
     total_unis_done = len(unis_done)
     print(f"Total universities already processed: {total_unis_done}")
 
-    for index, item in enumerate(unis):
-        print(f"Processing {index + 1}/{len(unis)}: {item['name']} ({item['website']})")
-        site = item["website"]
-        einrichtung = item["name"]
-
+    jobs = []
+    for item in unis:
         # , "OpenOLAT", "Canvas", "Stud.IP"]:
         for software in ["Moodle", "Ilias", "OpenOLAT"]:
-            if (einrichtung, software) in combos_done:
-                log.info(f"Skipping {einrichtung} - {software}, already done")
+            if (item["name"], software) in combos_done:
+                log.info(f"Skipping {item['name']} - {software}, already done")
                 continue
-
-            # Step 1: Google search
-            results = google_search(f"site:{site} {software}", skip_cache=False)
-
-            combined_verdict = False
-            scraping_results = []
-            # For each result...
-            for index, url in enumerate(results[:5]):
-                log.debug("--> Scraping url #%d: %s", index, url)
-
-                # Step 2: Scrape the URL and apply LLM
-                arguments = {
-                    "software": software,
-                    "einrichtung": einrichtung,
-                    "url": url
-                }
-                result = await scrape_url(url, prompt_template=prompt_template, arguments=arguments, skip_cache=False)
-                scraping_results.append(result)
-                # log.debug(result)
-                if result.software_usage_found:
-                    log.debug(
-                        f"{software} usage found in {url}: {result.reasoning}")
-                    combined_verdict = True
-                    # exit early
-                    break
-
-                log.debug(
-                    f"No {software} usage found in {url}: {result.reasoning}")
-
-            if not combined_verdict:
-                summary = f"Found no evidence of {software} usage in documents"
+            jobs.append((item, software))
+    if pipeline is not None:
+        print(f"Combinations to process: {len(jobs)}, with {pipeline}")
+    else:
+        print(f"Combinations to process: {len(jobs)}, with {concurrency} concurrent jobs")
+
+    queue: asyncio.Queue = asyncio.Queue()
+    if multi_label:
+        # one job per institution, for all software that is not done yet
+        by_institution: dict[str, tuple[UniversityDict, list[str]]] = {}
+        for item, software in jobs:
+            by_institution.setdefault(item["name"], (item, []))[1].append(software)
+        for job in by_institution.values():
+            queue.put_nowait(job)
+    else:
+        for item, software in jobs:
+            queue.put_nowait((item, [software]))
+
+    async def worker():
+        while True:
+            try:
+                item, software_list = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            print(f"Processing {item['name']} ({item['website']}) - {', '.join(software_list)}")
+            if multi_label:
+                res_items = await process_institution(
+                    item["website"], item["name"], software_list, multi_prompt_template,
+                    mode=mode, max_parallel=max_parallel)
             else:
-                summary = f"Found evidence of {software} usage in documents"
-
-            combined_inputs = [
-                {'url': url, 'reasoning': r.reasoning}
-                for url, r in zip(results[:5], scraping_results)
-            ]
-
-            combined_reasoning = {
-                'summary': summary,
-                'inputs': combined_inputs
-            }
-
-            log.info("==> combined result for %s / %s: %s", einrichtung, software, combined_verdict)
-
-            res_item = {
-                "einrichtung": einrichtung,
-                "software": software,
-                "usage_found": combined_verdict,
-                "reasoning": combined_reasoning
-            }
-
-            # print as json
-            with open(output_file, "a", encoding="utf-8") as f:
-                print("==" * 20, "adding result for", einrichtung, software, "==")
-                print(json.dumps(res_item, ensure_ascii=False), file=f, flush=True)
-
+                res_items = [await process_combo(
+                    item["website"], item["name"], software_list[0], prompt_template,
+                    mode=mode, max_parallel=max_parallel)]
+
+            # append as json, together with the progress index.
+            # This does not await, so cancelling a worker (Ctrl-C)
+            # never leaves a half-written record.
+            for res_item in res_items:
+                print("==" * 20, "adding result for", item["name"], res_item["software"], "==")
+                progress.append(res_item)
+
+    try:
+        # browsers and conversion processes are shared by all jobs, and closed at the end
+        async with crawler_pools(pool):
+            with convert_pool(convert_workers):
+                if pipeline is not None:
+                    await run_pipeline(jobs, prompt_template, progress.append, pipeline)
+                else:
+                    # a failing job stops the whole run, like in the sequential version
+                    async with asyncio.TaskGroup() as tg:
+                        for _ in range(concurrency):
+                            tg.create_task(worker())
+    finally:
+        await http_fetch.close_client()
+        print_cache_stats()
+        metrics.print_summary()
+        metrics.write(f"results/metrics_{record_results.init_time}.json")
+
+
+async def process_combo(site: str, einrichtung: str, software: str, prompt_template: str,
+                        mode: EvaluationMode = "sequential", max_parallel: int = 5) -> dict:
+    """
+    Searches for `software` on `site` and evaluates the top results.
+    Returns the result record for the combination.
+
+    With `mode="sequential"`, the results are evaluated one after another
+    until one is positive. "first-positive" evaluates up to `max_parallel`
+    results at once and cancels the others as soon as one is positive,
+    "all" evaluates all of them in parallel.
+    """
+    # Step 1: Google search
+    # (runs in a thread, so that other jobs can continue meanwhile)
+    results = await asyncio.to_thread(google_search, f"site:{site} {software}", skip_cache=False)
+    urls = results[:5]
+
+    # verdicts of the evaluated URLs, by position in `urls`
+    verdicts: dict[int, LMSResult] = {}
+
+    async def evaluate(index: int, url: str) -> LMSResult:
+        log.debug("--> Scraping url #%d: %s", index, url)
+
+        # Step 2: Scrape the URL and apply LLM
+        arguments = {
+            "software": software,
+            "einrichtung": einrichtung,
+            "url": url
+        }
+        result = await scrape_url(url, prompt_template=prompt_template, arguments=arguments, skip_cache=False)
+        verdicts[index] = result
+        # log.debug(result)
+        if result.software_usage_found:
+            log.debug(
+                f"{software} usage found in {url}: {result.reasoning}")
+        else:
+            log.debug(
+                f"No {software} usage found in {url}: {result.reasoning}")
+        return result
+
+    if mode == "sequential":
+        # For each result...
+        for index, url in enumerate(urls):
+            result = await evaluate(index, url)
+            if result.software_usage_found:
+                # exit early
+                break
+    else:
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def evaluate_parallel(index: int, url: str) -> None:
+            async with semaphore:
+                result = await evaluate(index, url)
+            if mode == "first-positive" and result.software_usage_found:
+                # cancels the other evaluations of the task group
+                raise _PositiveFound()
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for index, url in enumerate(urls):
+                    tg.create_task(evaluate_parallel(index, url))
+        except* _PositiveFound:
+            pass
+
+    return make_record(einrichtung, software, urls, verdicts)
+
+
+async def process_institution(site: str, einrichtung: str, software: list[str], prompt_template: str,
+                              mode: EvaluationMode = "sequential", max_parallel: int = 5) -> list[dict]:
+    """
+    Like `process_combo`, for several software products at once. The top
+    search results of all products are merged, and each URL is fetched
+    and sent to the LLM only once, asking about all products
+    (`scrape_url_multi`). Returns one result record per product.
+
+    Unless `mode` is "all", a URL is skipped once every product it was
+    found for has a positive verdict. URLs are evaluated by rank, i.e.
+    the first result of each product, then the second, and so on. With
+    "first-positive", the running evaluations are cancelled as soon as
+    every product has a positive verdict.
+    """
+    searches = await asyncio.gather(*(
+        asyncio.to_thread(google_search, f"site:{site} {name}", skip_cache=False)
+        for name in software))
+    urls_by_software = {name: results[:5] for name, results in zip(software, searches)}
+    ranked = [url for rank in range(5) for name in software
+              for url in urls_by_software[name][rank:rank + 1]]
+    urls = list(dict.fromkeys(ranked))
+    metrics.increment("multi_label", "urls", len(ranked))
+    metrics.increment("multi_label", "unique_urls", len(urls))
+
+    # verdicts by URL, then by software
+    verdicts: dict[str, dict[str, LMSResult]] = {}
+
+    def found(name: str) -> bool:
+        return any(verdicts[url][name].software_usage_found
+                   for url in urls_by_software[name] if url in verdicts)
+
+    def needed(url: str) -> bool:
+        return mode == "all" or any(
+            url in urls_by_software[name] and not found(name) for name in software)
+
+    async def evaluate(url: str) -> None:
+        if not needed(url):
+            metrics.increment("multi_label", "urls_skipped")
+            return
+        log.debug("--> Scraping url %s for %s", url, software)
+        arguments = {
+            "einrichtung": einrichtung,
+            "url": url
+        }
+        verdicts[url] = await scrape_url_multi(url, prompt_template=prompt_template, arguments=arguments,
+                                               software=software, skip_cache=False)
+
+    if mode == "sequential":
+        for url in urls:
+            await evaluate(url)
+    else:
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def evaluate_parallel(url: str) -> None:
+            async with semaphore:
+                await evaluate(url)
+            if mode == "first-positive" and all(map(found, software)):
+                # cancels the other evaluations of the task group
+                raise _PositiveFound()
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for url in urls:
+                    tg.create_task(evaluate_parallel(url))
+        except* _PositiveFound:
+            pass
+
+    return [
+        make_record(einrichtung, name, urls_by_software[name], {
+            index: verdicts[url][name]
+            for index, url in enumerate(urls_by_software[name]) if url in verdicts
+        })
+        for name in software
+    ]
+
+
+class _PositiveFound(Exception):
+    """
+    Raised to stop evaluating the other URLs of a combination, or of an
+    institution once all its software products are found.
+    """
+
+
+def print_cache_stats():
+    print("Cache statistics:")
+    for name, tiers in cache_stats().items():
+        for tier, counters in tiers.items():
+            print(f"  {name} ({tier}): {counters['hits']} hits, "
+                  f"{counters['misses']} misses, {counters['evictions']} evictions")
+
+
+
+def cli() -> None:
+    """
+    Parses the command line, configures the modules and runs `main`.
+    """
+    parser = argparse.ArgumentParser(description="Sucht nach Lernplattformen an Hochschulen")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of (einrichtung, software) combinations processed at once")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Run search, fetching and LLM calls as separate stages, "
+                             "with their own number of workers (see below)")
+    parser.add_argument("--search-workers", type=int, default=PipelineConfig.search_workers)
+    parser.add_argument("--fetch-workers", type=int, default=PipelineConfig.fetch_workers)
+    parser.add_argument("--llm-workers", type=int, default=PipelineConfig.llm_workers)
+    parser.add_argument("--queue-size", type=int, default=PipelineConfig.queue_size,
+                        help="Maximum number of items waiting between two stages")
+    parser.add_argument("--browsers", type=int, default=PoolConfig.size,
+                        help="Number of browsers kept open, i.e. pages loaded at once")
+    parser.add_argument("--pdf-crawlers", type=int, default=PoolConfig.pdf_size,
+                        help="Number of PDFs loaded at once")
+    parser.add_argument("--browser-max-pages", type=int, default=PoolConfig.max_pages,
+                        help="Restart a browser after this many pages")
+    parser.add_argument("--browser-max-memory", type=float, default=PoolConfig.max_memory_mb,
+                        help="Restart a browser when its own memory (browser and driver processes) "
+                             "grew by this many MB since its start")
+    parser.add_argument("--evaluate", choices=["sequential", "first-positive", "all"],
+                        default="sequential",
+                        help="How the top search results of a combination are evaluated: "
+                             "one after another until one is positive, in parallel until "
+                             "one is positive, or all of them in parallel")
+    parser.add_argument("--max-parallel-urls", type=int, default=5,
+                        help="Number of search results of one combination evaluated at once")
+    parser.add_argument("--multi-label", action="store_true",
+                        help="Fetch each URL found for an institution once, and ask the LLM "
+                             "about all software in one pass")
+    parser.add_argument("--alias", action="append", default=[], metavar="SOFTWARE=NAME",
+                        help="Another name of a software for the prefilter, e.g. Ilias=ILIAS-Lernplattform")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="Send pages to the LLM even if they do not mention the software")
+    parser.add_argument("--max-chunks", type=int, default=ranking.max_chunks(),
+                        help="Number of chunks of a page sent to the LLM at most")
+    parser.add_argument("--ranking-term", action="append", default=None, metavar="TERM",
+                        help="Word that makes a chunk of a long page more relevant, in addition "
+                             "to the software names (replaces the defaults: "
+                             f"{', '.join(ranking.CRITERION_TERMS)})")
+    parser.add_argument("--refetch", action="store_true",
+                        help="Fetch pages again even if they are in the content store")
+    parser.add_argument("--content-max-age", type=float, default=None, metavar="DAYS",
+                        help="Fetch pages again if the stored copy is older than this")
+    parser.add_argument("--keep-boilerplate", action="store_true",
+                        help="Do not remove blocks that are on most pages of a host "
+                             "(navigation, footer, ...) before sending pages to the LLM")
+    parser.add_argument("--browser-only", action="store_true",
+                        help="Load all pages with the browser, without trying a plain HTTP request first "
+                             "(PDFs are then only recognized by their URL)")
+    parser.add_argument("--min-words", type=int, default=50,
+                        help="Load a page with the browser if the HTTP response has fewer words")
+    parser.add_argument("--convert-workers", type=int, default=2,
+                        help="Number of processes that convert HTML and PDFs to text (0: in a thread)")
+    parser.add_argument("--pdf-max-mb", type=float, default=30,
+                        help="Do not download PDFs larger than this")
+    parser.add_argument("--pdf-max-pages", type=int, default=60,
+                        help="Number of pages of a PDF that are read at most")
+    parser.add_argument("--llm-batch-size", type=int, default=4,
+                        help="Number of chunks (also of different pages) sent to the LLM in one request "
+                             "(1: one request per chunk)")
+    parser.add_argument("--llm-batch-wait", type=float, default=0.25, metavar="SECONDS",
+                        help="How long a chunk waits for others to fill its batch")
+    args = parser.parse_args()
+    configure_batching(batch_size=args.llm_batch_size, max_wait=args.llm_batch_wait)
+    http_fetch.configure(enabled=not args.browser_only, min_words=args.min_words)
+    pdf_text.configure(max_bytes=int(args.pdf_max_mb * 1024 * 1024), max_pages=args.pdf_max_pages)
+    boilerplate.configure(enabled=not args.keep_boilerplate)
+    content_store.configure(
+        refresh=args.refetch,
+        max_age=timedelta(days=args.content_max_age) if args.content_max_age is not None else None,
+    )
+    ranking.configure(max_chunks=args.max_chunks, terms=args.ranking_term)
+    aliases: dict[str, list[str]] = {}
+    for alias in args.alias:
+        software, _, name = alias.partition("=")
+        if not name:
+            parser.error(f"--alias must look like SOFTWARE=NAME, not {alias!r}")
+        aliases.setdefault(software, []).append(name)
+    prefilter.configure(aliases=aliases, enabled=not args.no_prefilter)
+    if args.multi_label and args.pipeline:
+        parser.error("--multi-label is not supported with --pipeline")
+    pool_config = PoolConfig(
+        size=args.browsers,
+        pdf_size=args.pdf_crawlers,
+        max_pages=args.browser_max_pages,
+        max_memory_mb=args.browser_max_memory,
+    )
+    pipeline_config = None
+    if args.pipeline:
+        pipeline_config = PipelineConfig(
+            search_workers=args.search_workers,
+            fetch_workers=args.fetch_workers,
+            llm_workers=args.llm_workers,
+            queue_size=args.queue_size,
+            # the stages always run in parallel
+            mode="all" if args.evaluate == "all" else "first-positive",
+        )
+    try:
+        # main()
+        asyncio.run(main(concurrency=args.concurrency, pipeline=pipeline_config,
+                         pool=pool_config, mode=args.evaluate,
+                         max_parallel=args.max_parallel_urls, multi_label=args.multi_label,
+                         convert_workers=args.convert_workers))
+    except KeyboardInterrupt:
+        # finished results are saved, the rest is picked up on the next run
+        print("Interrupted")
 
 
 if __name__ == "__main__":
-    # main()
-    asyncio.run(main())
+    cli()
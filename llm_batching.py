@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Generic, Hashable, TypeVar
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class BatchDispatcher(Generic[T, R]):
+    """
+    Collects requests from many threads (e.g. the chunks of several pages
+    evaluated at the same time) and passes them to `send` in batches of
+    up to `max_batch_size`. Only requests with the same `key` (e.g. the
+    same model and schema) are batched together.
+
+    The first request of a batch waits up to `max_wait` seconds for more
+    requests, then sends the batch in its own thread; the other callers
+    wait for their result. `send` gets the key and the requests, and must
+    return one result per request, in the same order. An exception in
+    place of a result is raised in the caller of that request only.
+    """
+
+    def __init__(self, send: Callable[[Hashable, list[T]], list[R]],
+                 max_batch_size: int = 4, max_wait: float = 0.25, name: str = "llm_batches"):
+        self.send = send
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self._pending: dict[Hashable, list[tuple[T, Future[R]]]] = {}
+        self._cond = threading.Condition()
+
+    def submit(self, key: Hashable, request: T) -> R:
+        """
+        Sends `request` with the next batch for `key`, and returns its result.
+        Blocks until the batch is answered.
+        """
+        future: Future[R] = Future()
+        with self._cond:
+            batch = self._pending.get(key)
+            leader = batch is None or len(batch) >= self.max_batch_size
+            if leader:
+                batch = self._pending[key] = []
+            assert batch is not None
+            batch.append((request, future))
+            if len(batch) >= self.max_batch_size:
+                self._cond.notify_all()
+            if leader:
+                deadline = time.monotonic() + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+        if leader:
+            self._send(key, batch)
+        return future.result()
+
+    def _send(self, key: Hashable, batch: list[tuple[T, "Future[R]"]]) -> None:
+        metrics.increment(self.name, "batches")
+        metrics.increment(self.name, "requests", len(batch))
+        counters = metrics.counters[self.name]
+        metrics.set(self.name, "mean_batch_size", counters["requests"] / counters["batches"])
+        try:
+            results = self.send(key, [request for request, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Expected {len(batch)} results, got {len(results)}")
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def numbered_items(blocks: list[dict[str, Any]], count: int) -> list[list[dict[str, Any]] | None]:
+    """
+    Splits the answer to a batch of `count` items: each block has the
+    1-based number of its item in `"item"`. Returns the blocks of each
+    item (without `"item"`), or None for items without an answer.
+    """
+    items: list[list[dict[str, Any]] | None] = [None] * count
+    for block in blocks:
+        number = block.get("item")
+        if not isinstance(number, int) or not 1 <= number <= count:
+            log.warning(f"Ignoring answer block without a valid item number: {block}")
+            continue
+        answer = {k: v for k, v in block.items() if k != "item"}
+        items[number - 1] = (items[number - 1] or []) + [answer]
+    return items
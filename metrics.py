@@ -0,0 +1,124 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """
+    Returns the given percentile (0..1) of an already sorted list,
+    using the nearest-rank method.
+    """
+    if not sorted_values:
+        return math.nan
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class FunctionMetrics:
+    """
+    Wall times and outcomes (e.g. cache hit/miss) of the calls of one function.
+    """
+
+    # upper bounds of the histogram buckets in seconds
+    BUCKETS = [0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, math.inf]
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.outcomes: Counter[str] = Counter()
+
+    def add(self, seconds: float, outcome: str | None) -> None:
+        self.latencies.append(seconds)
+        if outcome is not None:
+            self.outcomes[outcome] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        calls = len(latencies)
+        histogram = Counter()
+        for seconds in latencies:
+            histogram[next(b for b in self.BUCKETS if seconds <= b)] += 1
+        hits = self.outcomes["hit"] + self.outcomes["coalesced"]
+        return {
+            "calls": calls,
+            "calls_per_sec": calls / elapsed if elapsed > 0 else math.nan,
+            "total_sec": sum(latencies),
+            "p50_sec": percentile(latencies, 0.50),
+            "p95_sec": percentile(latencies, 0.95),
+            "p99_sec": percentile(latencies, 0.99),
+            "max_sec": latencies[-1] if latencies else math.nan,
+            "hit_ratio": hits / calls if calls else math.nan,
+            "outcomes": dict(self.outcomes),
+            "histogram": {(f"<={b}s" if b != math.inf else f">{self.BUCKETS[-2]}s"): histogram[b]
+                          for b in self.BUCKETS},
+        }
+
+
+class Metrics:
+    """
+    Collects per-function timings and named counters for one run.
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.functions: dict[str, FunctionMetrics] = {}
+        self.counters: dict[str, Counter[str]] = {}
+        self._lock = threading.Lock()
+
+    def record_call(self, name: str, seconds: float, outcome: str | None = None) -> None:
+        with self._lock:
+            self.functions.setdefault(name, FunctionMetrics()).add(seconds, outcome)
+
+    def increment(self, name: str, key: str, amount: float = 1) -> None:
+        with self._lock:
+            self.counters.setdefault(name, Counter())[key] += amount
+
+    def set(self, name: str, key: str, value: float) -> None:
+        """
+        Sets a value that is not a count, e.g. a utilization.
+        """
+        with self._lock:
+            self.counters.setdefault(name, Counter())[key] = value
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.start_time
+        with self._lock:
+            return {
+                "elapsed_sec": elapsed,
+                "functions": {name: function.summary(elapsed)
+                              for name, function in self.functions.items()},
+                "counters": {name: dict(counter)
+                             for name, counter in self.counters.items()},
+            }
+
+    def print_summary(self) -> None:
+        summary = self.summary()
+        print(f"Metrics after {summary['elapsed_sec']:.1f}s:")
+        for name, function in summary["functions"].items():
+            print(f"  {name}: {function['calls']} calls "
+                  f"({function['calls_per_sec']:.2f}/s), "
+                  f"p50 {function['p50_sec']:.2f}s, p95 {function['p95_sec']:.2f}s, "
+                  f"p99 {function['p99_sec']:.2f}s, "
+                  f"hit ratio {function['hit_ratio']:.0%}, {function['outcomes']}")
+        for name, counter in summary["counters"].items():
+            print(f"  {name}: {counter}")
+
+    def write(self, filename: str) -> None:
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, "w", encoding="utf-8") as f:
+            # NaN is not valid JSON
+            json.dump(_replace_nan(self.summary()), f, indent=2)
+
+
+def _replace_nan(value):
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, dict):
+        return {k: _replace_nan(v) for k, v in value.items()}
+    return value
+
+
+# Metrics of the current run
+metrics = Metrics()
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Literal
+
+from crawler.scraper import LMSResult, Page, fetch_page, scrape_url
+from crawler.search.google import google_search
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# How the top search results of a combination are evaluated, see
+# `handwritten_crawler.process_combo`
+EvaluationMode = Literal["sequential", "first-positive", "all"]
+
+
+@dataclass
+class PipelineConfig:
+    """
+    Number of workers per stage, and the size of the queues between them.
+    With `mode="all"`, all URLs of a combination are evaluated, otherwise
+    the remaining ones are skipped once one is positive.
+    """
+    search_workers: int = 2
+    fetch_workers: int = 4
+    llm_workers: int = 4
+    queue_size: int = 20
+    mode: EvaluationMode = "first-positive"
+
+
+class Stage:
+    """
+    A pool of workers that take items from a bounded queue and pass them
+    to `handler`. Producers block when the queue is full, so a slow stage
+    slows down the stages before it instead of piling up work in memory.
+
+    Records how full the queue was when items were taken, and how much
+    of the time the workers were busy (utilization).
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int,
+                 handler: Callable[..., Awaitable[None]]):
+        self.name = name
+        self.workers = workers
+        self.handler = handler
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.items = 0
+        self.busy_sec = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.started_at = time.monotonic()
+
+    async def put(self, item) -> None:
+        await self.queue.put(item)
+
+    def start(self, tg: asyncio.TaskGroup) -> None:
+        self.started_at = time.monotonic()
+        for _ in range(self.workers):
+            tg.create_task(self._worker())
+
+    async def _worker(self) -> None:
+        while True:
+            item = await self.queue.get()
+            depth = self.queue.qsize()
+            self.depth_sum += depth
+            self.depth_max = max(self.depth_max, depth)
+            start = time.monotonic()
+            try:
+                await self.handler(*item)
+            finally:
+                self.busy_sec += time.monotonic() - start
+                self.items += 1
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "busy_sec": self.busy_sec,
+            "utilization": self.busy_sec / (self.workers * elapsed) if elapsed > 0 else 0.0,
+            "queue_depth_mean": self.depth_sum / self.items if self.items else 0.0,
+            "queue_depth_max": self.depth_max,
+        }
+
+
+@dataclass
+class Combo:
+    """
+    The state of one (einrichtung, software) combination in the pipeline.
+    """
+    site: str
+    einrichtung: str
+    software: str
+    urls: list[str] = field(default_factory=list)
+    verdicts: dict[int, LMSResult] = field(default_factory=dict)
+    pending: int = 0
+
+    @property
+    def positive(self) -> bool:
+        return any(v.software_usage_found for v in self.verdicts.values())
+
+    def arguments(self, url: str) -> dict:
+        return {
+            "software": self.software,
+            "einrichtung": self.einrichtung,
+            "url": url
+        }
+
+    def record(self) -> dict:
+        """
+        The result record, see `make_record`.
+        """
+        return make_record(self.einrichtung, self.software, self.urls, self.verdicts)
+
+
+def make_record(einrichtung: str, software: str, urls: list[str],
+                verdicts: dict[int, LMSResult]) -> dict:
+    """
+    The result record of a combination, from the verdicts of the
+    evaluated URLs (by position in `urls`).
+    """
+    combined_verdict = any(r.software_usage_found for r in verdicts.values())
+
+    if not combined_verdict:
+        summary = f"Found no evidence of {software} usage in documents"
+    else:
+        summary = f"Found evidence of {software} usage in documents"
+
+    # completed evaluations only, in the order of the search results
+    combined_inputs = [
+        {'url': urls[index], 'reasoning': verdicts[index].reasoning}
+        for index in sorted(verdicts)
+    ]
+
+    combined_reasoning = {
+        'summary': summary,
+        'inputs': combined_inputs
+    }
+
+    log.info("==> combined result for %s / %s: %s", einrichtung, software, combined_verdict)
+
+    return {
+        "einrichtung": einrichtung,
+        "software": software,
+        "usage_found": combined_verdict,
+        "reasoning": combined_reasoning
+    }
+
+
+async def run_pipeline(jobs: list[tuple[dict, str]], prompt_template: str,
+                       on_result: Callable[[dict], None],
+                       config: PipelineConfig | None = None) -> None:
+    """
+    Processes `jobs` (university, software) in three stages connected by
+    bounded queues: Google search → fetching pages → LLM classification.
+    Each stage has its own number of workers, so e.g. the browser and the
+    LLM can both be kept busy. URLs whose verdict is already cached skip
+    the fetch and LLM stages. Unless `config.mode` is "all", once a URL of
+    a combination is positive, the remaining URLs of that combination are
+    skipped if they have not been started yet.
+
+    `on_result` is called with the result record of every combination.
+    Queue depths and utilization per stage are added to `metrics`.
+    """
+    config = config or PipelineConfig()
+
+    def resolve(combo: Combo, index: int | None = None, verdict: LMSResult | None = None) -> None:
+        if verdict is not None:
+            combo.verdicts[index] = verdict  # type: ignore
+            log.debug(f"{combo.einrichtung} / {combo.software}, {combo.urls[index]}: "  # type: ignore
+                      f"{verdict.software_usage_found}")
+        combo.pending -= 1
+        if combo.pending <= 0:
+            print("==" * 20, "adding result for", combo.einrichtung, combo.software, "==")
+            on_result(combo.record())
+
+    async def search(combo: Combo) -> None:
+        print(f"Processing {combo.einrichtung} ({combo.site}) - {combo.software}")
+        results = await asyncio.to_thread(
+            google_search, f"site:{combo.site} {combo.software}", skip_cache=False)
+        combo.urls = results[:5]
+        # one more than the URLs, so the combination is not finished
+        # before all URLs are queued
+        combo.pending = len(combo.urls) + 1
+        for index, url in enumerate(combo.urls):
+            await fetch.put((combo, index, url))
+        resolve(combo)
+
+    def skip(combo: Combo) -> bool:
+        return config.mode != "all" and combo.positive
+
+    async def fetch_url(combo: Combo, index: int, url: str) -> None:
+        if skip(combo):
+            metrics.increment("pipeline", "urls_skipped")
+            resolve(combo)
+            return
+        arguments = combo.arguments(url)
+        try:
+            verdict = scrape_url.cached(url, prompt_template=prompt_template, arguments=arguments)
+        except KeyError:
+            pass
+        else:
+            metrics.increment("pipeline", "urls_cached")
+            resolve(combo, index, verdict)
+            return
+        page = await fetch_page(url)
+        await classify.put((combo, index, url, page))
+
+    async def classify_url(combo: Combo, index: int, url: str, page: Page) -> None:
+        if skip(combo):
+            metrics.increment("pipeline", "urls_skipped")
+            resolve(combo)
+            return
+        verdict = await scrape_url(url, prompt_template=prompt_template,
+                                   arguments=combo.arguments(url), skip_cache=False, page=page)
+        resolve(combo, index, verdict)
+
+    searching = Stage("search", config.search_workers, config.queue_size, search)
+    fetch = Stage("fetch", config.fetch_workers, config.queue_size, fetch_url)
+    classify = Stage("classify", config.llm_workers, config.queue_size, classify_url)
+    stages = [searching, fetch, classify]
+
+    async def feed() -> None:
+        for item, software in jobs:
+            await searching.put((Combo(item["website"], item["name"], software),))
+        # each stage only adds items to the next one, so they can be
+        # waited for in order
+        for stage in stages:
+            await stage.queue.join()
+        raise _Done()
+
+    try:
+        # a failing item stops the whole run, like in the sequential version
+        async with asyncio.TaskGroup() as tg:
+            for stage in stages:
+                stage.start(tg)
+            tg.create_task(feed())
+    except* _Done:
+        pass
+    finally:
+        for stage in stages:
+            for key, value in stage.stats().items():
+                metrics.set(f"stage:{stage.name}", key, value)
+
+
+class _Done(Exception):
+    """
+    Raised when all jobs are done, to stop the workers of the task group.
+    """
@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import threading
+
+from utils import parse_json_objects
+
+log = logging.getLogger(__name__)
+
+
+class ProgressIndex:
+    """
+    Keeps track of which combinations (e.g. einrichtung/software) are
+    already in a results file, without parsing the whole file on startup.
+
+    Next to `output_file`, an append-only index `<output_file>.progress`
+    is kept with one line per result: the values of `keys`, and the size
+    of the results file after writing it. Results must be written through
+    `append`, which updates both files. If the index is missing, was
+    built with other keys, or its last size does not match the results
+    file (e.g. after a crash between the two writes, or after editing the
+    results by hand), it is rebuilt from the results file.
+    """
+
+    def __init__(self, output_file: str, keys: tuple[str, ...] = ("einrichtung", "software")):
+        self.output_file = output_file
+        self.index_file = output_file + ".progress"
+        self.keys = tuple(keys)
+        self._lock = threading.Lock()
+
+    def load(self) -> set[tuple]:
+        done = self._read_index()
+        if done is None:
+            log.info(f"Rebuilding progress index {self.index_file}")
+            done = self._rebuild()
+        return done
+
+    def _read_index(self) -> set[tuple] | None:
+        if not os.path.exists(self.index_file):
+            return None
+        output_size = os.path.getsize(self.output_file) if os.path.exists(self.output_file) else 0
+        done = set()
+        size = 0
+        with open(self.index_file, "r", encoding="utf-8") as f:
+            try:
+                header = json.loads(f.readline())
+                if header.get("keys") != list(self.keys):
+                    return None
+                for line in f:
+                    *values, size = json.loads(line)
+                    if all(values):
+                        done.add(tuple(values))
+            except (ValueError, TypeError, AttributeError):
+                # e.g. a line cut off by a crash
+                return None
+        if size != output_size:
+            return None
+        return done
+
+    def _rebuild(self) -> set[tuple]:
+        done = set()
+        lines = [json.dumps({"keys": list(self.keys)})]
+        if os.path.exists(self.output_file):
+            for obj in parse_json_objects(self.output_file):
+                values = [obj.get(key, "") for key in self.keys]
+                if all(values):
+                    done.add(tuple(values))
+                    lines.append(json.dumps(values + [None], ensure_ascii=False))
+            # only the last size is checked
+            lines.append(json.dumps([""] * len(self.keys) + [os.path.getsize(self.output_file)]))
+
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, self.index_file)
+        return done
+
+    def append(self, record: dict) -> None:
+        """
+        Appends `record` to the results file (as one JSON line) and to the index.
+        """
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        values = [record.get(key, "") for key in self.keys]
+        with self._lock:
+            if not os.path.exists(self.index_file):
+                self._rebuild()
+            with open(self.output_file, "ab") as f:
+                f.write(line)
+                f.flush()
+                size = f.tell()
+            with open(self.index_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(values + [size], ensure_ascii=False) + "\n")
@@ -1,65 +1,217 @@
-
+import asyncio
+import atexit
+import contextlib
+import gzip
+import importlib.util
 import json
+import logging
 import os
+import queue
+import threading
 import time
 
-from pydantic import BaseModel
+from pydantic_core import to_jsonable_python
 
+from metrics import metrics
 from utils import sync_async_decorator
 
+log = logging.getLogger(__name__)
+
+
+class ResultWriter:
+    """
+    Writes records as compact JSON lines from a background thread.
+    Records are collected and written in batches of `batch_size`, or
+    every `flush_interval` seconds, whichever comes first.
+    `compression` can be None, "gzip" or "zstd" (needs `zstandard`).
+    If `max_bytes` is set, a new file is started once the current one
+    has received that many (uncompressed) bytes: `<path>.jsonl`,
+    `<path>.1.jsonl`, `<path>.2.jsonl`, ...
+    """
+    _STOP = object()
+
+    def __init__(self, path: str, flush_interval: float = 1.0, batch_size: int = 100,
+                 compression: str | None = None, max_bytes: int | None = None):
+        if compression not in (None, "gzip", "zstd"):
+            raise ValueError(f"Unknown compression: {compression}")
+        if compression == "zstd" and importlib.util.find_spec("zstandard") is None:
+            raise ValueError("Compression zstd needs the zstandard package")
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.files: list[str] = []
+        self._file = None
+        self._bytes = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name=f"ResultWriter({path})", daemon=True)
+        self._thread.start()
+
+    def write(self, record: dict) -> None:
+        self._queue.put(record)
+
+    def flush(self) -> None:
+        """
+        Blocks until all records written so far are on disk.
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+
+    def _run(self) -> None:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP or isinstance(item, threading.Event):
+                self._write_batch(batch)
+                batch = []
+                if item is self._STOP:
+                    self._close_file()
+                    return
+                item.set()
+            elif item is not None:
+                batch.append(item)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._write_batch(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _write_batch(self, batch: list[dict]) -> None:
+        if not batch:
+            return
+        try:
+            data = "".join(
+                json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+                for record in batch).encode("utf-8")
+            if self._file is None:
+                self._open_file()
+            self._file.write(data)
+            self._file.flush()
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception(f"Could not write {len(batch)} records to {self.path}")
+            return
+        self._bytes += len(data)
+        if self.max_bytes is not None and self._bytes >= self.max_bytes:
+            self._close_file()
+
+    def _open_file(self) -> None:
+        part = f".{len(self.files)}" if self.files else ""
+        extension = {None: "", "gzip": ".gz", "zstd": ".zst"}[self.compression]
+        filename = f"{self.path}{part}.jsonl{extension}"
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with contextlib.ExitStack() as stack:
+            if self.compression == "gzip":
+                file = stack.enter_context(gzip.open(filename, "ab"))
+            elif self.compression == "zstd":
+                import zstandard  # pylint: disable=import-outside-toplevel
+                raw = stack.enter_context(open(filename, "ab"))
+                file = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+            else:
+                file = stack.enter_context(open(filename, "ab"))
+            # stays open until `_close_file`, closed here only on errors
+            stack.pop_all()
+        self._file = file
+        self.files.append(filename)
+        self._bytes = 0
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Settings for the writers created by `record_results`, see `configure`
+_writer_options: dict = {}
+_writers: dict[str, ResultWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def configure(**options) -> None:
+    """
+    Sets the `ResultWriter` options (flush_interval, batch_size,
+    compression, max_bytes) for result files opened from now on.
+    """
+    _writer_options.update(options)
+
+
+def get_writer(name: str) -> ResultWriter:
+    with _writers_lock:
+        writer = _writers.get(name)
+        if writer is None:
+            path = f"results/{name}_{record_results.init_time}"
+            writer = ResultWriter(path, **_writer_options)
+            _writers[name] = writer
+        return writer
+
+
+@atexit.register
+def close_writers() -> None:
+    """
+    Writes all pending records and closes the result files.
+    Called automatically when the interpreter exits.
+    """
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
 
 @sync_async_decorator
 def record_results(func, *args, **kwargs):
     """
     Decorator to record the results of a function call.
     For a function like `google_search`, the results are of the form:
-    {
-        "cache_hit": false,
-        "args": {
-            "query": "site:example.com moodle"
-        },
-        "return": [
-            "https://example.com/moodle",
-            "https://example.com/moodle2"
-        ]
-    }
-    For each run of the program, a new file is created:
-    `results/<function_name>_<timestamp>.json`
+    {"cache_hit":"miss","args":{"query":"site:example.com moodle"},"return":["https://example.com/moodle","https://example.com/moodle2"]}
+    For each run of the program, a new JSON lines file is created:
+    `results/<function_name>_<timestamp>.jsonl`
+    Records are written in the background, see `ResultWriter` and
+    `configure`.
+    The wall time and cache outcome of every call are also added to
+    `metrics.metrics`.
     """
     kwargs['cache_return_info'] = True
+    start = time.perf_counter()
     # call wrapped function
-    inner_result = yield args, kwargs
+    try:
+        inner_result = yield args, kwargs
+    except asyncio.CancelledError:
+        # e.g. another URL was positive first
+        metrics.record_call(func.__name__, time.perf_counter() - start, 'cancelled')
+        raise
+    except BaseException:
+        metrics.record_call(func.__name__, time.perf_counter() - start, 'error')
+        raise
     # print("Inner result:", inner_result)
     result, cache_hit = inner_result
-
-    if isinstance(result, BaseModel):
-        # if the result is a Pydantic model, convert it to a dict
-        result_dict = result.model_dump(mode="json")
-    else:
-        result_dict = result
+    metrics.record_call(func.__name__, time.perf_counter() - start, cache_hit)
 
     # prepare the result data
-    result_data = {
+    # (Pydantic models, also nested like the `dict[str, LMSResult]` of
+    # `scrape_url_multi`, are converted to plain JSON data)
+    result_data = to_jsonable_python({
         "cache_hit": cache_hit,
         "args": {k: v for k, v in zip(func.__code__.co_varnames, args)},
-        "return": result_dict
-    }
-
-    results_dir = "results"
-    if not os.path.exists(results_dir):
-        os.makedirs(results_dir)
-
-    # create a unique filename based on the function name and execution time
-    filename = f"{results_dir}/{func.__name__}_{record_results.init_time}.json"
+        "return": result
+    }, fallback=str)
 
-    # write the result to a file
-    with open(filename, 'a', encoding='utf-8') as f:
-        # if result_data is a Pydantic model, convert it to a dict
-        json.dump(result_data, f, ensure_ascii=False, indent=2)
-        f.write("\n")
+    get_writer(func.__name__).write(result_data)
 
     return result
 
 
 if not hasattr(record_results, 'init_time'):
-    record_results.init_time = time.strftime("%Y%m%d_%H%M%S")
\ No newline at end of file
+    record_results.init_time = time.strftime("%Y%m%d_%H%M%S")
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+
+from crawler import boilerplate as boilerplate_module
+from crawler.boilerplate import BoilerplateFilter, split_blocks
+from crawler.content_store import ContentStore, Page
+from metrics import metrics
+
+NAV = "[Startseite](/) | [Studium](/studium) | [Forschung](/forschung)"
+FOOTER = "© Universität Example · Impressum · Datenschutz"
+LMS_LINK = "[Moodle](https://moodle.uni-example.de)"
+
+
+def page(text: str) -> str:
+    return "\n\n".join([NAV, LMS_LINK, text, FOOTER])
+
+
+def keep(block: str) -> bool:
+    return "Moodle" in block
+
+
+def test_split_blocks() -> None:
+    assert split_blocks("a\nb\n\n\n  c  \n \n") == ["a\nb", "c"]
+
+
+def test_strips_blocks_common_on_host() -> None:
+    boilerplate = BoilerplateFilter(min_pages=3, min_fraction=0.5)
+    url = "https://www.uni-example.de/seite{}"
+    # not enough pages yet
+    assert boilerplate.strip(url.format(1), page("Eins"), keep) == page("Eins")
+    assert boilerplate.strip(url.format(2), page("Zwei"), keep) == page("Zwei")
+
+    metrics.counters.pop("boilerplate", None)
+    stripped = boilerplate.strip(url.format(3), page("Drei"), keep)
+    assert stripped == LMS_LINK + "\n\nDrei"
+    counters = metrics.counters["boilerplate"]
+    assert counters["blocks_removed"] == 2
+    assert counters["bytes_saved"] == len((NAV + "\n\n" + FOOTER).encode("utf-8"))
+    assert counters["tokens_saved"] > 0
+
+    # other hosts are not affected
+    other = "https://www.other.de/"
+    assert boilerplate.strip(other, page("Vier"), keep) == page("Vier")
+
+
+def test_learns_from_content_store(tmp_path) -> None:
+    store = ContentStore(str(tmp_path / "pages.sqlite"))
+    for n in range(4):
+        store.put(Page(url=f"https://www.uni-example.de/{n}", markdown=page(str(n))))
+    store.put(Page(url="https://www.other.de/", markdown=page("x")))
+    assert len(store.pages_for_host("www.uni-example.de", 10)) == 4
+
+    boilerplate = BoilerplateFilter(seed=store.pages_for_host)
+    assert boilerplate.strip("https://www.uni-example.de/neu", page("Neu")) == "Neu"
+
+
+def test_same_content_counts_once() -> None:
+    boilerplate = BoilerplateFilter(min_pages=3, min_fraction=0.5)
+    document = page("Prüfungsordnung mit allen Regeln zur Lernplattform")
+    # the same document under three URLs is not boilerplate of itself
+    for url in ("https://www.uni-example.de/po", "https://www.uni-example.de/po?download=1",
+                "https://www.uni-example.de/dokumente/po"):
+        assert boilerplate.strip(url, document, keep) == document
+
+    # the blocks it shares with other pages still are
+    boilerplate.strip("https://www.uni-example.de/a", page("A"), keep)
+    assert boilerplate.strip("https://www.uni-example.de/b", page("B"), keep) == LMS_LINK + "\n\nB"
+
+
+def test_seeds_host_in_thread(tmp_path, monkeypatch) -> None:
+    seeded = []
+
+    def seed(host, limit):
+        seeded.append((host, threading.get_ident()))
+        return [(f"https://{host}/{n}", page(str(n))) for n in range(4)]
+
+    monkeypatch.setattr(boilerplate_module, "_filter", BoilerplateFilter(seed=seed))
+    monkeypatch.setitem(boilerplate_module._settings, "enabled", True)
+
+    async def main() -> str:
+        await boilerplate_module.prepare_host("https://www.uni-example.de/neu")
+        await boilerplate_module.prepare_host("https://www.uni-example.de/noch-eine")
+        return boilerplate_module.strip_boilerplate("https://www.uni-example.de/neu", page("Neu"))
+
+    assert asyncio.run(main()) == "Neu"
+    assert [host for host, _ in seeded] == ["www.uni-example.de"]
+    assert seeded[0][1] != threading.get_ident()
@@ -1,27 +1,44 @@
 
+import asyncio
+import sqlite3
+import threading
+import time
+from datetime import timedelta
 from unittest.mock import Mock
-from cache_results import cache_results
+from cache_results import _caches, cache_results, cache_stats
+from cache_backends import LRUCache, PickleBackend, SqliteBackend, cache_key
 import os
+import pickle
 from typing import reveal_type
+from pydantic import BaseModel
 from pytest import fixture
+from cache_tool import portable_entries
 
-# fixture to delete the cache file before and after each test
+CACHE_FILES = [
+    "testfunc_square_cache.pkl",
+    "testfunc_square_cache.pkl.migrated",
+    "testfunc_square_cache.pkl.lock",
+    "testfunc_square_cache.sqlite",
+    "testfunc_square_cache.sqlite-wal",
+    "testfunc_square_cache.sqlite-shm",
+    "testfunc_square_other.sqlite",
+    "testfunc_square_other.sqlite-wal",
+    "testfunc_square_other.sqlite-shm",
+]
+
+def remove_cache_files():
+    for cache_file in CACHE_FILES:
+        try:
+            os.remove(cache_file)
+        except FileNotFoundError:
+            pass
+
+# fixture to delete the cache files before and after each test
 @fixture
 def fresh_cache():
-    cache_file = "testfunc_square_cache.pkl"
-    # delete if it exists
-    try:
-        os.remove(cache_file)
-    except FileNotFoundError:
-        pass
-
+    remove_cache_files()
     yield  # This is where the test will run
-
-    # delete the cache file after the test
-    try:
-        os.remove(cache_file)
-    except FileNotFoundError:
-        pass
+    remove_cache_files()
 
 def test_cache_results(fresh_cache) -> None:
     def testfunc_square(x):
@@ -76,4 +93,404 @@ def test_dummy_on_miss(fresh_cache) -> None:
     # Value not in the cache should return the dummy value
     assert testfunc_square(3) == 42
 
-    
\ No newline at end of file
+
+def test_cached_lookup_and_ignored_kwargs(fresh_cache) -> None:
+    calls = []
+
+    @cache_results(name="testfunc_square", ignore=("hint",))
+    def testfunc_square(x: int, hint: int | None = None) -> int:
+        calls.append(x)
+        return hint if hint is not None else x * x
+
+    try:
+        testfunc_square.cached(2)
+        assert False, "expected KeyError"
+    except KeyError:
+        pass
+    assert calls == []
+
+    # the hint is used, but not part of the key
+    assert testfunc_square(2, hint=4) == 4
+    assert testfunc_square.cached(2) == 4
+    assert testfunc_square(2) == 4
+    assert calls == [2]
+
+
+def test_not_cacheable_results(fresh_cache) -> None:
+    calls = []
+
+    @cache_results(name="testfunc_square", cacheable=lambda result: result >= 0)
+    def testfunc_square(x: int) -> int:
+        calls.append(x)
+        return -1 if x < 0 else x * x
+
+    assert testfunc_square(-2) == -1
+    assert testfunc_square(-2) == -1
+    assert testfunc_square(2) == 4
+    assert testfunc_square(2) == 4
+    assert calls == [-2, -2, 2]
+
+
+def test_cached_lookup_with_version_and_cacheable(fresh_cache) -> None:
+    def square(x: int) -> int:
+        return -1 if x < 0 else x * x
+
+    # a result stored before `cacheable` was added
+    cache_results(name="testfunc_square", version="v2")(square)(-3)
+
+    def decorated():
+        return cache_results(name="testfunc_square", version=lambda: "v2",
+                             cacheable=lambda result: result >= 0)(square)
+
+    assert decorated()(3) == 9
+    # e.g. in the next run, before any call
+    testfunc_square = decorated()
+    assert testfunc_square.cached(3) == 9
+    try:
+        testfunc_square.cached(-3)
+        assert False, "expected KeyError"
+    except KeyError:
+        pass
+
+
+def test_persists_between_decorators(fresh_cache) -> None:
+    # pylint: disable=function-redefined
+    mock = Mock(wraps=lambda x: x * x)
+    wrapped = cache_results(name="testfunc_square")(mock)
+    assert wrapped(3) == 9
+
+    mock = Mock(wraps=lambda x: x * x)
+    wrapped = cache_results(name="testfunc_square")(mock)
+    assert wrapped(3) == 9
+    mock.assert_not_called()
+
+
+def test_migrates_pickle_cache(fresh_cache) -> None:
+    # a cache file as written by the old pickle implementation
+    with open("testfunc_square_cache.pkl", "wb") as f:
+        pickle.dump({'[[5], {}]': 25}, f)
+
+    mock = Mock(wraps=lambda x: x * x)
+    wrapped = cache_results(name="testfunc_square")(mock)
+    assert wrapped(5) == 25
+    mock.assert_not_called()
+    assert not os.path.exists("testfunc_square_cache.pkl")
+    assert os.path.exists("testfunc_square_cache.pkl.migrated")
+
+
+def test_custom_backend(fresh_cache) -> None:
+    backend = PickleBackend("testfunc_square_cache.pkl")
+    mock = Mock(wraps=lambda x: x * x)
+    wrapped = cache_results(name="testfunc_square", backend=backend)(mock)
+    assert wrapped(4) == 16
+    assert wrapped(4) == 16
+    mock.assert_called_once()
+    assert not os.path.exists("testfunc_square_cache.sqlite")
+
+    with open("testfunc_square_cache.pkl", "rb") as f:
+        assert pickle.load(f) == {cache_key((4,), {})[0]: 16}
+
+
+def test_sqlite_backend(fresh_cache) -> None:
+    backend = SqliteBackend("testfunc_square_cache.sqlite")
+    backend.set("a", [1, 2])
+    backend.set_many([("b", 3), ("a", 4)])
+    assert backend.get("a") == 4
+    assert "b" in backend
+    assert "c" not in backend
+    assert len(backend) == 2
+    backend.close()
+
+
+def test_coalesces_concurrent_async_calls(fresh_cache) -> None:
+    calls = []
+
+    @cache_results(name="testfunc_square")
+    async def testfunc_square(x: int) -> int:
+        calls.append(x)
+        await asyncio.sleep(0.05)
+        return x * x
+
+    async def run():
+        return await asyncio.gather(
+            testfunc_square(2, cache_return_info=True),
+            testfunc_square(2, cache_return_info=True),
+            testfunc_square(3, cache_return_info=True),
+        )
+
+    results = asyncio.run(run())
+    assert results == [(4, 'miss'), (4, 'coalesced'), (9, 'miss')]
+    assert sorted(calls) == [2, 3]
+
+
+def test_coalesces_concurrent_sync_calls(fresh_cache) -> None:
+    calls = []
+
+    @cache_results(name="testfunc_square")
+    def testfunc_square(x: int) -> int:
+        calls.append(x)
+        time.sleep(0.05)
+        return x * x
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(testfunc_square(2)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [4, 4, 4, 4]
+    assert calls == [2]
+
+
+def test_waiters_get_exception(fresh_cache) -> None:
+    @cache_results(name="testfunc_square")
+    async def testfunc_square(x: int) -> int:
+        await asyncio.sleep(0.05)
+        raise ValueError(x)
+
+    async def run():
+        return await asyncio.gather(
+            testfunc_square(2), testfunc_square(2), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert [type(r) for r in results] == [ValueError, ValueError]
+
+
+def test_waiter_retries_when_first_call_is_cancelled(fresh_cache) -> None:
+    calls = []
+
+    @cache_results(name="testfunc_square")
+    async def testfunc_square(x: int) -> int:
+        calls.append(x)
+        await asyncio.sleep(0.05)
+        return x * x
+
+    async def run():
+        first = asyncio.create_task(testfunc_square(2))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(testfunc_square(2))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == 4
+    assert calls == [2, 2]
+
+
+def test_lru_cache_bounds() -> None:
+    lru = LRUCache(max_entries=2, max_bytes=1000)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)  # evicts b, the least recently used
+    assert lru.get("a") == 1
+    assert lru.get("c") == 3
+    try:
+        lru.get("b")
+        assert False, "b should have been evicted"
+    except KeyError:
+        pass
+    assert lru.stats.as_dict() == {"hits": 3, "misses": 1, "evictions": 1}
+
+    lru = LRUCache(max_entries=100, max_bytes=300)
+    lru.set("a", "x" * 200)
+    lru.set("b", "y" * 200)
+    assert len(lru) == 1
+    assert lru.size_bytes <= 300
+    lru.set("c", "z" * 1000)  # larger than the whole cache, not stored
+    assert len(lru) == 1
+
+
+def test_memory_tier_stats(fresh_cache) -> None:
+    mock = Mock(wraps=lambda x: x * x)
+    wrapped = cache_results(name="testfunc_square")(mock)
+    before = cache_stats().get("testfunc_square", {})
+    wrapped(2)
+    wrapped(2)
+    wrapped(2)
+    stats = cache_stats()["testfunc_square"]
+    memory_hits = stats["memory"]["hits"] - before.get("memory", {}).get("hits", 0)
+    disk_misses = stats["disk"]["misses"] - before.get("disk", {}).get("misses", 0)
+    assert memory_hits == 2
+    assert disk_misses == 1
+    mock.assert_called_once()
+
+
+def test_memory_tier_invalidated_by_other_writer(fresh_cache) -> None:
+    backend = SqliteBackend("testfunc_square_cache.sqlite")
+    wrapped = cache_results(name="testfunc_square", backend=backend)(lambda x: x * x)
+    assert wrapped(2) == 4
+
+    # another process overwrites the entry
+    other = SqliteBackend("testfunc_square_cache.sqlite")
+    other.set(cache_key((2,), {})[0], 5)
+    other.close()
+
+    assert wrapped(2) == 5
+    backend.close()
+
+
+def test_ttl(fresh_cache) -> None:
+    mock = Mock(wraps=lambda x: x * x)
+    wrapped = cache_results(name="testfunc_square", ttl=timedelta(seconds=0.1))(mock)
+    assert wrapped(2) == 4
+    assert wrapped(2) == 4
+    assert mock.call_count == 1
+    time.sleep(0.15)
+    assert wrapped(2) == 4
+    assert mock.call_count == 2
+
+
+def test_max_entries_lru(fresh_cache) -> None:
+    backend = SqliteBackend("testfunc_square_cache.sqlite", max_entries=2)
+    backend.set("a", 1)
+    backend.set("b", 2)
+    backend.get("a")
+    backend.set("c", 3)
+    assert len(backend) == 2
+    assert "b" not in backend
+    assert backend.evictions == 1
+    backend.close()
+
+
+def test_max_entries_lfu(fresh_cache) -> None:
+    backend = SqliteBackend("testfunc_square_cache.sqlite", max_entries=2, eviction="lfu")
+    backend.set("a", 1)
+    backend.set("b", 2)
+    backend.get("a")
+    backend.get("a")
+    backend.get("b")
+    backend.set("c", 3)
+    # c has no hits yet, so it goes first
+    assert "a" in backend
+    assert "c" not in backend
+    backend.close()
+
+
+def test_compact_uses_saved_policy(fresh_cache) -> None:
+    backend = SqliteBackend("testfunc_square_cache.sqlite", ttl=60)
+    backend.set_many([("old", 1)], created_at=time.time() - 120)
+    backend.set("new", 2)
+    backend.close()
+
+    offline = SqliteBackend("testfunc_square_cache.sqlite", load_policy=True)
+    assert offline.compact() == 1
+    assert [key for key, _ in offline.items()] == ["new"]
+    offline.close()
+
+
+def test_upgrades_old_schema(fresh_cache) -> None:
+    conn = sqlite3.connect("testfunc_square_cache.sqlite")
+    conn.execute("CREATE TABLE cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+    conn.execute("INSERT INTO cache VALUES (?, ?)", ('[["a"], {}]', pickle.dumps(1)))
+    conn.commit()
+    conn.close()
+
+    backend = SqliteBackend("testfunc_square_cache.sqlite", max_entries=10)
+    assert backend.get(cache_key(["a"], {})[0]) == 1
+    backend.close()
+
+
+def test_cache_key() -> None:
+    key, encoded = cache_key(("https://example.com",), {"prompt_template": "x" * 1000})
+    assert len(key) == 32
+    assert encoded == '[["https://example.com"],{"prompt_template":"%s"}]' % ("x" * 1000)
+    # keyword order does not matter
+    assert cache_key((), {"a": 1, "b": 2}) == cache_key((), {"b": 2, "a": 1})
+    assert cache_key((1,), {}, version="2")[0] != cache_key((1,), {})[0]
+
+
+def test_stores_readable_args(fresh_cache) -> None:
+    wrapped = cache_results(name="testfunc_square")(lambda x: x * x)
+    wrapped(7)
+    conn = sqlite3.connect("testfunc_square_cache.sqlite")
+    assert conn.execute("SELECT args FROM cache").fetchall() == [("[[7],{}]",)]
+    conn.close()
+
+
+def test_version_invalidates_entries(fresh_cache) -> None:
+    mock = Mock(wraps=lambda x: x * x)
+    cache_results(name="testfunc_square", version="1")(mock)(2)
+    cache_results(name="testfunc_square", version="1")(mock)(2)
+    assert mock.call_count == 1
+    cache_results(name="testfunc_square", version=lambda: "2")(mock)(2)
+    assert mock.call_count == 2
+
+    offline = SqliteBackend("testfunc_square_cache.sqlite", load_policy=True)
+    assert offline.version == "2"
+    assert offline.compact() == 1
+    assert len(offline) == 1
+    offline.close()
+
+
+class Square(BaseModel):
+    value: int
+
+
+def test_stores_annotated_results_as_json(fresh_cache) -> None:
+    @cache_results(name="testfunc_square", memory_entries=0)
+    def testfunc_square(x: int) -> Square:
+        return Square(value=x * x)
+
+    assert testfunc_square(3) == Square(value=9)
+    assert testfunc_square(3) == Square(value=9)
+
+    conn = sqlite3.connect("testfunc_square_cache.sqlite")
+    assert conn.execute("SELECT value, encoding FROM cache").fetchall() == [
+        (b'{"value": 9}', "json")]
+    conn.close()
+
+
+def test_merge_newest_wins(fresh_cache) -> None:
+    ours = SqliteBackend("testfunc_square_cache.sqlite")
+    ours.set_many([("a", 1, "[[1],{}]", "json")], created_at=100)
+    ours.set_many([("b", 2, "[[2],{}]", "json")], created_at=300)
+
+    theirs = SqliteBackend("testfunc_square_other.sqlite")
+    theirs.set_many([("a", 10, "[[1],{}]", "json")], created_at=200)
+    theirs.set_many([("b", 20, "[[2],{}]", "json")], created_at=200)
+    # pickled by an older version, converted on export
+    theirs.set_many([("c", Square(value=30), "[[3],{}]")], created_at=200)
+    theirs.close()
+
+    counts = ours.merge(portable_entries("testfunc_square_other.sqlite"))
+    assert counts == {"added": 1, "replaced": 1, "skipped": 1}
+    assert dict(ours.items()) == {"a": 10, "b": 2, "c": {"value": 30}}
+    ours.close()
+
+
+def test_memory_tier_kept_across_threads(fresh_cache) -> None:
+    backend = SqliteBackend("testfunc_square_cache.sqlite", max_entries=1000)
+    mock = Mock(wraps=lambda x: x * x)
+    wrapped = cache_results(name="testfunc_square", backend=backend)(mock)
+    for x in range(5):
+        wrapped(x)
+    cache = next(cache for cache in _caches if cache.backend is backend)
+    cache.memory.clear = Mock(wraps=cache.memory.clear)
+
+    # new threads open their own connections, read (which updates the
+    # access times) and write new entries
+    threads = [threading.Thread(target=lambda n=n: [wrapped(x) for x in range(5 + n)])
+               for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    cache.memory.clear.assert_not_called()
+    assert mock.call_count == 8
+    disk_hits = cache.disk_stats.hits
+    assert [wrapped(x) for x in range(8)] == [x * x for x in range(8)]
+    # all served from memory
+    assert cache.disk_stats.hits == disk_hits
+
+    # a write by another process still clears the memory tier
+    other = SqliteBackend("testfunc_square_cache.sqlite")
+    other.set(cache_key((2,), {})[0], 5)
+    other.close()
+    assert wrapped(2) == 5
+    backend.close()
@@ -0,0 +1,45 @@
+import time
+
+from crawler.content_store import ContentStore, Page, normalize_url
+
+
+def test_normalize_url() -> None:
+    assert (normalize_url("HTTPS://Www.Uni-Example.DE:443/lehre?b=2&a=1&utm_source=x#top")
+            == "https://www.uni-example.de/lehre?a=1&b=2")
+    assert normalize_url("http://example.de") == "http://example.de/"
+    assert normalize_url("http://example.de:8080/x") == "http://example.de:8080/x"
+
+
+def test_store_and_lookup(tmp_path) -> None:
+    store = ContentStore(str(tmp_path / "pages.sqlite"))
+    assert store.get("https://example.de/moodle") is None
+
+    store.put(Page(url="https://example.de/moodle#login", markdown="# Moodle ä",
+                   status_code=200, headers={"content-type": "text/html"}))
+    page = store.get("https://EXAMPLE.de/moodle")
+    assert page is not None
+    assert page.markdown == "# Moodle ä"
+    assert page.status_code == 200
+    assert page.headers == {"content-type": "text/html"}
+    assert page.fetched_at is not None
+
+
+def test_content_is_shared_and_replaced(tmp_path) -> None:
+    store = ContentStore(str(tmp_path / "pages.sqlite"))
+    store.put(Page(url="https://example.de/a", markdown="same"))
+    store.put(Page(url="https://example.de/b", markdown="same"))
+    conn = store._conn()  # pylint: disable=protected-access
+    assert conn.execute("SELECT COUNT(*) FROM content").fetchone()[0] == 1
+
+    store.put(Page(url="https://example.de/a", markdown="new"))
+    store.put(Page(url="https://example.de/b", markdown="new"))
+    assert conn.execute("SELECT COUNT(*) FROM content").fetchone()[0] == 1
+    assert len(store) == 2
+
+
+def test_max_age(tmp_path) -> None:
+    store = ContentStore(str(tmp_path / "pages.sqlite"), max_age=60)
+    store.put(Page(url="https://example.de/old", markdown="x", fetched_at=time.time() - 120))
+    store.put(Page(url="https://example.de/new", markdown="y"))
+    assert store.get("https://example.de/old") is None
+    assert store.get("https://example.de/new") is not None
@@ -0,0 +1,275 @@
+import json
+import threading
+from typing import Any
+from unittest.mock import Mock
+
+import pytest
+
+pytest.importorskip("crawl4ai")
+
+from crawl4ai import LLMConfig  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import crawl4ai_helpers  # noqa: E402
+from cache_backends import LRUCache, SqliteBackend  # noqa: E402
+from cache_results import TieredCache, cache_stats  # noqa: E402
+from crawl4ai_helpers import ChunkLimitedLLMExtractionStrategy  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+SCHEMA = {
+    "type": "object",
+    "properties": {"software_usage_found": {"type": "boolean"}},
+    "required": ["software_usage_found"],
+}
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    """
+    Replaces the LLM call: chunks containing "ja" are positive, chunks
+    containing "kaputt" raise. Returns the list of (chunk, thread) calls.
+    """
+    calls = []
+
+    def extract(self, url, ix, html):
+        calls.append((html, threading.get_ident()))
+        if "kaputt" in html:
+            raise RuntimeError("LLM not reachable")
+        return [{"software_usage_found": "ja" in html, "error": False}]
+
+    monkeypatch.setattr(crawl4ai_helpers.LLMExtractionStrategy, "extract", extract)
+    crawl4ai_helpers.configure_batching(batch_size=1)
+    yield calls
+    crawl4ai_helpers.configure_batching(batch_size=4)
+
+
+def make_strategy(provider: str = "openai/test", **kwargs) -> ChunkLimitedLLMExtractionStrategy:
+    strategy = ChunkLimitedLLMExtractionStrategy(
+        llm_config=LLMConfig(provider=provider, api_token="test"),
+        schema=SCHEMA, extraction_type="schema", instruction="Wird Moodle genutzt?", **kwargs)
+    # one chunk per section
+    strategy._merge = lambda documents, *args, **kwargs: list(documents)
+    return strategy
+
+
+def test_cache_is_used_from_calling_thread(llm) -> None:
+    cache = Mock()
+    cache.get.side_effect = KeyError
+    strategy = make_strategy(cache=cache, stop_when=None)
+    strategy.run("https://www.uni-example.de", ["nein eins", "ja zwei", "nein drei"])
+
+    assert len(llm) == 3
+    # the LLM calls run in the executor, the cache is only used here
+    assert all(thread != threading.get_ident() for _, thread in llm)
+    assert cache.set.call_count == 3
+
+    stored = {args[0]: args[1] for args, _ in cache.set.call_args_list}
+    cache.get.side_effect = stored.__getitem__
+    blocks = make_strategy(cache=cache, stop_when=None).run(
+        "https://www.uni-example.de/kopie", ["nein eins", "ja zwei", "nein drei"])
+    assert len(llm) == 3
+    assert [block["software_usage_found"] for block in blocks] == [False, True, False]
+
+
+def test_stops_after_first_positive_wave(llm) -> None:
+    strategy = make_strategy(wave_size=2)
+    blocks = strategy.run("https://www.uni-example.de", ["nein", "nein", "ja", "nein", "nein"])
+
+    assert strategy.evaluated_chunks == 4
+    assert strategy.skipped_chunks == [4]
+    assert sorted(html for html, _ in llm) == ["ja", "nein", "nein", "nein"]
+    assert [block["software_usage_found"] for block in blocks] == [False, False, True, False]
+
+
+def test_without_stop_when_evaluates_all_chunks(llm) -> None:
+    strategy = make_strategy(wave_size=2, stop_when=None)
+    blocks = strategy.run("https://www.uni-example.de", ["ja", "nein", "ja", "nein", "nein"])
+
+    assert strategy.evaluated_chunks == 5
+    assert strategy.skipped_chunks == []
+    assert len(llm) == 5
+    assert len(blocks) == 5
+
+
+def test_groq_one_request_at_a_time(llm, monkeypatch) -> None:
+    running = []
+    max_running = 0
+    extract = crawl4ai_helpers.LLMExtractionStrategy.extract
+
+    def counting_extract(self, url, ix, html):
+        nonlocal max_running
+        running.append(ix)
+        max_running = max(max_running, len(running))
+        try:
+            threading.Event().wait(0.01)
+            return extract(self, url, ix, html)
+        finally:
+            running.remove(ix)
+
+    sleeps = []
+    monkeypatch.setattr(crawl4ai_helpers.LLMExtractionStrategy, "extract", counting_extract)
+    monkeypatch.setattr(crawl4ai_helpers.time, "sleep", sleeps.append)
+    strategy = make_strategy(provider="groq/test", wave_size=4, stop_when=None)
+    strategy.run("https://www.uni-example.de", ["nein"] * 4)
+
+    assert max_running == 1
+    assert len(llm) == 4
+    assert sleeps == [0.5] * 4
+
+
+def test_failed_chunk_becomes_error_block(llm) -> None:
+    cache = Mock()
+    cache.get.side_effect = KeyError
+    strategy = make_strategy(cache=cache, wave_size=2, stop_when=None)
+    blocks = strategy.run("https://www.uni-example.de", ["nein", "kaputt", "ja"])
+
+    assert strategy.evaluated_chunks == 3
+    assert blocks[1] == {"index": 1, "error": True, "tags": ["error"],
+                         "content": "LLM not reachable"}
+    assert [block["software_usage_found"] for block in (blocks[0], blocks[2])] == [False, True]
+    # the error is not cached
+    assert cache.set.call_count == 2
+
+
+def test_sqlite_connections_only_in_calling_thread(llm, tmp_path) -> None:
+    backend = SqliteBackend(str(tmp_path / "chunks.sqlite"))
+    cache = TieredCache("llm_chunk", backend, LRUCache(100, 1024 * 1024),
+                        TypeAdapter(list[dict[str, Any]]))
+    threads = set()
+    connect = backend._conn
+
+    def recording_conn():
+        threads.add(threading.get_ident())
+        return connect()
+
+    backend._conn = recording_conn
+    sections = ["nein eins", "nein zwei", "ja drei", "nein vier"]
+    make_strategy(cache=cache, stop_when=None).run("https://www.uni-example.de", sections)
+    make_strategy(cache=cache, stop_when=None).run("https://www.uni-example.de/kopie", sections)
+
+    assert len(llm) == 4
+    assert threads == {threading.get_ident()}
+    backend.close()
+
+
+def test_deprecated_arguments_are_rejected() -> None:
+    strategy = make_strategy(max_chunks=3)
+    assert strategy.max_chunks == 3
+    assert strategy.llm_config.provider == "openai/test"
+    with pytest.raises(AttributeError, match="deprecated"):
+        strategy.provider = "openai/other"
+
+
+def test_stops_between_waves_when_stop_event_is_set(llm, monkeypatch) -> None:
+    stop = threading.Event()
+    extract = crawl4ai_helpers.LLMExtractionStrategy.extract
+
+    def stopping_extract(self, url, ix, html):
+        # the caller is cancelled while the first wave runs
+        stop.set()
+        return extract(self, url, ix, html)
+
+    monkeypatch.setattr(crawl4ai_helpers.LLMExtractionStrategy, "extract", stopping_extract)
+    strategy = make_strategy(wave_size=2, stop_when=None, stop_event=stop)
+    blocks = strategy.run("https://www.uni-example.de", ["nein"] * 5)
+
+    assert len(blocks) == 2
+    assert strategy.evaluated_chunks == 2
+    assert strategy.skipped_chunks == [2, 3, 4]
+
+
+def test_chunk_cache_in_cache_stats(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(crawl4ai_helpers, "_chunk_cache", None)
+    cache = crawl4ai_helpers.chunk_cache()
+    assert crawl4ai_helpers.chunk_cache() is cache
+    assert "llm_chunk" in cache_stats()
+    cache.backend.close()
+
+
+BATCH = [f"https://www.uni-example.de/seite{i}" for i in range(3)]
+
+
+@pytest.fixture
+def completion(monkeypatch):
+    """
+    Replaces the batched LLM call: answers with the JSON `blocks`, or raises
+    if `blocks` is an exception. Returns the list of prompts.
+    """
+    prompts = []
+    answer: dict[str, Any] = {"blocks": []}
+
+    def perform_completion_with_backoff(provider, prompt, api_token, **kwargs):
+        prompts.append(prompt)
+        if isinstance(answer["blocks"], Exception):
+            raise answer["blocks"]
+        content = f"<blocks>{json.dumps(answer['blocks'])}</blocks>"
+        return Mock(choices=[Mock(message=Mock(content=content))])
+
+    monkeypatch.setattr(crawl4ai_helpers, "perform_completion_with_backoff",
+                        perform_completion_with_backoff)
+
+    def install(blocks) -> list[str]:
+        answer["blocks"] = blocks
+        return prompts
+    return install
+
+
+def send_batch(strategy: ChunkLimitedLLMExtractionStrategy) -> list:
+    return crawl4ai_helpers._send_batch(
+        None, [(strategy, url, 0, f"Inhalt von Seite {i}") for i, url in enumerate(BATCH)])
+
+
+def test_batch_answers_reach_their_items(completion) -> None:
+    prompts = completion([
+        {"item": 2, "software_usage_found": True},
+        {"item": 1, "software_usage_found": False},
+        {"item": 3, "software_usage_found": False},
+    ])
+    results = send_batch(make_strategy())
+
+    [prompt] = prompts
+    for number, url in enumerate(BATCH, start=1):
+        item = prompt.split(f'<item number="{number}">')[1].split("</item>")[0]
+        assert url in item
+        assert f"Inhalt von Seite {number - 1}" in item
+        assert "Wird Moodle genutzt?" in item
+    assert '"item"' in prompt.split("<schema_block>")[1]
+    assert results == [[{"software_usage_found": found, "error": False}]
+                       for found in (False, True, False)]
+
+
+def test_missing_answers_are_resent_in_parallel(completion, monkeypatch) -> None:
+    completion([{"item": 1, "software_usage_found": True}])
+    # waits until both missing chunks are being resent
+    barrier = threading.Barrier(2, timeout=5)
+
+    def extract(self, url, ix, html):
+        barrier.wait()
+        if url == BATCH[2]:
+            raise RuntimeError("LLM not reachable")
+        return [{"software_usage_found": False, "error": False}]
+
+    monkeypatch.setattr(crawl4ai_helpers.LLMExtractionStrategy, "extract", extract)
+    resent = metrics.counters.get("llm_batches", {}).get("resent", 0)
+    results = send_batch(make_strategy())
+
+    assert results[:2] == [[{"software_usage_found": True, "error": False}],
+                           [{"software_usage_found": False, "error": False}]]
+    # only the failed chunk gets the error
+    assert isinstance(results[2], RuntimeError)
+    assert metrics.counters["llm_batches"]["resent"] == resent + 2
+
+
+def test_failed_batch_is_resent_in_parallel(completion, monkeypatch) -> None:
+    completion(RuntimeError("invalid JSON"))
+    barrier = threading.Barrier(3, timeout=5)
+
+    def extract(self, url, ix, html):
+        barrier.wait()
+        return [{"software_usage_found": url == BATCH[1], "error": False}]
+
+    monkeypatch.setattr(crawl4ai_helpers.LLMExtractionStrategy, "extract", extract)
+    results = send_batch(make_strategy())
+
+    assert [blocks[0]["software_usage_found"] for blocks in results] == [False, True, False]
@@ -0,0 +1,112 @@
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("crawl4ai")
+
+from crawler import crawler_pool  # noqa: E402
+from crawler.crawler_pool import CrawlerPool, memory_usage_mb  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+
+class FakeCrawler:
+    """
+    Starts a child process, like the Playwright driver of a real crawler,
+    unless `spawn` is False.
+    """
+
+    def __init__(self, spawn: bool = True):
+        self.spawn = spawn
+        self.process: subprocess.Popen | None = None
+        self.closed = False
+
+    async def start(self) -> None:
+        await asyncio.sleep(0.01)
+        if self.spawn:
+            self.process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+
+    async def close(self) -> None:
+        self.closed = True
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+
+
+def use_pool(pool: CrawlerPool, pages: int) -> list[object]:
+    """
+    Loads `pages` pages one after another, returns the crawler of each.
+    """
+    async def main() -> list[object]:
+        used = []
+        try:
+            for _ in range(pages):
+                async with pool.crawler() as crawler:
+                    used.append(crawler)
+        finally:
+            await pool.close()
+        return used
+
+    return asyncio.run(main())
+
+
+def test_slots_measure_their_own_processes() -> None:
+    crawlers: list[FakeCrawler] = []
+
+    def factory() -> FakeCrawler:
+        crawlers.append(FakeCrawler())
+        return crawlers[-1]
+
+    async def main() -> list[list[int]]:
+        pool = CrawlerPool("html", 2, factory, max_memory_mb=1024)  # type: ignore
+        entered = asyncio.Barrier(2)
+
+        async def use() -> None:
+            async with pool.crawler():
+                await entered.wait()
+
+        try:
+            await asyncio.gather(use(), use())
+            return [[process.pid for process in slot.processes] for slot in pool._slots]
+        finally:
+            await pool.close()
+
+    pids = asyncio.run(main())
+    assert sorted(pids) == sorted([crawler.process.pid] for crawler in crawlers)
+    assert memory_usage_mb([]) == 0
+
+
+def test_recycles_after_max_pages(monkeypatch) -> None:
+    monkeypatch.setattr(metrics, "counters", {})
+    crawlers: list[FakeCrawler] = []
+
+    def factory() -> FakeCrawler:
+        crawlers.append(FakeCrawler(spawn=False))
+        return crawlers[-1]
+
+    used = use_pool(CrawlerPool("html", 1, factory, max_pages=2), 5)  # type: ignore
+
+    assert used == [crawlers[0]] * 2 + [crawlers[1]] * 2 + [crawlers[2]]
+    assert all(crawler.closed for crawler in crawlers)
+    assert metrics.counters["crawler_pool:html"] == {"started": 3, "recycled_pages": 2}
+
+
+def test_recycles_on_memory_growth(monkeypatch) -> None:
+    monkeypatch.setattr(metrics, "counters", {})
+    # the memory of the slot's browser: at its start, then before each page
+    readings = iter([500.0, 700.0, 1400.0, 1600.0, 500.0])
+    monkeypatch.setattr(crawler_pool, "memory_usage_mb", lambda processes: next(readings))
+    crawlers: list[FakeCrawler] = []
+
+    def factory() -> FakeCrawler:
+        crawlers.append(FakeCrawler(spawn=False))
+        return crawlers[-1]
+
+    used = use_pool(CrawlerPool("html", 1, factory, max_memory_mb=1000), 4)  # type: ignore
+
+    # grown by 900 MB before page 3 is still below the limit,
+    # by 1100 MB before page 4 is not
+    assert used == [crawlers[0]] * 3 + [crawlers[1]]
+    assert crawlers[0].closed
+    assert metrics.counters["crawler_pool:html"] == {"started": 2, "recycled_memory": 1}
@@ -0,0 +1,262 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("crawl4ai")
+
+import handwritten_crawler  # noqa: E402
+from crawler.scraper import LMSResult  # noqa: E402
+from progress import ProgressIndex  # noqa: E402
+
+URLS = [f"https://www.uni-example.de/seite{i}" for i in range(5)]
+
+
+class FakeScraper:
+    """
+    Replaces `scrape_url`: the URL with index i takes `delays[i]` seconds,
+    and is positive if i is in `positives`.
+    """
+
+    def __init__(self, delays: list[float], positives: set[int] = frozenset()):
+        self.delays = delays
+        self.positives = positives
+        self.started: list[int] = []
+        self.cancelled: list[int] = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, url, prompt_template, arguments, skip_cache=False) -> LMSResult:
+        index = URLS.index(url)
+        self.started.append(index)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delays[index])
+        except asyncio.CancelledError:
+            self.cancelled.append(index)
+            raise
+        finally:
+            self.running -= 1
+        return LMSResult(reasoning=f"Seite {index}", software_usage_found=index in self.positives)
+
+
+@pytest.fixture
+def scraper(monkeypatch):
+    def install(delays: list[float], positives: set[int] = frozenset()) -> FakeScraper:
+        fake = FakeScraper(delays, positives)
+        monkeypatch.setattr(handwritten_crawler, "google_search", lambda query, skip_cache=False: URLS)
+        monkeypatch.setattr(handwritten_crawler, "scrape_url", fake)
+        return fake
+    return install
+
+
+def process(mode: str, max_parallel: int = 5) -> dict:
+    return asyncio.run(handwritten_crawler.process_combo(
+        "uni-example.de", "Universität Example", "Moodle", "{software}",
+        mode=mode, max_parallel=max_parallel))  # type: ignore
+
+
+def test_first_positive_cancels_the_others(scraper) -> None:
+    fake = scraper([0.2, 0.01, 2, 2, 2], positives={1})
+    record = process("first-positive")
+
+    assert record["usage_found"] is True
+    assert sorted(fake.started) == [0, 1, 2, 3, 4]
+    assert sorted(fake.cancelled) == [0, 2, 3, 4]
+    # only completed evaluations are recorded
+    assert record["reasoning"]["inputs"] == [{"url": URLS[1], "reasoning": "Seite 1"}]
+
+
+def test_inputs_in_url_order(scraper) -> None:
+    # the last URL finishes first
+    fake = scraper([0.05, 0.04, 0.03, 0.02, 0.01])
+    record = process("all")
+
+    assert fake.cancelled == []
+    assert record["usage_found"] is False
+    assert [item["url"] for item in record["reasoning"]["inputs"]] == URLS
+
+
+def test_all_does_not_cancel(scraper) -> None:
+    fake = scraper([0.01, 0.02, 0.03, 0.04, 0.05], positives={0})
+    record = process("all")
+
+    assert fake.cancelled == []
+    assert record["usage_found"] is True
+    assert len(record["reasoning"]["inputs"]) == 5
+
+
+def test_max_parallel(scraper) -> None:
+    fake = scraper([0.02] * 5)
+    process("first-positive", max_parallel=2)
+
+    assert fake.max_running == 2
+    assert sorted(fake.started) == [0, 1, 2, 3, 4]
+
+
+def test_sequential_stops_at_first_positive(scraper) -> None:
+    fake = scraper([0.0] * 5, positives={2})
+    record = process("sequential")
+
+    assert fake.started == [0, 1, 2]
+    assert fake.max_running == 1
+    assert record["usage_found"] is True
+
+
+MULTI_URLS = {
+    "Moodle": [f"https://www.uni-example.de/moodle{i}" for i in range(3)],
+    "Ilias": [f"https://www.uni-example.de/ilias{i}" for i in range(3)],
+}
+
+
+class FakeMultiScraper:
+    """
+    Replaces `scrape_url_multi`: `delays[url]` seconds per URL, which is
+    positive for the software in `positives[url]`.
+    """
+
+    def __init__(self, delays: dict[str, float], positives: dict[str, set[str]]):
+        self.delays = delays
+        self.positives = positives
+        self.started: list[str] = []
+        self.cancelled: list[str] = []
+
+    async def __call__(self, url, prompt_template, arguments, software, skip_cache=False) -> dict[str, LMSResult]:
+        self.started.append(url)
+        try:
+            await asyncio.sleep(self.delays.get(url, 0.0))
+        except asyncio.CancelledError:
+            self.cancelled.append(url)
+            raise
+        return {name: LMSResult(reasoning=f"{name} auf {url}",
+                                software_usage_found=name in self.positives.get(url, set()))
+                for name in software}
+
+
+@pytest.fixture
+def multi_scraper(monkeypatch):
+    def install(delays: dict[str, float], positives: dict[str, set[str]]) -> FakeMultiScraper:
+        fake = FakeMultiScraper(delays, positives)
+        monkeypatch.setattr(handwritten_crawler, "google_search",
+                            lambda query, skip_cache=False: MULTI_URLS[query.split()[-1]])
+        monkeypatch.setattr(handwritten_crawler, "scrape_url_multi", fake)
+        return fake
+    return install
+
+
+def process_institution(mode: str) -> list[dict]:
+    return asyncio.run(handwritten_crawler.process_institution(
+        "uni-example.de", "Universität Example", ["Moodle", "Ilias"], "{software}",
+        mode=mode))  # type: ignore
+
+
+def test_institution_records_per_software(multi_scraper) -> None:
+    moodle, ilias = MULTI_URLS["Moodle"], MULTI_URLS["Ilias"]
+    fake = multi_scraper({}, {moodle[1]: {"Moodle"}})
+    records = process_institution("sequential")
+
+    assert [record["software"] for record in records] == ["Moodle", "Ilias"]
+    moodle_record, ilias_record = records
+    assert moodle_record["usage_found"] is True
+    assert [item["url"] for item in moodle_record["reasoning"]["inputs"]] == moodle[:2]
+    assert ilias_record["usage_found"] is False
+    assert [item["url"] for item in ilias_record["reasoning"]["inputs"]] == ilias
+    # Moodle is found after the second rank, its last URL is skipped
+    assert fake.started == [moodle[0], ilias[0], moodle[1], ilias[1], ilias[2]]
+
+
+def test_institution_cancels_when_all_found(multi_scraper) -> None:
+    moodle, ilias = MULTI_URLS["Moodle"], MULTI_URLS["Ilias"]
+    delays = {url: 2.0 for url in moodle + ilias}
+    delays.update({moodle[0]: 0.01, ilias[1]: 0.02})
+    fake = multi_scraper(delays, {moodle[0]: {"Moodle"}, ilias[1]: {"Ilias"}})
+    records = process_institution("first-positive")
+
+    assert all(record["usage_found"] for record in records)
+    assert sorted(fake.cancelled) == sorted(set(moodle + ilias) - {moodle[0], ilias[1]})
+
+
+def test_institution_all_does_not_cancel(multi_scraper) -> None:
+    moodle, ilias = MULTI_URLS["Moodle"], MULTI_URLS["Ilias"]
+    fake = multi_scraper({url: 0.01 for url in moodle + ilias},
+                         {moodle[0]: {"Moodle"}, ilias[0]: {"Ilias"}})
+    records = process_institution("all")
+
+    assert fake.cancelled == []
+    assert all(len(record["reasoning"]["inputs"]) == 3 for record in records)
+
+
+UNIS = [{"website": f"uni{i}.example.de", "name": f"Uni {i}"} for i in range(4)]
+
+
+class FakeCombos:
+    """
+    Replaces `process_combo`: every combination takes `delay` seconds.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.started: list[tuple[str, str]] = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, site, einrichtung, software, prompt_template,
+                       mode="sequential", max_parallel=5) -> dict:
+        self.started.append((einrichtung, software))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        return {"einrichtung": einrichtung, "software": software, "usage_found": False}
+
+
+@pytest.fixture
+def combos(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(handwritten_crawler, "read_universities", lambda filename: UNIS)
+
+    def install(delay: float = 0.01) -> FakeCombos:
+        fake = FakeCombos(delay)
+        monkeypatch.setattr(handwritten_crawler, "process_combo", fake)
+        return fake
+    return install
+
+
+def test_main_resumes_with_bounded_concurrency(combos) -> None:
+    progress = ProgressIndex("results_new.jsonlines")
+    done = [("Uni 0", "Moodle"), ("Uni 0", "Ilias"), ("Uni 2", "OpenOLAT")]
+    for einrichtung, software in done:
+        progress.append({"einrichtung": einrichtung, "software": software})
+    fake = combos()
+    asyncio.run(asyncio.wait_for(handwritten_crawler.main(concurrency=3), 5))
+
+    # the combinations of the earlier run are not processed again
+    assert len(fake.started) == 4 * 3 - len(done)
+    assert not set(done) & set(fake.started)
+    assert fake.max_running == 3
+    assert ProgressIndex("results_new.jsonlines").load() == {
+        (uni["name"], software) for uni in UNIS for software in ["Moodle", "Ilias", "OpenOLAT"]}
+
+
+def test_main_resumes_after_cancelling(combos) -> None:
+    fake = combos()
+
+    async def cancel_run() -> None:
+        task = asyncio.create_task(handwritten_crawler.main(concurrency=2))
+        while len(fake.started) < 5:
+            await asyncio.sleep(0.001)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(asyncio.wait_for(cancel_run(), 5))
+    done = ProgressIndex("results_new.jsonlines").load()
+    # the running combinations are not recorded
+    assert len(done) < len(fake.started)
+
+    fake = combos()
+    asyncio.run(asyncio.wait_for(handwritten_crawler.main(concurrency=2), 5))
+    assert not done & set(fake.started)
+    assert len(done) + len(fake.started) == 4 * 3
@@ -0,0 +1,59 @@
+import asyncio
+
+import httpx
+import pytest
+
+pytest.importorskip("crawl4ai")
+
+from crawler import http_fetch  # noqa: E402
+
+URL = "https://www.uni-example.de/lernplattform"
+TEXT = " ".join(["Lernplattform"] * 60)
+
+
+def markdown(url: str, html: str) -> str:
+    return html.removeprefix("<html><body>").removesuffix("</body></html>")
+
+
+@pytest.fixture
+def respond(monkeypatch):
+    """
+    Answers the requests of `http_fetch` with the given response, and
+    converts HTML by removing the outer tags.
+    """
+    monkeypatch.setattr(http_fetch, "html_to_markdown", markdown)
+
+    def install(response: httpx.Response | Exception) -> None:
+        def handler(request: httpx.Request) -> httpx.Response:
+            if isinstance(response, Exception):
+                raise response
+            return response
+        monkeypatch.setattr(http_fetch, "_client",
+                            httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return install
+
+
+def html(body: str) -> httpx.Response:
+    return httpx.Response(200, headers={"content-type": "text/html; charset=utf-8"},
+                          text=f"<html><body>{body}</body></html>")
+
+
+def test_html_page(respond) -> None:
+    respond(html(TEXT))
+    page, reason = asyncio.run(http_fetch.fetch(URL))
+
+    assert reason == "ok"
+    assert page is not None and page.markdown == TEXT
+    assert page.status_code == 200 and not page.is_pdf
+
+
+@pytest.mark.parametrize("response, reason", [
+    (httpx.Response(404, text="Nicht gefunden"), "status_404"),
+    (httpx.ConnectError("Connection refused"), "http_error"),
+    (httpx.Response(200, headers={"content-type": "image/png"}, content=b"\x89PNG"), "not_html"),
+    (html('<noscript>Bitte JavaScript aktivieren</noscript><div id="root"></div>'), "javascript"),
+    (html("Willkommen"), "too_little_text"),
+])
+def test_needs_browser(respond, response, reason) -> None:
+    respond(response)
+    assert asyncio.run(http_fetch.fetch(URL)) == (None, reason)
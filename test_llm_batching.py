@@ -0,0 +1,75 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from llm_batching import BatchDispatcher, numbered_items
+
+
+def test_batches_concurrent_requests() -> None:
+    batches = []
+    lock = threading.Lock()
+
+    def send(key, requests):
+        with lock:
+            batches.append((key, list(requests)))
+        return [f"{key}:{request}" for request in requests]
+
+    dispatcher = BatchDispatcher(send, max_batch_size=3, max_wait=0.5, name="test_batches")
+    jobs = [("a", n) for n in range(6)] + [("b", 10)]
+    with ThreadPoolExecutor(len(jobs)) as executor:
+        results = list(executor.map(lambda job: dispatcher.submit(*job), jobs))
+
+    # every caller gets its own answer
+    assert results == [f"{key}:{n}" for key, n in jobs]
+    assert sorted(n for key, requests in batches if key == "a" for n in requests) == list(range(6))
+    assert all(len(requests) <= 3 for _, requests in batches)
+    # different keys are never batched together
+    assert ("b", [10]) in batches
+    assert len(batches) < len(jobs)
+
+
+def test_single_request_is_sent_after_max_wait() -> None:
+    dispatcher = BatchDispatcher(lambda key, requests: [r * 2 for r in requests],
+                                 max_batch_size=4, max_wait=0.01, name="test_batches")
+    assert dispatcher.submit("a", 21) == 42
+
+
+def test_errors_reach_all_callers() -> None:
+    def send(key, requests):
+        raise ValueError("rate limit")
+
+    dispatcher = BatchDispatcher(send, max_batch_size=2, max_wait=0.5, name="test_batches")
+    with ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(dispatcher.submit, "a", n) for n in range(2)]
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+
+
+def test_error_for_one_request() -> None:
+    def send(key, requests):
+        return [ValueError(f"no answer for {r}") if r == 1 else r * 2 for r in requests]
+
+    dispatcher = BatchDispatcher(send, max_batch_size=2, max_wait=0.5, name="test_batches")
+    with ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(dispatcher.submit, "a", n) for n in range(2)]
+        assert futures[0].result() == 0
+        with pytest.raises(ValueError, match="no answer for 1"):
+            futures[1].result()
+
+
+def test_numbered_items() -> None:
+    blocks = [
+        {"item": 2, "software": "Moodle", "software_usage_found": True},
+        {"item": 1, "software_usage_found": False},
+        {"item": 2, "software": "Ilias", "software_usage_found": False},
+        {"item": 7, "software_usage_found": True},
+        {"software_usage_found": True},
+    ]
+    assert numbered_items(blocks, 3) == [
+        [{"software_usage_found": False}],
+        [{"software": "Moodle", "software_usage_found": True},
+         {"software": "Ilias", "software_usage_found": False}],
+        None,
+    ]
@@ -0,0 +1,36 @@
+import json
+
+from metrics import Metrics, percentile
+
+
+def test_percentile() -> None:
+    values = [float(n) for n in range(1, 101)]
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 0.99) == 99
+    assert percentile([3.0], 0.99) == 3
+
+
+def test_summary(tmp_path) -> None:
+    metrics = Metrics()
+    metrics.record_call("google_search", 0.5, "miss")
+    metrics.record_call("google_search", 0.001, "hit")
+    metrics.record_call("google_search", 0.002, "hit")
+    metrics.record_call("google_search", 0.003, "coalesced")
+    metrics.increment("prefilter", "skipped", 2)
+
+    summary = metrics.summary()
+    google = summary["functions"]["google_search"]
+    assert google["calls"] == 4
+    assert google["hit_ratio"] == 0.75
+    assert google["p50_sec"] == 0.002
+    assert google["max_sec"] == 0.5
+    assert google["outcomes"] == {"miss": 1, "hit": 2, "coalesced": 1}
+    assert google["histogram"]["<=0.001s"] == 1
+    assert google["histogram"]["<=0.01s"] == 2
+    assert summary["counters"] == {"prefilter": {"skipped": 2}}
+
+    filename = tmp_path / "metrics.json"
+    metrics.write(str(filename))
+    with open(filename, encoding="utf-8") as f:
+        assert json.load(f)["functions"]["google_search"]["calls"] == 4
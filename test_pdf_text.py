@@ -0,0 +1,52 @@
+from crawler.pdf_text import PdfText, extract_text, is_pdf
+
+
+def make_pdf(pages: list[str]) -> bytes:
+    """
+    A minimal PDF with one line of text per page.
+    """
+    count = len(pages)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids ["
+        + b" ".join(b"%d 0 R" % (4 + 2 * i) for i in range(count))
+        + b"] /Count %d >>" % count,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, text in enumerate(pages):
+        stream = b"BT /F1 12 Tf 72 720 Td (%s) Tj ET" % text.encode("latin-1")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792]"
+                       b" /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (5 + 2 * i))
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return data
+
+
+def test_is_pdf() -> None:
+    assert is_pdf("application/pdf", b"")
+    assert is_pdf("application/octet-stream", b"%PDF-1.7\n...")
+    assert not is_pdf("text/html", b"<!DOCTYPE html>")
+
+
+def test_extract_text() -> None:
+    data = make_pdf(["Seite eins", "Seite zwei"])
+    assert extract_text(data) == PdfText("Seite eins\n\nSeite zwei", 2, 2, None)
+
+
+def test_extract_text_stops_early() -> None:
+    data = make_pdf([f"Seite {i} mit Moodle" for i in range(10)])
+    assert extract_text(data, max_pages=3) == PdfText(
+        "Seite 0 mit Moodle\n\nSeite 1 mit Moodle\n\nSeite 2 mit Moodle", 3, 10, "page_limit")
+
+    # 4 words are about 5 tokens per page
+    assert extract_text(data, token_budget=10) == PdfText(
+        "Seite 0 mit Moodle\n\nSeite 1 mit Moodle", 2, 10, "budget_reached")
@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("crawl4ai")
+
+import pipeline  # noqa: E402
+from crawler.content_store import Page  # noqa: E402
+from crawler.scraper import LMSResult  # noqa: E402
+from metrics import metrics  # noqa: E402
+from pipeline import PipelineConfig, make_record, run_pipeline  # noqa: E402
+
+JOBS = [({"website": "uni-example.de", "name": "Universität Example"}, "Moodle"),
+        ({"website": "hs-example.de", "name": "Hochschule Example"}, "Ilias")]
+
+
+def urls_for(site: str) -> list[str]:
+    return [f"https://www.{site}/seite{i}" for i in range(5)]
+
+
+class FakeScraper:
+    """
+    Replaces `google_search`, `fetch_page` and `scrape_url` of the pipeline.
+    URLs in `positive` are positive, URLs in `cached` have a cached
+    verdict, and classifying a URL in `failing` raises.
+    """
+
+    def __init__(self, positive=(), cached=(), failing=(), delay: float = 0.0):
+        self.positive = set(positive)
+        self.cached_urls = set(cached)
+        self.failing = set(failing)
+        self.delay = delay
+        self.fetched: list[str] = []
+        self.classified: list[str] = []
+        self.max_outstanding = 0
+
+    def verdict(self, url: str) -> LMSResult:
+        return LMSResult(reasoning=url, software_usage_found=url in self.positive)
+
+    def google_search(self, query: str, skip_cache=False) -> list[str]:
+        return urls_for(query.split()[0].removeprefix("site:"))
+
+    async def fetch_page(self, url: str) -> Page:
+        self.fetched.append(url)
+        self.max_outstanding = max(self.max_outstanding, len(self.fetched) - len(self.classified))
+        return Page(url=url, markdown=url)
+
+    async def scrape_url(self, url, prompt_template, arguments, skip_cache=False, page=None) -> LMSResult:
+        assert page is not None and page.url == url
+        await asyncio.sleep(self.delay)
+        if url in self.failing:
+            raise RuntimeError(f"LLM failed for {url}")
+        self.classified.append(url)
+        return self.verdict(url)
+
+    def cached(self, url, prompt_template, arguments) -> LMSResult:
+        if url not in self.cached_urls:
+            raise KeyError(url)
+        return self.verdict(url)
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    def install(**kwargs) -> FakeScraper:
+        scraper = FakeScraper(**kwargs)
+        scraper.scrape_url.__func__.cached = scraper.cached  # type: ignore
+        monkeypatch.setattr(pipeline, "google_search", scraper.google_search)
+        monkeypatch.setattr(pipeline, "fetch_page", scraper.fetch_page)
+        monkeypatch.setattr(pipeline, "scrape_url", scraper.scrape_url)
+        return scraper
+    return install
+
+
+def run(config: PipelineConfig, jobs=JOBS) -> list[dict]:
+    records: list[dict] = []
+    asyncio.run(asyncio.wait_for(run_pipeline(jobs, "{software}", records.append, config), 5))
+    return records
+
+
+def test_records_all_combinations(fake) -> None:
+    scraper = fake()
+    records = run(PipelineConfig(mode="all"))
+
+    assert sorted(record["software"] for record in records) == ["Ilias", "Moodle"]
+    for record in records:
+        site = "uni-example.de" if record["software"] == "Moodle" else "hs-example.de"
+        verdicts = {index: scraper.verdict(url) for index, url in enumerate(urls_for(site))}
+        assert record == make_record(record["einrichtung"], record["software"], urls_for(site), verdicts)
+
+
+def test_skips_cached_and_positive(fake) -> None:
+    moodle = urls_for("uni-example.de")
+    scraper = fake(positive=[moodle[1]], cached=[moodle[0], moodle[1]])
+    metrics.counters.pop("pipeline", None)
+    records = run(PipelineConfig(search_workers=1, fetch_workers=1, llm_workers=1,
+                                 mode="first-positive"), JOBS[:1])
+
+    # the cached verdicts are used, and the combination is positive
+    # before the other URLs are fetched
+    assert scraper.fetched == []
+    assert metrics.counters["pipeline"]["urls_cached"] == 2
+    assert metrics.counters["pipeline"]["urls_skipped"] == 3
+    [record] = records
+    assert record["usage_found"] is True
+    assert [item["url"] for item in record["reasoning"]["inputs"]] == moodle[:2]
+
+
+def test_bounded_queues(fake) -> None:
+    jobs = [({"website": f"uni{i}.example.de", "name": f"Uni {i}"}, "Moodle") for i in range(4)]
+    scraper = fake(delay=0.005)
+    records = run(PipelineConfig(search_workers=2, fetch_workers=1, llm_workers=1,
+                                 queue_size=1, mode="all"), jobs)
+
+    assert len(records) == 4
+    assert len(scraper.classified) == 20
+    # one page being classified, one in the queue, one waiting to be queued
+    assert scraper.max_outstanding <= 3
+    assert metrics.counters["stage:classify"]["queue_depth_max"] <= 1
+
+
+def test_failing_stage_stops_the_run(fake) -> None:
+    moodle = urls_for("uni-example.de")
+    scraper = fake(failing=[moodle[2]])
+    records: list[dict] = []
+    with pytest.raises(ExceptionGroup) as info:
+        asyncio.run(asyncio.wait_for(
+            run_pipeline(JOBS, "{software}", records.append, PipelineConfig(mode="all")), 5))
+
+    assert info.group_contains(RuntimeError, match="LLM failed")
+    assert all(record["software"] != "Moodle" for record in records)
+    assert moodle[2] not in scraper.classified
+    # the stage statistics are recorded anyway
+    assert "stage:fetch" in metrics.counters
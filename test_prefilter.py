@@ -0,0 +1,33 @@
+from crawler import prefilter as prefilter_module
+from crawler.prefilter import mentions, normalize, prefilter
+from metrics import metrics
+
+
+def test_normalize() -> None:
+    assert normalize("Lernplattform „ILIAS“ – Übersicht") == " lernplattform ilias uebersicht "
+    assert normalize("Stud.IP") == " stud ip "
+
+
+def test_mentions() -> None:
+    assert mentions("Die Kurse liegen im ILIAS der Hochschule.", "Ilias")
+    assert mentions("Unser Moodle-basiertes System", "Moodle")
+    assert mentions("Anmeldung im Moodlekurs", "Moodle")
+    assert mentions("Kurse in OLAT", "OpenOLAT")
+    assert mentions("Kurse in Open-OLAT", "OpenOLAT")
+    assert mentions("Login bei Stud IP", "Stud.IP")
+    assert not mentions("Heiße Chocolate in der Mensa", "OpenOLAT")
+    assert not mentions("Keine Lernplattform erwähnt", "Moodle")
+
+
+def test_prefilter_counts_and_aliases() -> None:
+    metrics.counters.pop("prefilter", None)
+    assert not prefilter("Unsere Lernplattform heißt Lernraum.", "Moodle")
+    prefilter_module.configure(aliases={"Moodle": ["Lernraum"]})
+    try:
+        assert prefilter("Unsere Lernplattform heißt Lernraum.", "Moodle")
+    finally:
+        prefilter_module.ALIASES["Moodle"].remove("Lernraum")
+    counters = metrics.counters["prefilter"]
+    assert counters["checked"] == 2
+    assert counters["rejected"] == 1
+    assert counters["hit_rate"] == 0.5
@@ -0,0 +1,37 @@
+import json
+
+from progress import ProgressIndex
+
+
+def test_append_and_load(tmp_path) -> None:
+    output_file = str(tmp_path / "results.jsonlines")
+    progress = ProgressIndex(output_file)
+    assert progress.load() == set()
+
+    progress.append({"einrichtung": "Uni A", "software": "Moodle", "usage_found": True})
+    progress.append({"einrichtung": "Uni A", "software": "Ilias", "usage_found": False})
+
+    assert ProgressIndex(output_file).load() == {("Uni A", "Moodle"), ("Uni A", "Ilias")}
+    with open(output_file, encoding="utf-8") as f:
+        assert [json.loads(line)["software"] for line in f] == ["Moodle", "Ilias"]
+
+
+def test_rebuilds_missing_or_stale_index(tmp_path) -> None:
+    output_file = tmp_path / "results.jsonlines"
+    # results written without an index, pretty-printed like older versions
+    output_file.write_text(
+        json.dumps({"einrichtung": "Uni A", "software": "Moodle"}, indent=2)
+        + json.dumps({"einrichtung": "Uni B", "software": "Ilias"}, indent=2),
+        encoding="utf-8")
+    progress = ProgressIndex(str(output_file))
+    assert progress.load() == {("Uni A", "Moodle"), ("Uni B", "Ilias")}
+    assert (tmp_path / "results.jsonlines.progress").exists()
+
+    # the results file grows without going through the index
+    with open(output_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"einrichtung": "Uni C", "software": "OpenOLAT"}) + "\n")
+    assert ProgressIndex(str(output_file)).load() == {
+        ("Uni A", "Moodle"), ("Uni B", "Ilias"), ("Uni C", "OpenOLAT")}
+
+    progress.append({"einrichtung": "Uni D", "software": "Moodle"})
+    assert len(ProgressIndex(str(output_file)).load()) == 4
@@ -0,0 +1,31 @@
+from crawler import ranking
+from crawler.ranking import bm25_scores, query_terms, top_chunks
+
+
+def test_bm25_prefers_relevant_chunks() -> None:
+    chunks = [
+        "Vorlesung Analysis I, Montag 10 Uhr, Hörsaal 3",
+        "Vorlesung Lineare Algebra, Dienstag 12 Uhr",
+        "Die Materialien stehen im Moodle-Kursraum bereit",
+        "Übung Analysis, Mittwoch",
+        "Anmeldung zu den Moodlekursen über die Lernplattform",
+    ]
+    scores = bm25_scores(chunks, ["Moodle", "Lernplattform"])
+    assert scores[0] == scores[1] == scores[3] == 0
+    assert scores[4] > scores[2] > 0
+    assert top_chunks(chunks, ["Moodle", "Lernplattform"], 3) == [4, 2, 0]
+
+
+def test_bm25_without_terms() -> None:
+    assert bm25_scores(["a", "b"], []) == [0.0, 0.0]
+    assert top_chunks(["a", "b", "c"], [], 2) == [0, 1]
+
+
+def test_query_terms_and_configure() -> None:
+    terms = list(ranking.CRITERION_TERMS)
+    try:
+        ranking.configure(max_chunks=3, terms=["Kurs"])
+        assert ranking.max_chunks() == 3
+        assert query_terms(["OpenOLAT"]) == ["OpenOLAT", "OLAT", "Open OLAT", "Kurs"]
+    finally:
+        ranking.configure(max_chunks=5, terms=terms)
@@ -0,0 +1,86 @@
+import gzip
+import importlib.util
+import json
+import time
+
+from pydantic import BaseModel
+from pytest import fixture, raises
+
+from record_results import ResultWriter, close_writers, record_results
+
+
+@fixture
+def results_path(tmp_path):
+    return str(tmp_path / "testfunc_20240101_000000")
+
+
+def read_lines(filename, opener=open):
+    with opener(filename, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_writes_compact_jsonl(results_path) -> None:
+    writer = ResultWriter(results_path, flush_interval=10)
+    writer.write({"args": {"query": "site:example.com Moodle"}, "return": ["ä"]})
+    writer.write({"args": {"query": "site:example.com Ilias"}, "return": []})
+    writer.close()
+
+    assert writer.files == [results_path + ".jsonl"]
+    with open(writer.files[0], encoding="utf-8") as f:
+        assert f.readline() == '{"args":{"query":"site:example.com Moodle"},"return":["ä"]}\n'
+    assert len(read_lines(writer.files[0])) == 2
+
+
+def test_flush_interval_and_flush(results_path) -> None:
+    writer = ResultWriter(results_path, flush_interval=0.05, batch_size=1000)
+    writer.write({"n": 1})
+    time.sleep(0.2)
+    assert read_lines(writer.files[0]) == [{"n": 1}]
+
+    writer.write({"n": 2})
+    writer.flush()
+    assert read_lines(writer.files[0]) == [{"n": 1}, {"n": 2}]
+    writer.close()
+
+
+def test_gzip_and_rotation(results_path) -> None:
+    writer = ResultWriter(results_path, batch_size=1, compression="gzip", max_bytes=20)
+    for n in range(3):
+        writer.write({"n": n, "padding": "x" * 10})
+    writer.close()
+
+    assert writer.files == [results_path + suffix
+                            for suffix in (".jsonl.gz", ".1.jsonl.gz", ".2.jsonl.gz")]
+    records = [record for filename in writer.files
+               for record in read_lines(filename, gzip.open)]
+    assert [record["n"] for record in records] == [0, 1, 2]
+
+
+def test_records_dict_of_models(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+
+    class Verdict(BaseModel):
+        reasoning: str
+        software_usage_found: bool
+
+    @record_results
+    def classify_multi(url, cache_return_info=False):
+        assert cache_return_info
+        return {"Moodle": Verdict(reasoning="Login", software_usage_found=True)}, "miss"
+
+    result = classify_multi("https://www.uni-example.de")
+    assert result["Moodle"].software_usage_found
+    close_writers()
+
+    [filename] = (tmp_path / "results").glob("classify_multi_*.jsonl")
+    assert read_lines(filename) == [{
+        "cache_hit": "miss",
+        "args": {"url": "https://www.uni-example.de"},
+        "return": {"Moodle": {"reasoning": "Login", "software_usage_found": True}},
+    }]
+
+
+def test_zstd_needs_zstandard(results_path, monkeypatch) -> None:
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name: None)
+    with raises(ValueError, match="zstandard"):
+        ResultWriter(results_path, compression="zstd")
@@ -0,0 +1,195 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("crawl4ai")
+
+from crawler import boilerplate, content_store, http_fetch, scraper  # noqa: E402
+from crawler import prefilter as prefilter_module  # noqa: E402
+from crawler.content_store import Page  # noqa: E402
+from crawler.scraper import PREFILTER, LMSResult, SoftwareVerdict, combine_verdicts  # noqa: E402
+from metrics import metrics  # noqa: E402
+from record_results import close_writers  # noqa: E402
+
+URL = "https://www.uni-example.de/lernplattform"
+
+
+def test_combine_verdicts() -> None:
+    assert combine_verdicts([
+        LMSResult(reasoning="Kein Hinweis", software_usage_found=False),
+        LMSResult(reasoning="Login-Link", software_usage_found=True),
+        LMSResult(reasoning="Kursliste", software_usage_found=True),
+    ]) == LMSResult(reasoning="Login-Link; Kursliste", software_usage_found=True)
+    assert combine_verdicts([]) == LMSResult(reasoning="No mention found.", software_usage_found=False)
+
+
+def test_classify_page_multi(monkeypatch) -> None:
+    monkeypatch.setitem(boilerplate._settings, "enabled", False)
+    asked = []
+
+    async def extract_blocks(page, prompt, response_format, software, stop_when=None):
+        asked.append((prompt, software))
+        return [
+            SoftwareVerdict(software="moodle ", reasoning="Chunk 1", software_usage_found=False),
+            SoftwareVerdict(software="Ilias", reasoning="Chunk 1", software_usage_found=False),
+            SoftwareVerdict(software="Moodle", reasoning="Chunk 2", software_usage_found=True),
+            SoftwareVerdict(software="Blackboard", reasoning="Chunk 2", software_usage_found=True),
+        ]
+
+    monkeypatch.setattr(scraper, "extract_blocks", extract_blocks)
+    page = Page(url="https://www.uni-example.de", markdown="Kurse in Moodle und ILIAS")
+    results = asyncio.run(scraper.classify_page_multi(
+        page, "Nutzt die Einrichtung {software}?", {}, ["Moodle", "Ilias", "OpenOLAT"]))
+
+    # OpenOLAT is not mentioned, so the LLM is not asked about it
+    assert asked == [("Nutzt die Einrichtung Moodle, Ilias?", ["Moodle", "Ilias"])]
+    assert results["Moodle"] == LMSResult(reasoning="Chunk 2", software_usage_found=True)
+    assert results["Ilias"] == LMSResult(reasoning="No mention found.", software_usage_found=False)
+    assert results["OpenOLAT"].reasoning.startswith(PREFILTER)
+    assert set(results) == {"Moodle", "Ilias", "OpenOLAT"}
+
+
+@pytest.fixture
+def fetcher(monkeypatch, tmp_path):
+    """
+    Replaces the HTTP fetch and the browser, and uses an empty content
+    store. Returns the list of URLs loaded with the browser.
+    """
+    settings = dict(content_store._settings)
+    content_store.configure(filename=str(tmp_path / "pages.sqlite"), enabled=True, refresh=False)
+    monkeypatch.setattr(metrics, "functions", {})
+    monkeypatch.setattr(metrics, "counters", {})
+    loaded = []
+
+    def install(http_result: tuple[Page | None, str], browser_success: bool = True) -> list[str]:
+        async def fetch(url):
+            return http_result
+
+        async def fetch_with_browser(url, is_pdf):
+            loaded.append(url)
+            return Page(url=url, markdown="Aus dem Browser" if browser_success else ""), browser_success
+
+        monkeypatch.setattr(http_fetch, "fetch", fetch)
+        monkeypatch.setattr(scraper, "fetch_with_browser", fetch_with_browser)
+        return loaded
+
+    yield install
+    content_store.configure(**settings)
+
+
+def test_fetch_page_http(fetcher) -> None:
+    loaded = fetcher((Page(url=URL, markdown="Per HTTP"), "ok"))
+    page = asyncio.run(scraper.fetch_page(URL))
+
+    assert page.markdown == "Per HTTP"
+    assert loaded == []
+    assert metrics.functions["fetch:http"].outcomes == {"ok": 1}
+    assert "fetch:browser" not in metrics.functions
+    assert content_store.lookup(URL).markdown == "Per HTTP"
+
+    # the second time, it comes from the content store
+    asyncio.run(scraper.fetch_page(URL))
+    assert metrics.counters["content_store"] == {"miss": 1, "hit": 1}
+
+
+@pytest.mark.parametrize("reason", ["status_404", "http_error", "not_html", "javascript", "too_little_text"])
+def test_fetch_page_falls_back_to_browser(fetcher, reason) -> None:
+    loaded = fetcher((None, reason))
+    page = asyncio.run(scraper.fetch_page(URL))
+
+    assert page.markdown == "Aus dem Browser"
+    assert loaded == [URL]
+    assert metrics.functions["fetch:http"].outcomes == {"fallback": 1}
+    assert metrics.functions["fetch:browser"].outcomes == {"ok": 1}
+    assert metrics.counters["fetch_fallback"] == {reason: 1}
+    assert content_store.lookup(URL).markdown == "Aus dem Browser"
+
+
+def test_failed_browser_fetch_is_not_stored(fetcher) -> None:
+    fetcher((None, "javascript"), browser_success=False)
+    asyncio.run(scraper.fetch_page(URL))
+
+    assert metrics.functions["fetch:browser"].outcomes == {"failed": 1}
+    assert content_store.lookup(URL) is None
+
+
+def test_make_llm_strategy(monkeypatch, tmp_path) -> None:
+    monkeypatch.chdir(tmp_path)
+    settings = {"LLM_PROVIDER": "openai/gpt-test", "LLM_BASE_URL": "https://llm.example.de/v1",
+                "LLM_API_KEY": "geheim"}
+    monkeypatch.setattr(scraper.dotenv, "get_key", lambda path, name: settings[name])
+    strategy = scraper.make_llm_strategy("Wird Moodle genutzt?", ranking_terms=["Moodle"])
+
+    assert strategy.llm_config.provider == "openai/gpt-test"
+    assert strategy.schema == LMSResult.model_json_schema()
+    assert strategy.ranking_terms == ["Moodle"]
+    assert strategy.cache is not None
+
+
+def test_scrape_url_multi_caches_prefilter_verdicts(monkeypatch, tmp_path) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(boilerplate._settings, "enabled", False)
+    asked = []
+
+    async def fetch_page(url):
+        return Page(url=url, markdown="Kurse in Moodle und im Lernraum")
+
+    async def extract_blocks(page, prompt, response_format, software, stop_when=None):
+        asked.append(software)
+        return [SoftwareVerdict(software=name, reasoning="Kurse", software_usage_found=True)
+                for name in software]
+
+    monkeypatch.setattr(scraper, "fetch_page", fetch_page)
+    monkeypatch.setattr(scraper, "extract_blocks", extract_blocks)
+
+    def scrape() -> dict[str, LMSResult]:
+        return asyncio.run(scraper.scrape_url_multi(
+            "https://www.uni-example.de/multi", "{software}", {}, ["Moodle", "Ilias"]))
+
+    results = scrape()
+    assert results["Ilias"].reasoning.startswith(PREFILTER)
+    # the result with the prefilter verdict for Ilias is cached
+    assert scrape() == results
+    assert asked == [["Moodle"]]
+
+    # with another alias, the LLM is asked again
+    prefilter_module.configure(aliases={"Ilias": ["Lernraum"]})
+    try:
+        results = scrape()
+    finally:
+        prefilter_module.ALIASES["Ilias"].remove("Lernraum")
+    assert asked == [["Moodle"], ["Moodle", "Ilias"]]
+    assert results["Ilias"].software_usage_found
+    close_writers()
+
+
+def test_cancelling_extract_blocks_stops_the_strategy(monkeypatch) -> None:
+    events = []
+
+    class BlockingStrategy:
+        evaluated_chunks = 0
+        skipped_chunks: list[int] = []
+
+        def __init__(self, stop_event):
+            self.stop_event = stop_event
+            events.append(stop_event)
+
+        def run(self, url, sections):
+            # like the waves of `ChunkLimitedLLMExtractionStrategy.run`
+            assert self.stop_event.wait(5)
+            return []
+
+    monkeypatch.setattr(scraper, "make_llm_strategy",
+                        lambda prompt, schema, stop_when, terms, stop_event: BlockingStrategy(stop_event))
+
+    async def main() -> None:
+        task = asyncio.create_task(scraper.extract_blocks(
+            Page(url=URL, markdown="Kurse in Moodle"), "{software}", LMSResult, ["Moodle"]))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(asyncio.wait_for(main(), 2))
+    [stop] = events
+    assert stop.is_set()
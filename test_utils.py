@@ -0,0 +1,46 @@
+import json
+
+from utils import parse_json_objects
+
+
+def write(tmp_path, content: str):
+    filename = tmp_path / "results.jsonlines"
+    filename.write_bytes(content.encode("utf-8"))
+    return str(filename)
+
+
+OBJECTS = [
+    {"einrichtung": "Universität Kassel", "software": "Moodle", "usage_found": True},
+    {"einrichtung": "Uni {Klammer}", "software": "Ilias", "reasoning": 'ein "Zitat" \\ und }'},
+    {"einrichtung": "FH Aachen", "software": "OpenOLAT", "reasoning": {"inputs": [{"url": "x"}]}},
+]
+
+
+def test_jsonl(tmp_path) -> None:
+    content = "".join(json.dumps(obj, ensure_ascii=False) + "\n" for obj in OBJECTS)
+    assert list(parse_json_objects(write(tmp_path, content))) == OBJECTS
+
+
+def test_concatenated_pretty_printed(tmp_path) -> None:
+    content = "".join(json.dumps(obj, ensure_ascii=False, indent=2) for obj in OBJECTS)
+    filename = write(tmp_path, content)
+    assert list(parse_json_objects(filename)) == OBJECTS
+    # object boundaries falling between chunks
+    for chunk_size in (1, 2, 3, 7):
+        assert list(parse_json_objects(filename, chunk_size=chunk_size)) == OBJECTS
+
+
+def test_several_objects_per_line(tmp_path) -> None:
+    content = "".join(json.dumps(obj) for obj in OBJECTS) + "\n"
+    assert list(parse_json_objects(write(tmp_path, content))) == OBJECTS
+
+
+def test_reports_malformed_records(tmp_path) -> None:
+    good = json.dumps(OBJECTS[0]) + "\n"
+    bad = '{"einrichtung": "kaputt", }\n'
+    content = good + bad + good + '{"abgeschnitten": '
+    errors = []
+    assert list(parse_json_objects(write(tmp_path, content), errors=errors)) == [
+        OBJECTS[0], OBJECTS[0]]
+    assert [offset for offset, _ in errors] == [
+        len(good.encode()), len((good + bad + good).encode())]
@@ -11,10 +11,12 @@
 #     # Logic after the function call
 
 import asyncio
+import concurrent.futures
 import functools
 from contextlib import contextmanager
 import json
 import logging
+import re
 log = logging.getLogger(__name__)
 
 # class DontCallWrapped(Exception):
@@ -29,7 +31,14 @@ log = logging.getLogger(__name__)
 def sync_async_decorator(decorator_logic):
     """
     A decorator that can handle both synchronous and asynchronous functions.
-    It uses a context manager to execute logic before and after the function call.
+    It uses a generator to execute logic before and after the function call.
+
+    The generator yields `(args, kwargs)` to call the wrapped function and
+    receives its result (or has its exception thrown in). It may also
+    yield a `concurrent.futures.Future`, in which case the wrapper waits
+    for the future and sends back its result instead of calling the
+    function. The return value of the generator is the return value of
+    the decorated function.
     """
 
     def decorator(func):
@@ -41,27 +50,24 @@ def sync_async_decorator(decorator_logic):
                 try:
                     log.debug("calling next(gen)")
                     val = next(gen)
-                    # val is the modified args, kwargs
-                    log.debug("val:", val)
-                except StopIteration as exc:
-                    log.debug("Decorator logic did not yield any value, returning early")
-                    return exc.value
-                args, kwargs = val
-                try:
-                    result = await func(*args, **kwargs)
-                except Exception as e:
-                    log.debug(f"Exception in function {func.__name__}: {e}")
-                    raise
-                try:
-                    log.debug("Sending result back to generator:", result)
-                    tmp = gen.send(result)  # Send the function result back to the generator
-                    log.debug("tmp:", tmp)
-                    # next(gen)
-                    raise RuntimeError("generator didn't stop")
+                    while True:
+                        try:
+                            if isinstance(val, concurrent.futures.Future):
+                                # shield, so that cancelling this call does
+                                # not cancel the future for other waiters
+                                result = await asyncio.shield(asyncio.wrap_future(val))
+                            else:
+                                # val is the modified args, kwargs
+                                args, kwargs = val
+                                result = await func(*args, **kwargs)
+                        except BaseException as e:
+                            log.debug(f"Exception in function {func.__name__}: {e}")
+                            val = gen.throw(e)
+                        else:
+                            # Send the function result back to the generator
+                            val = gen.send(result)
                 except StopIteration as exc:
                     # receive the return value from the generator
-                    log.debug("Decorator logic completed successfully, result:", result)
-                    log.debug("exc.value:", exc.value)
                     return exc.value
 
         else:
@@ -71,83 +77,146 @@ def sync_async_decorator(decorator_logic):
                 try:
                     log.debug("calling next(gen)")
                     val = next(gen)
-                    log.debug("val:", val)
-                except StopIteration as exc:
-                    log.debug("Decorator logic did not yield any value, returning early")
-                    return exc.value
-                args, kwargs = val
-                try:
-                    result = func(*args, **kwargs)
-                except Exception as e:
-                    log.debug(f"Exception in function {func.__name__}: {e}")
-                    raise
-                try:
-                    log.debug("Sending result back to generator:", result)
-                    tmp = gen.send(result)  # Send the result back to the generator
-                    log.debug("tmp:", tmp)
-                    # next(gen)
-                    raise RuntimeError("generator didn't stop")
+                    while True:
+                        try:
+                            if isinstance(val, concurrent.futures.Future):
+                                result = val.result()
+                            else:
+                                args, kwargs = val
+                                result = func(*args, **kwargs)
+                        except BaseException as e:
+                            log.debug(f"Exception in function {func.__name__}: {e}")
+                            val = gen.throw(e)
+                        else:
+                            val = gen.send(result)
                 except StopIteration as exc:
-                    log.debug("Decorator logic completed successfully, result:", result)
-                    log.debug("exc.value:", exc.value)
                     return exc.value
         return wrapper
     return decorator
 
 
-def parse_json_objects(filename):
+# Characters that matter when looking for the end of an object,
+# outside of strings and inside of them
+_OBJECT_SPECIAL = re.compile(rb'[{}"]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+
+
+class _ObjectScanner:
+    """
+    Finds complete top-level {...} objects in a stream of bytes that is
+    fed in pieces, taking strings and escapes into account.
+    Text between objects is skipped.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape_next = False
+        self.start = 0
+        self.parts: list[bytes] = []
+
+    def feed(self, data: bytes, offset: int):
+        """
+        Yields `(start offset, bytes)` of each object completed in `data`,
+        which starts at byte `offset` of the stream.
+        """
+        pos = 0
+        object_start = 0
+        if self.escape_next:
+            # escaped character at the start of this piece
+            self.escape_next = False
+            pos = 1
+        while True:
+            if self.depth == 0:
+                # Suche nach öffnender Klammer
+                pos = data.find(b"{", pos)
+                if pos < 0:
+                    return
+                self.start = offset + pos
+                object_start = pos
+                self.depth = 1
+                pos += 1
+                continue
+
+            special = _STRING_SPECIAL if self.in_string else _OBJECT_SPECIAL
+            match = special.search(data, pos)
+            if match is None:
+                self.parts.append(data[object_start:])
+                return
+            char = match.group()
+            pos = match.end()
+
+            if self.in_string:
+                if char == b"\\":
+                    if pos >= len(data):
+                        self.escape_next = True
+                    pos += 1
+                else:
+                    self.in_string = False
+            elif char == b'"':
+                self.in_string = True
+            elif char == b"{":
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    # Gefunden: komplettes JSON-Objekt
+                    self.parts.append(data[object_start:pos])
+                    yield self.start, b"".join(self.parts)
+                    self.parts = []
+
+
+def parse_json_objects(filename, errors: list[tuple[int, str]] | None = None,
+                       chunk_size: int = 1 << 20):
     """
     Parst JSON-Objekte aus einer Datei, die mehrere JSON-Objekte enthält
     (nicht durch Zeilenumbrüche getrennt), von öffnender zu schließender Klammer.
+
+    Die Datei wird zeilenweise in Blöcken von höchstens `chunk_size` Bytes
+    gelesen, es wird also nie die ganze Datei in den Speicher geladen.
+    Zeilen, die genau ein Objekt enthalten (JSON Lines), werden direkt
+    geparst; alles andere (z.B. formatierte Objekte über mehrere Zeilen)
+    geht durch einen langsameren Scanner.
+    Fehlerhafte Objekte werden mit ihrem Byte-Offset geloggt und, falls
+    angegeben, an `errors` als `(offset, fehlermeldung)` angehängt.
     """
 
-    with open(filename, "r", encoding="utf-8") as f:
-        content = f.read()
-
-    i = 0
-    while i < len(content):
-        # Überspringe Whitespace
-        while i < len(content) and content[i].isspace():
-            i += 1
-
-        if i >= len(content):
-            break
-
-        # Suche nach öffnender Klammer
-        if content[i] == '{':
-            start = i
-            brace_count = 0
-            in_string = False
-            escape_next = False
-
-            while i < len(content):
-                char = content[i]
-
-                if escape_next:
-                    escape_next = False
-                elif char == '\\':
-                    escape_next = True
-                elif char == '"' and not escape_next:
-                    in_string = not in_string
-                elif not in_string:
-                    if char == '{':
-                        brace_count += 1
-                    elif char == '}':
-                        brace_count -= 1
-                        if brace_count == 0:
-                            # Gefunden: komplettes JSON-Objekt
-                            json_str = content[start:i+1]
-                            try:
-                                json_obj = json.loads(json_str)
-                                yield json_obj
-                            except json.JSONDecodeError as e:
-                                print(f"Fehler beim Parsen von JSON: {e}")
-                                print(f"JSON-String: {json_str[:100]}...")
-                            break
-
-                i += 1
-
-        i += 1
+    def report(offset, message):
+        log.warning(f"Fehler beim Parsen von JSON bei Byte {offset} in {filename}: {message}")
+        if errors is not None:
+            errors.append((offset, message))
+
+    scanner = _ObjectScanner()
+    offset = 0
+    with open(filename, "rb") as f:
+        while True:
+            line = f.readline(chunk_size)
+            if not line:
+                break
+            line_offset = offset
+            offset += len(line)
+
+            # fast path: one complete object per line
+            if scanner.depth == 0 and (line.endswith(b"\n") or len(line) < chunk_size):
+                stripped = line.strip()
+                if stripped.startswith(b"{") and stripped.endswith(b"}"):
+                    try:
+                        yield json.loads(stripped)
+                        continue
+                    except ValueError:
+                        # e.g. several objects on one line, let the scanner decide
+                        pass
+
+            for start, data in scanner.feed(line, line_offset):
+                try:
+                    json_obj = json.loads(data)
+                except ValueError as e:
+                    report(start, str(e))
+                    continue
+                yield json_obj
+
+    if scanner.depth > 0:
+        report(scanner.start, "Unvollständiges Objekt am Dateiende")
 
     # cm = contextmanager(decorator_logic)
     # def decorator(func):